@@ -0,0 +1,224 @@
+"""Benchmarks for ckanext-deadoralive's scheduling and report code paths.
+
+Seeds the test database with lots of synthetic resources and link checker
+results and then times get_resources_to_check(), upsert(), upsert_many() and
+the broken_links_by_organization and broken_links_by_email reports. For each
+one it prints the time taken per call, the number of SQL queries per call and
+its peak memory use, so that performance regressions are visible.
+
+The seeding and each benchmark run in their own forked child process, so
+that each benchmark's peak memory use is its own and not the high-water mark
+left by seeding or by an earlier benchmark.
+
+From the ckanext-deadoralive directory run:
+
+    nosetests --nologcapture --with-pylons=test.ini -s benchmarks.py
+
+By default it benchmarks a site with 10,000 resources. To benchmark other
+sizes put a comma-separated list of numbers of resources in the
+DEADORALIVE_BENCHMARK_SIZES environment variable:
+
+    DEADORALIVE_BENCHMARK_SIZES=10000,100000,1000000 nosetests ...
+
+Note that seeding 1,000,000 resources takes a long time.
+
+"""
+import datetime
+import multiprocessing
+import os
+import Queue
+import resource
+import time
+import traceback
+
+import sqlalchemy.event
+
+import ckan.model
+import ckan.new_tests.helpers as helpers
+import ckanext.deadoralive.config as config
+import ckanext.deadoralive.model.results as results
+import ckanext.deadoralive.tests.factories as custom_factories
+import ckanext.deadoralive.tests.helpers as custom_helpers
+
+
+def _sizes():
+    sizes = os.environ.get("DEADORALIVE_BENCHMARK_SIZES", "10000")
+    return [int(size) for size in sizes.split(",") if size.strip()]
+
+
+class _QueryCounter(object):
+    """Counts the SQL statements that SQLAlchemy sends to the database.
+
+    An executemany() counts as one statement.
+
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        self.count += 1
+
+
+# SQLAlchemy 0.7 can't remove event listeners, so the one counter is listened
+# for once and the benchmarks read the difference in its count.
+_query_counter = None
+
+
+def _get_query_counter():
+    global _query_counter
+    if _query_counter is None:
+        _query_counter = _QueryCounter()
+        sqlalchemy.event.listen(ckan.model.meta.engine,
+                                "before_cursor_execute", _query_counter)
+    return _query_counter
+
+
+def _max_rss_mb():
+    """Return the peak memory use of this process so far, in megabytes."""
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _in_child_process(func):
+    """Call func() in a forked child process and return its return value.
+
+    The return value is sent back through a queue, so it must be picklable.
+    The database connections are closed before forking so that the child
+    process doesn't share them, it opens its own.
+
+    """
+    ckan.model.Session.remove()
+    ckan.model.meta.engine.dispose()
+    queue = multiprocessing.Queue()
+
+    def target():
+        try:
+            queue.put((True, func()))
+        except Exception:
+            queue.put((False, traceback.format_exc()))
+        finally:
+            ckan.model.Session.remove()
+
+    process = multiprocessing.Process(target=target)
+    process.start()
+    while True:
+        try:
+            succeeded, value = queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            if not process.is_alive() and queue.empty():
+                raise AssertionError(
+                    "The benchmark process exited with code {0}".format(
+                        process.exitcode))
+    process.join()
+    if not succeeded:
+        raise AssertionError("The benchmark failed:\n" + value)
+    return value
+
+
+def _measure(size, name, func, repeat=1):
+    """Call func(i) repeat times and print how long each call took etc.
+
+    The calls are made in a child process (see _in_child_process()) and the
+    memory use printed is that process's peak and how much it grew during the
+    calls.
+
+    :returns: the return value of the last call
+
+    """
+    def measure():
+        counter = _get_query_counter()
+        queries_before = counter.count
+        rss_before = _max_rss_mb()
+        start = time.time()
+        for i in range(repeat):
+            value = func(i)
+        seconds = (time.time() - start) / repeat
+        queries = (counter.count - queries_before) / float(repeat)
+        rss_after = _max_rss_mb()
+        return (seconds, queries, rss_after, rss_after - rss_before), value
+
+    (seconds, queries, peak, grew), value = _in_child_process(measure)
+    print "{0:>9} {1:<32} {2:>10.1f} {3:>8.1f} {4:>10.1f} {5:>+8.1f}".format(
+        size, name, seconds * 1000, queries, peak, grew)
+    return value
+
+
+def _print_header():
+    print
+    print "{0:>9} {1:<32} {2:>10} {3:>8} {4:>10} {5:>8}".format(
+        "resources", "benchmark", "ms/call", "queries", "peak MB",
+        "grew MB")
+
+
+# The number of resources that the upsert and upsert_many benchmarks save
+# results for.
+_NUM_UPSERTED = 500
+
+
+class TestBenchmarks(custom_helpers.FunctionalTestBaseClass):
+
+    def setup(self):
+        custom_helpers.FunctionalTestBaseClass.setup(self)
+        self.original_report_cache_ttl = config.report_cache_ttl
+        # Time the reports themselves, not the cache.
+        config.report_cache_ttl = 0
+
+    def teardown(self):
+        config.report_cache_ttl = self.original_report_cache_ttl
+
+    def test_benchmarks(self):
+        _print_header()
+        for i, size in enumerate(_sizes()):
+            if i > 0:
+                custom_helpers.FunctionalTestBaseClass.setup(self)
+            self._benchmark(size)
+
+    def _benchmark(self, size):
+        def seed(_):
+            resource_ids = custom_factories.bulk_create_resources(size)
+            custom_factories.bulk_create_results(resource_ids)
+            # Only the IDs that the upsert benchmarks use are sent back.
+            return resource_ids[:_NUM_UPSERTED]
+        resource_ids = _measure(size, "seed", seed)
+
+        since = datetime.timedelta(hours=config.recheck_resources_after)
+        pending_since = datetime.timedelta(
+            hours=config.resend_pending_resources_after)
+
+        def get_resources_to_check(_):
+            results.get_resources_to_check(50, since=since,
+                                           pending_since=pending_since)
+        _measure(size, "get_resources_to_check(50)", get_resources_to_check,
+                 repeat=10)
+
+        def get_resources_to_check_per_host(_):
+            results.get_resources_to_check(
+                50, since=since, pending_since=pending_since,
+                max_per_host=2, include_urls=True)
+        _measure(size, "get_resources_to_check per host",
+                 get_resources_to_check_per_host, repeat=10)
+
+        def upsert(i):
+            results.upsert(resource_ids[i], alive=(i % 2 == 0), status=200)
+        _measure(size, "upsert", upsert, repeat=min(100, size))
+
+        def upsert_many(i):
+            start = i * 50
+            results.upsert_many([
+                dict(resource_id=resource_id, alive=True, status=200)
+                for resource_id in resource_ids[start:start + 50]])
+        _measure(size, "upsert_many(50)", upsert_many,
+                 repeat=max(1, min(10, size // 50)))
+
+        def broken_links_by_organization(_):
+            helpers.call_action(
+                "ckanext_deadoralive_broken_links_by_organization")
+        _measure(size, "broken_links_by_organization",
+                 broken_links_by_organization, repeat=3)
+
+        def broken_links_by_email(_):
+            helpers.call_action("ckanext_deadoralive_broken_links_by_email")
+        _measure(size, "broken_links_by_email", broken_links_by_email,
+                 repeat=3)
@@ -0,0 +1,161 @@
+"""Caching for this extension's broken link reports.
+
+The broken link reports are visible to anyone and each one reads all of the
+site's broken links from the database, so their results are cached.
+
+Cached reports are keyed by the results generation (see
+results.get_generation()), which is incremented whenever any resource becomes
+broken or stops being broken, so a cached report is never used after an
+upsert that changed it. The reports also include the datasets' and
+organizations' titles, email addresses etc, changes to those will show up
+when the cached report expires after ``report_cache_ttl`` seconds.
+
+There are two cache backends:
+
+``memory``
+  An in-process least-recently-used cache of up to ``report_cache_size``
+  reports (the default).
+
+``beaker``
+  A shared cache configured by the ``beaker.cache.*`` settings in the CKAN
+  config file (e.g. ``beaker.cache.type = ext:memcached``), so that all of
+  the site's processes can share cached reports. The in-process cache is
+  still used in front of it.
+
+Cached reports are shared between callers, so they mustn't be modified.
+
+"""
+import collections
+import hashlib
+import json
+import threading
+import time
+
+import beaker.cache
+import beaker.util
+import pylons.config
+
+import ckanext.deadoralive.config as config
+import ckanext.deadoralive.model.results as results
+
+
+def get_or_create(name, data_dict, createfunc):
+    """Return a cached report, or create it and cache it.
+
+    :param name: the name of the report, e.g. the name of the action function
+        that returns it
+    :type name: string
+
+    :param data_dict: the params that the report was requested with, reports
+        requested with different params are cached separately
+    :type data_dict: dict
+
+    :param createfunc: the function to call (with no arguments) to create the
+        report if it isn't cached
+
+    """
+    if config.report_cache_ttl <= 0:
+        return createfunc()
+
+    key = _key(name, data_dict)
+    value = _memory_cache.get(key)
+    if value is not _MISSING:
+        return value
+
+    if config.report_cache_backend == "beaker":
+        try:
+            value = _get_beaker_cache().get_value(key)
+        except KeyError:
+            value = createfunc()
+            _get_beaker_cache().put(key, value)
+    else:
+        value = createfunc()
+
+    _memory_cache.set(key, value, config.report_cache_ttl,
+                      config.report_cache_size)
+    return value
+
+
+def clear():
+    """Empty the in-process cache.
+
+    Reports in the beaker cache (if any) are left, they'll expire by
+    themselves.
+
+    """
+    global _beaker_cache
+    _memory_cache.clear()
+    with _beaker_cache_lock:
+        _beaker_cache = None
+
+
+def _key(name, data_dict):
+    """Return the cache key for the given report.
+
+    The key covers the report's name and params and the current results
+    generation. (The reports don't depend on the broken link settings
+    directly, changing them bumps the generation when the saved broken states
+    are recomputed, see results.update_broken_states().)
+
+    """
+    key = json.dumps([name, data_dict, results.get_generation()],
+                     sort_keys=True, default=str)
+    return hashlib.sha1(key).hexdigest()
+
+
+_MISSING = object()
+
+
+class _LRUCache(object):
+
+    """A thread-safe in-process least-recently-used cache with expiry times.
+
+    This is a private class - other modules shouldn't use it.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+
+    def get(self, key):
+        """Return the cached value for key, or _MISSING."""
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return _MISSING
+            expires, value = item
+            if expires < time.time():
+                return _MISSING
+            # Re-inserting the item moves it to the most-recently-used end.
+            self._items[key] = item
+            return value
+
+    def set(self, key, value, ttl, max_size):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (time.time() + ttl, value)
+            while len(self._items) > max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+_memory_cache = _LRUCache()
+
+_beaker_cache = None
+_beaker_cache_lock = threading.Lock()
+
+
+def _get_beaker_cache():
+    """Return the beaker cache, creating it the first time it's needed."""
+    global _beaker_cache
+    with _beaker_cache_lock:
+        if _beaker_cache is None:
+            manager = beaker.cache.CacheManager(
+                **beaker.util.parse_cache_config_options(pylons.config))
+            _beaker_cache = manager.get_cache(
+                "ckanext_deadoralive_reports",
+                expire=config.report_cache_ttl)
+        return _beaker_cache
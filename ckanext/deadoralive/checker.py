@@ -0,0 +1,401 @@
+"""A built-in link checker that checks resources directly from the database.
+
+This does the same job as the external deadoralive link checker service, but
+instead of getting the resources to check and posting the results back over
+the CKAN API it calls the model functions directly, so it's run on a machine
+that has the CKAN config file (``paster deadoralive check``, see commands.py).
+
+Each batch of resources is leased with results.get_resources_to_check() and
+their links are checked concurrently by a pool of threads sharing one HTTP
+connection pool, with a limit on the number of concurrent requests to any one
+host. All of the batch's results are then saved together with
+results.upsert_many().
+
+Only the main thread uses the database, the worker threads just make the HTTP
+requests.
+
+To use more than one CPU core, run_processes() runs run() in several worker
+processes at once. Leasing resources is serialized by a database lock (see
+results.get_resources_to_check()) so each process gets different resources.
+
+"""
+import collections
+import datetime
+import functools
+import logging
+import multiprocessing
+import multiprocessing.pool
+import Queue
+import signal
+import threading
+import time
+
+import requests
+import requests.adapters
+
+import ckan.model
+import ckanext.deadoralive.config as config
+import ckanext.deadoralive.model.results as results
+
+
+log = logging.getLogger(__name__)
+
+USER_AGENT = "ckanext-deadoralive"
+
+
+def run(batch_size=50, concurrency=10, per_host=2, timeout=30,
+        max_batches=None, stop=None):
+    """Check resources' links until there are none left to check.
+
+    Keeps leasing batches of resources that are due to be checked and saving
+    their results until there are no more resources due to be checked (or
+    until ``max_batches`` batches have been checked).
+
+    When get_resources_to_check() returns no resources but some are still
+    due, because their hosts are cooling down (see the ``host_cooldown``
+    setting), the checker waits for the hosts to cool down and carries on.
+
+    :param batch_size: the maximum number of resources to lease at once
+    :type batch_size: int
+
+    :param concurrency: the maximum number of links to check at once
+    :type concurrency: int
+
+    :param per_host: the maximum number of links on the same host to check at
+        once, 0 for no limit
+    :type per_host: int
+
+    :param timeout: the number of seconds to wait for a server to respond
+        before counting the link as dead
+    :type timeout: int or float
+
+    :param max_batches: the maximum number of batches to check, or None to
+        keep going until there are no resources left to check
+    :type max_batches: int
+
+    :param stop: an event that, when set, stops the checker after it finishes
+        the batch that it's checking (optional)
+    :type stop: threading.Event or multiprocessing.Event
+
+    :returns: the number of resources that were checked and the numbers of
+        them whose links were alive and dead
+    :rtype: dict with the keys ``checked``, ``alive`` and ``dead``
+
+    """
+    stats = collections.Counter(checked=0, alive=0, dead=0)
+    session = _make_session(concurrency)
+    limiter = _HostLimiter(per_host)
+    pool = multiprocessing.pool.ThreadPool(concurrency)
+    try:
+        num_batches = 0
+        while max_batches is None or num_batches < max_batches:
+            if stop is not None and stop.is_set():
+                break
+            results_ = check_batch(pool, session, limiter, batch_size,
+                                   timeout)
+            if not results_:
+                if not _throttled():
+                    break
+                log.info("The hosts of all the resources that are due to be "
+                         "checked are cooling down, waiting")
+                _wait(stop, min(config.host_cooldown, _MAX_THROTTLED_WAIT))
+                continue
+            num_batches += 1
+            for result in results_:
+                stats["checked"] += 1
+                stats["alive" if result["alive"] else "dead"] += 1
+            log.info("Checked %s links (%s alive, %s dead)",
+                     stats["checked"], stats["alive"], stats["dead"])
+    finally:
+        pool.close()
+        pool.join()
+        session.close()
+    return dict(stats)
+
+
+def run_processes(processes, **kwargs):
+    """Check resources' links in several worker processes at once.
+
+    Each worker process calls run() with the given keyword arguments and
+    sends its stats back to this process when it finishes.
+
+    If this process receives SIGTERM or SIGINT the workers finish the batches
+    that they're checking (saving the results) and then exit.
+
+    :param processes: the number of worker processes to run
+    :type processes: int
+
+    :returns: the total stats of all the worker processes, see run(), plus
+        ``failed_processes``: the number of worker processes that crashed
+    :rtype: dict
+
+    """
+    stop = multiprocessing.Event()
+    queue = multiprocessing.Queue()
+
+    # The workers mustn't share this process's database connections, so close
+    # them before forking. Each worker then opens its own connections.
+    ckan.model.Session.remove()
+    ckan.model.meta.engine.dispose()
+
+    workers = [multiprocessing.Process(target=_worker,
+                                       args=(queue, stop, kwargs))
+               for _ in range(processes)]
+
+    def handle_signal(signum, frame):
+        log.info("Received signal %s, stopping after the current batches",
+                 signum)
+        stop.set()
+
+    previous_handlers = dict(
+        (signum, signal.signal(signum, handle_signal))
+        for signum in (signal.SIGTERM, signal.SIGINT))
+    try:
+        for worker in workers:
+            worker.start()
+
+        stats = collections.Counter(checked=0, alive=0, dead=0)
+        finished = 0
+        while finished < len(workers):
+            # Check this before get(), any workers that have already exited
+            # will have already sent their stats.
+            workers_alive = any(worker.is_alive() for worker in workers)
+            try:
+                worker_stats = queue.get(timeout=1)
+            except Queue.Empty:
+                if not workers_alive:
+                    # Some workers crashed without sending their stats.
+                    break
+                continue
+            except IOError:
+                # The call to get() was interrupted by a signal.
+                continue
+            finished += 1
+            stats.update(worker_stats)
+
+        for worker in workers:
+            worker.join()
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+    stats["failed_processes"] = len(
+        [worker for worker in workers if worker.exitcode != 0])
+    return dict(stats)
+
+
+def _worker(queue, stop, kwargs):
+    """Run the link checker in a worker process started by run_processes()."""
+    # The parent process tells the workers when to stop. If the whole process
+    # group is sent a signal, just finish the current batch.
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: stop.set())
+    try:
+        stats = run(stop=stop, **kwargs)
+    finally:
+        ckan.model.Session.remove()
+    queue.put(stats)
+
+
+def _throttled():
+    """Return True if there are resources due to be checked that
+    get_resources_to_check() held back because of the host cooldown."""
+    if not config.host_cooldown:
+        return False
+    since, pending_since = _get_lease_times()
+    return results.get_stats(since, pending_since)["queue_depth"] > 0
+
+
+def _wait(stop, seconds):
+    """Sleep for the given number of seconds, or until stop is set."""
+    if stop is None:
+        time.sleep(seconds)
+    else:
+        stop.wait(seconds)
+
+
+# The maximum number of seconds to wait for hosts to cool down before trying
+# to lease resources again.
+_MAX_THROTTLED_WAIT = 10
+
+
+def _get_lease_times():
+    """Return the since and pending_since params for
+    get_resources_to_check()."""
+    return (datetime.timedelta(hours=config.recheck_resources_after),
+            datetime.timedelta(hours=config.resend_pending_resources_after))
+
+
+def check_batch(pool, session, limiter, batch_size, timeout):
+    """Lease one batch of resources, check their links and save the results.
+
+    :returns: the results that were saved (an empty list if there were no
+        resources to check)
+    :rtype: list of dicts
+
+    """
+    since, pending_since = _get_lease_times()
+    resources = results.get_resources_to_check(
+        batch_size, since=since, pending_since=pending_since,
+        max_per_host=config.max_resources_per_host,
+        host_cooldown=datetime.timedelta(seconds=config.host_cooldown),
+        include_urls=True)
+    if not resources:
+        return []
+
+    validators = results.get_validators(
+        [resource["id"] for resource in resources])
+    for resource, validators_ in zip(resources, validators):
+        resource.update(validators_)
+
+    results_ = pool.map(
+        functools.partial(_check_resource, session=session, limiter=limiter,
+                          timeout=timeout),
+        resources)
+    results.upsert_many(results_)
+    return results_
+
+
+def _check_resource(resource, session, limiter, timeout):
+    """Check one resource's link and return the result to be saved.
+
+    Any unexpected error checking the link is logged and the link is saved as
+    dead, so that one resource can't lose the rest of its batch's results.
+
+    """
+    try:
+        with limiter(results.get_host(resource["url"])):
+            result = check_url(session, resource["url"], timeout,
+                               validators=resource)
+    except Exception as err:
+        log.exception("Error checking resource %s", resource["id"])
+        result = dict(alive=False, status=None, reason=type(err).__name__,
+                      etag=None, last_modified=None, content_length=None)
+    result["resource_id"] = resource["id"]
+    return result
+
+
+def check_url(session, url, timeout, validators=None):
+    """Check whether the given URL is dead or alive.
+
+    Only the response's headers are downloaded, not its body.
+
+    If the resource's saved ``etag`` or ``last_modified`` validators are given
+    the request is a conditional one, and a 304 Not Modified response counts
+    as alive.
+
+    :param session: the requests session to make the request with
+
+    :param url: the URL to check
+    :type url: string
+
+    :param timeout: the number of seconds to wait for the server to respond
+    :type timeout: int or float
+
+    :param validators: the resource's saved HTTP validators (optional)
+    :type validators: dict with the optional keys ``etag`` and
+        ``last_modified``
+
+    :returns: the result, with the keys ``alive`` (bool), ``status`` (the
+        HTTP status code, or None if there was no valid HTTP response),
+        ``reason`` (the HTTP reason or the error) and ``etag``,
+        ``last_modified`` and ``content_length`` (from the response's
+        headers, or None)
+    :rtype: dict
+
+    """
+    result = dict(alive=False, status=None, reason=None, etag=None,
+                  last_modified=None, content_length=None)
+    if not url:
+        result["reason"] = "Invalid URL"
+        return result
+
+    headers = {"User-Agent": USER_AGENT}
+    validators = validators or {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    try:
+        response = session.get(url, headers=headers, timeout=timeout,
+                               stream=True)
+    except (requests.exceptions.RequestException, ValueError,
+            UnicodeError) as err:
+        result["reason"] = _describe_error(err)
+        return result
+
+    try:
+        result["status"] = response.status_code
+        result["reason"] = response.reason
+        result["alive"] = (response.status_code < 400)
+        result["etag"] = response.headers.get("ETag")
+        result["last_modified"] = response.headers.get("Last-Modified")
+        try:
+            result["content_length"] = int(
+                response.headers.get("Content-Length"))
+        except (TypeError, ValueError):
+            pass
+    finally:
+        response.close()
+    return result
+
+
+def _describe_error(err):
+    """Return an error's message, or its class name if it has no message.
+
+    On Python 2 str() raises UnicodeEncodeError for non-ASCII messages (and
+    unicode() raises UnicodeDecodeError for non-ASCII byte string ones), so
+    those get the class name too.
+
+    """
+    try:
+        return unicode(err) or type(err).__name__
+    except UnicodeError:
+        return type(err).__name__
+
+
+def _make_session(concurrency):
+    """Return a requests session with a connection pool of the given size."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency,
+                                            pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class _HostLimiter(object):
+
+    """Limits the number of concurrent requests to each host.
+
+    Usage::
+
+        with limiter(host):
+            # Make a request to host.
+
+    This is a private class - other modules shouldn't use it.
+
+    """
+    def __init__(self, per_host):
+        self._per_host = per_host
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def __call__(self, host):
+        if not self._per_host or not host:
+            return _NullContext()
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(
+                    self._per_host)
+            return self._semaphores[host]
+
+
+class _NullContext(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
@@ -0,0 +1,88 @@
+"""This extension's paster commands."""
+import sys
+
+import paste.script.command
+
+import ckan.lib.cli
+
+
+class DeadOrAliveCommand(ckan.lib.cli.CkanCommand):
+    """Check the site's links for broken links
+
+    Usage:
+
+        paster deadoralive check [options] -c <path to CKAN config file>
+
+    Checks all of the resources that are due to be checked, the same ones
+    that would be given to the deadoralive link checker service, and saves
+    the results. Exits when there are no more resources to check.
+
+    """
+    summary = __doc__.split("\n")[0]
+    usage = __doc__
+    max_args = 1
+    min_args = 1
+
+    # Our own copy of CkanCommand's parser, so that our options don't get
+    # added to all of CKAN's commands.
+    parser = paste.script.command.Command.standard_parser(verbose=True)
+    parser.add_option(
+        "-c", "--config", dest="config", default="development.ini",
+        help="the CKAN config file to use (default: development.ini)")
+    parser.add_option(
+        "--batch-size", dest="batch_size", type="int", default=50,
+        help="the maximum number of resources to lease at once (default: 50)")
+    parser.add_option(
+        "--concurrency", dest="concurrency", type="int", default=10,
+        help="the maximum number of links to check at once (default: 10)")
+    parser.add_option(
+        "--per-host", dest="per_host", type="int", default=2,
+        help="the maximum number of links on the same host to check at once, "
+             "0 for no limit (default: 2)")
+    parser.add_option(
+        "--timeout", dest="timeout", type="float", default=30,
+        help="the number of seconds to wait for a server to respond "
+             "(default: 30)")
+    parser.add_option(
+        "--processes", dest="processes", type="int", default=1,
+        help="the number of worker processes to check links in, each with "
+             "its own --concurrency (default: 1)")
+    parser.add_option(
+        "--max-batches", dest="max_batches", type="int", default=None,
+        help="stop after checking this many batches in each process "
+             "(default: no limit)")
+
+    def command(self):
+        cmd = self.args[0]
+        if cmd == "check":
+            self._load_config()
+            self.check()
+        else:
+            print self.usage
+            sys.exit(1)
+
+    def check(self):
+        # This has to be imported after the config has been loaded.
+        import ckanext.deadoralive.checker as checker
+
+        for option in ("batch_size", "concurrency", "processes"):
+            if getattr(self.options, option) < 1:
+                print "--{0} must be at least 1".format(
+                    option.replace("_", "-"))
+                sys.exit(1)
+
+        kwargs = dict(batch_size=self.options.batch_size,
+                      concurrency=self.options.concurrency,
+                      per_host=self.options.per_host,
+                      timeout=self.options.timeout,
+                      max_batches=self.options.max_batches)
+        if self.options.processes > 1:
+            stats = checker.run_processes(self.options.processes, **kwargs)
+        else:
+            stats = checker.run(**kwargs)
+        print "Checked {checked} links ({alive} alive, {dead} dead)".format(
+            **stats)
+        if stats.get("failed_processes"):
+            print "{0} worker processes failed".format(
+                stats["failed_processes"])
+            sys.exit(1)
@@ -17,3 +17,14 @@ resend_pending_resources_after = 2
 broken_resource_min_fails = 3
 broken_resource_min_hours = 36
 authorized_users = []
+report_cache_ttl = 300
+report_cache_size = 100
+report_cache_backend = "memory"
+keep_history = False
+history_retention_days = 30
+max_resources_per_host = 0
+host_cooldown = 0
+adaptive_recheck = False
+adaptive_recheck_min_hours = 6
+adaptive_recheck_max_hours = 720
+deduplicate_urls = False
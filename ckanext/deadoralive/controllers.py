@@ -1,15 +1,49 @@
 import json
 
+import ckan.model
 import ckan.plugins.toolkit as toolkit
 
+import ckanext.deadoralive.export as export
+import ckanext.deadoralive.metrics as metrics
+
+
+# The number of organizations shown on each page of the broken links by
+# organization report.
+ORGANIZATIONS_PER_PAGE = 20
+
 
 class BrokenLinksController(toolkit.BaseController):
 
     def broken_links_by_organization(self):
 
-        report = toolkit.get_action(
-            "ckanext_deadoralive_broken_links_by_organization")(data_dict={})
-        extra_vars = {"organizations": report}
+        try:
+            page = int(toolkit.request.params.get("page", 1))
+        except ValueError:
+            toolkit.abort(400, "page must be an integer")
+        page = max(page, 1)
+
+        # The organization and min_broken filters are passed through to the
+        # action function, and kept in the previous and next page links.
+        filters = dict((key, toolkit.request.params[key])
+                       for key in ("organization", "min_broken")
+                       if toolkit.request.params.get(key))
+
+        # Ask for one more organization than we show, to find out whether
+        # there's a next page.
+        data_dict = dict(filters, limit=ORGANIZATIONS_PER_PAGE + 1,
+                         offset=(page - 1) * ORGANIZATIONS_PER_PAGE)
+        try:
+            report = toolkit.get_action(
+                "ckanext_deadoralive_broken_links_by_organization")(
+                    data_dict=data_dict)
+        except toolkit.ValidationError as err:
+            toolkit.abort(400, str(err.error_dict))
+        extra_vars = {
+            "organizations": report[:ORGANIZATIONS_PER_PAGE],
+            "page": page,
+            "has_next_page": len(report) > ORGANIZATIONS_PER_PAGE,
+            "filters": filters,
+        }
 
         return toolkit.render("broken_links_by_organization.html",
                               extra_vars=extra_vars)
@@ -26,6 +60,41 @@ class BrokenLinksController(toolkit.BaseController):
         return toolkit.render("broken_links_by_email.html",
                               extra_vars=extra_vars)
 
+    def broken_links_csv(self):
+        return self._export(export.iter_csv, "text/csv", "broken_links.csv")
+
+    def broken_links_jsonl(self):
+        return self._export(export.iter_jsonl, "application/x-ndjson",
+                            "broken_links.jsonl")
+
+    def _export(self, format_, content_type, filename):
+        """Return a streaming response of all the site's broken links.
+
+        The export has the same data as the broken links by email report, so
+        it has the same authorization.
+
+        """
+        try:
+            toolkit.check_access("ckanext_deadoralive_broken_links_by_email",
+                                 dict(model=ckan.model, user=toolkit.c.user))
+        except toolkit.NotAuthorized:
+            toolkit.abort(401)
+        toolkit.response.headers["Content-Type"] = (
+            "{0}; charset=utf-8".format(content_type))
+        toolkit.response.headers["Content-Disposition"] = (
+            'attachment; filename="{0}"'.format(filename))
+        return _stream(format_(export.iter_broken_links()))
+
+    def metrics(self):
+        try:
+            toolkit.check_access("ckanext_deadoralive_metrics",
+                                 dict(model=ckan.model, user=toolkit.c.user))
+        except toolkit.NotAuthorized:
+            toolkit.abort(403)
+        toolkit.response.headers["Content-Type"] = (
+            "text/plain; version=0.0.4; charset=utf-8")
+        return metrics.render()
+
     def _call_action(self, action, data_dict=None, key=None):
         context = dict(user=toolkit.c.user)
         if data_dict is None:
@@ -35,6 +104,8 @@ class BrokenLinksController(toolkit.BaseController):
             result = action_function(context, data_dict)
         except toolkit.NotAuthorized:
             toolkit.abort(403)
+        except toolkit.ValidationError as err:
+            toolkit.abort(400, str(err.error_dict))
         toolkit.response.headers['Content-Type'] = 'application/json'
         if key:
             result = result[key]
@@ -55,6 +126,17 @@ class BrokenLinksController(toolkit.BaseController):
 
         return self._call_action("ckanext_deadoralive_upsert", data_dict)
 
+    def upsert_many(self):
+
+        # The results are posted as a JSON array in the request body.
+        try:
+            results = json.loads(toolkit.request.body)
+        except ValueError:
+            toolkit.abort(400, "The request body must be a JSON array")
+
+        return self._call_action("ckanext_deadoralive_upsert_many",
+                                 {"results": results})
+
     def get_resource_id_for_url(self):
 
         # Instead of our own get_url_for_resource_id function we just call
@@ -67,3 +149,18 @@ class BrokenLinksController(toolkit.BaseController):
         del data_dict["resource_id"]
 
         return self._call_action("resource_show", data_dict, key="url")
+
+
+def _stream(lines):
+    """Stream the given lines as the response body.
+
+    The lines are generated after the controller action has returned and CKAN
+    has closed the request's database session, so they're read with a new
+    session which is closed when the response is finished.
+
+    """
+    try:
+        for line in lines:
+            yield line
+    finally:
+        ckan.model.Session.remove()
@@ -0,0 +1,93 @@
+"""Exporting the site's broken links as CSV or JSON lines.
+
+The broken links are streamed from the database (see
+results.get_broken_links()) and each one is formatted and yielded as soon as
+it's read, so exporting uses the same amount of memory however many broken
+links the site has.
+
+"""
+import csv
+import datetime
+import json
+import StringIO
+
+import ckanext.deadoralive.model.results as results
+
+
+# The fields of each exported broken link, in order.
+FIELDS = ("resource_id", "url", "dataset", "organization", "email", "status",
+          "reason", "num_fails", "last_successful")
+
+
+def iter_broken_links():
+    """Iterate over the site's broken links as dicts with the FIELDS keys."""
+    for link in results.get_broken_links(include_results=True):
+        last_successful = link["last_successful"]
+        if isinstance(last_successful, datetime.datetime):
+            last_successful = last_successful.isoformat()
+        yield dict(
+            resource_id=link["resource_id"],
+            url=link["url"],
+            dataset=link["dataset_name"],
+            organization=link["organization_name"],
+            email=(link["dataset_maintainer_email"] or
+                   link["dataset_author_email"]),
+            status=link["status"],
+            reason=link["reason"],
+            num_fails=link["num_fails"],
+            last_successful=last_successful,
+        )
+
+
+def iter_csv(links):
+    """Iterate over the lines of a CSV file of the given broken links.
+
+    The first line is a header row with the FIELDS names. The lines are UTF-8
+    encoded.
+
+    The file is meant to be opened in spreadsheets, so values that a
+    spreadsheet would run as a formula (URLs, reasons and emails come from
+    publishers and remote servers) are prefixed with a ``'`` (see
+    _FORMULA_PREFIXES).
+
+    """
+    buf = StringIO.StringIO()
+    writer = csv.writer(buf)
+
+    def line(values):
+        writer.writerow([_encode(value) for value in values])
+        value = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return value
+
+    yield line(FIELDS)
+    for link in links:
+        yield line(link[field] for field in FIELDS)
+
+
+def iter_jsonl(links):
+    """Iterate over the lines of a JSON lines file of the given broken links.
+
+    Each line is a JSON object with the FIELDS keys.
+
+    """
+    for link in links:
+        yield json.dumps(link, sort_keys=True) + "\n"
+
+
+def _encode(value):
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    elif not isinstance(value, str):
+        return str(value)
+    if value.startswith(_FORMULA_PREFIXES):
+        value = "'" + value
+    return value
+
+
+# The characters that make spreadsheets run a cell's value as a formula when
+# it starts with them.
+_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
@@ -1,6 +1,7 @@
 """Template helper functions provided by this extension."""
 
 import ckan.plugins.toolkit as toolkit
+import ckanext.deadoralive.logic.action.get as get
 
 
 def get_results(resource_id):
@@ -9,3 +10,31 @@ def get_results(resource_id):
     results = toolkit.get_action("ckanext_deadoralive_get")(
         data_dict={"resource_id": resource_id})
     return results
+
+
+def get_results_for_dataset(dataset):
+    """Return the latest link check results for all of a dataset's resources.
+
+    Returns a dict mapping resource IDs to link check result dicts. The results
+    for all of the dataset's resources are fetched with one query, and are
+    memoized for the rest of the request, so templates can call this helper
+    once for each of the dataset's resources. (Datasets with more than
+    get_many's MAX_RESOURCE_IDS resources take one query for each
+    MAX_RESOURCE_IDS resources.)
+
+    """
+    cache = getattr(toolkit.c, "deadoralive_results", None)
+    if not isinstance(cache, dict):
+        cache = toolkit.c.deadoralive_results = {}
+
+    if dataset["id"] not in cache:
+        resource_ids = [resource["id"]
+                        for resource in dataset.get("resources", [])]
+        results = {}
+        for start in range(0, len(resource_ids), get.MAX_RESOURCE_IDS):
+            results.update(toolkit.get_action(
+                "ckanext_deadoralive_get_many")(data_dict={
+                    "resource_ids":
+                        resource_ids[start:start + get.MAX_RESOURCE_IDS]}))
+        cache[dataset["id"]] = results
+    return cache[dataset["id"]]
@@ -5,8 +5,15 @@ import pylons.config
 import ckan.plugins.toolkit as toolkit
 import ckanext.deadoralive.model.results as results
 import ckanext.deadoralive.config as config
+import ckanext.deadoralive.cache as cache
+import ckanext.deadoralive.metrics as metrics
 
 
+# The maximum number of resources that get_many() returns results for at once.
+MAX_RESOURCE_IDS = 1000
+
+
+@metrics.instrument
 def get_resources_to_check(context, data_dict):
     """Return a list of up to ``n`` resource IDs to be checked.
 
@@ -25,10 +32,30 @@ def get_resources_to_check(context, data_dict):
     not be returned by this function again for at least 2 hours (configurable:
     ``ckanext.deadoralive.resend_pending_resources_after``).
 
+    Resources are interleaved by the hosts in their URLs, and can be limited
+    to a number of resources per host in each batch (configurable:
+    ``ckanext.deadoralive.max_resources_per_host``) and to not returning
+    resources from the same host again for some seconds (configurable:
+    ``ckanext.deadoralive.host_cooldown``).
+
     :param n: the maximum number of resources to return at once
     :type n: int
 
-    :rtype: list of strings
+    :param include_urls: return each resource's URL with its ID, so that the
+        link checker doesn't need to get each resource's URL separately (the
+        same URL that resource_show returns) (optional, default: False)
+    :type include_urls: bool
+
+    :param include_validators: return each resource's saved HTTP validators
+        and content hash with its ID, so that the link checker can make
+        conditional requests (optional, default: False)
+    :type include_validators: bool
+
+    :returns: the resource IDs or, if ``include_urls`` or
+        ``include_validators`` is true, dicts with the key ``id`` and the
+        keys ``url`` and/or ``etag``, ``last_modified``, ``content_length``
+        and ``content_hash``
+    :rtype: list of strings or list of dicts
 
     """
     toolkit.check_access("ckanext_deadoralive_get_resources_to_check",
@@ -45,52 +72,36 @@ def get_resources_to_check(context, data_dict):
 
     n = data_dict.get("n", 50)
 
-    return results.get_resources_to_check(n, since=since_delta,
-                                          pending_since=pending_since_delta)
-
-
-def _is_broken(result):
-    """Return True if the given link checker result represents a broken link.
-
-    This implements our configurable "A link is broken if it has been broken
-    for at least N consecutive checks over a period of at least M days" logic
-    for deciding whether a link is broken or not.
-
-    """
-    if not result:
-        return False
-
-    n = config.broken_resource_min_fails
-    m = config.broken_resource_min_hours
-    m_hours_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=m)
-
-    # Innocent until proven guilty.
-    broken = False
+    include_urls = toolkit.asbool(data_dict.get("include_urls", False))
+    include_validators = toolkit.asbool(
+        data_dict.get("include_validators", False))
 
-    # We won't mark a link as "working" if it has never been checked
-    # successfully. It may not pass our test to be marked as broken if it hasn't
-    # been checked n times, but we will leave it unmarked rather than mark it
-    # as working.
-    if not result["last_successful"]:
-        broken = None
+    resources = results.get_resources_to_check(
+        n, since=since_delta, pending_since=pending_since_delta,
+        max_per_host=config.max_resources_per_host,
+        host_cooldown=datetime.timedelta(seconds=config.host_cooldown),
+        include_urls=include_urls)
 
-    # Mark the resource as broken if it has at least n consecutive fails over
-    # a period of at least m hours.
-    if result["num_fails"] >= n:
-        last_successful = result["last_successful"]
-        if last_successful:
-            last_successful = datetime.datetime.strptime(
-                last_successful, "%Y-%m-%dT%H:%M:%S.%f")
-        if last_successful is None or last_successful < m_hours_ago:
-            broken = True
-
-    return broken
+    if not include_validators:
+        return resources
+    if not include_urls:
+        return results.get_validators(resources)
+    validators = results.get_validators(
+        [resource["id"] for resource in resources])
+    for resource, validators_ in zip(resources, validators):
+        resource.update(validators_)
+    return resources
 
 
 @toolkit.side_effect_free
+@metrics.instrument
 def get(context, data_dict):
     """Get the latest link check result data for a resource.
 
+    The result's ``broken`` value is the resource's broken state as worked out
+    when its last link check result was saved (or when the broken link
+    settings last changed), it isn't recomputed here.
+
     :param resource_id: the resource to return the result data for
     :type resource_id: string
 
@@ -110,90 +121,159 @@ def get(context, data_dict):
     except results.NoResultForResourceError:
         return None
 
-    result["broken"] = _is_broken(result)
-
     return result
 
 
-def _broken_links_by_organization(context, organization_list, all_results,
-                                  package_search):
+@toolkit.side_effect_free
+@metrics.instrument
+def get_many(context, data_dict):
+    """Get the latest link check result data for many resources at once.
+
+    All the results are fetched with a single database query.
 
-    # Get a list of the names of all the site's organizations.
-    organizations = organization_list(context=context,
-                                      data_dict={'all_fields': True})
+    :param resource_ids: the resources to return the result data for, no
+        more than MAX_RESOURCE_IDS of them
+    :type resource_ids: list of strings (or a comma-separated string)
 
-    # Get a dict mapping resource IDs to link checker results.
-    result_dicts = {}
-    for result in all_results():
-        assert result["resource_id"] not in result_dicts
-        result_dicts[result["resource_id"]] = result
+    :returns: a dict mapping resource IDs to their latest link check data,
+      resources that have no results are not included
+    :rtype: dict
 
-    # Build the datasets with broken links by organization report.
+    """
+    toolkit.check_access("ckanext_deadoralive_get_many", context, data_dict)
+
+    resource_ids = data_dict.get("resource_ids", [])
+    if isinstance(resource_ids, basestring):
+        resource_ids = toolkit.aslist(resource_ids, ",")
+    if not (isinstance(resource_ids, list) and
+            all(isinstance(resource_id, basestring)
+                for resource_id in resource_ids)):
+        raise toolkit.ValidationError(
+            {"resource_ids": ["resource_ids must be a list of strings"]})
+    if len(resource_ids) > MAX_RESOURCE_IDS:
+        raise toolkit.ValidationError(
+            {"resource_ids": ["No more than {0} resource_ids are allowed"
+                              .format(MAX_RESOURCE_IDS)]})
+
+    return results.get_many(resource_ids)
+
+
+def _image_display_url(image_url):
+    """Return the URL to display an organization's image from.
+
+    The same as CKAN core's organization dictization does: uploaded images
+    are stored as a filename that needs to be turned into a URL.
+
+    """
+    if image_url and not image_url.startswith("http"):
+        return toolkit.h.url_for_static(
+            "uploads/group/{0}".format(image_url), qualified=True)
+    return image_url
+
+
+def _broken_links_by_organization(broken_links, count_datasets):
+    """Group a list of broken links into the by-organization report.
+
+    :param broken_links: the site's broken links, as returned by
+        results.get_broken_links(organizations_only=True)
+    :param count_datasets: a function like results.count_datasets()
+
+    """
     report = []
-    for organization in organizations:
-
-        organization_report_item = {
-            "name": organization["name"],
-            "display_name": (organization.get("title")
-                             or organization.get("name")),
-            "image_display_url": organization["image_display_url"],
-            "description": organization["description"],
-            "packages": organization["packages"],
-            "datasets_with_broken_links": []}
-        num_broken_links = 0
-
-        # Get a list of all the organization's datasets
-        # (these are full dataset dicts, including a list of resource dicts
-        # for each dataset).
-        datasets = package_search(
-            data_dict={"fq": "organization:{name}".format(
-                name=organization["name"])})
-
-        # Build the report dict for each of the organization's datasets.
-        for dataset in datasets:
-            resource_ids = [resource["id"] for resource in dataset["resources"]]
-            broken_resource_ids = [resource_id for resource_id in resource_ids
-                                   if _is_broken(result_dicts.get(resource_id))]
-            num_broken_links += len(broken_resource_ids)
-            if broken_resource_ids:  # Only report datasets with broken links.
-                dataset_report_item = {
-                    "name": dataset["name"],
-                    "display_name": dataset.get("title") or dataset.get("name"),
-                    "num_broken_links": len(broken_resource_ids),
-                    "resources_with_broken_links": broken_resource_ids,
-                    }
-                organization_report_item["datasets_with_broken_links"].append(
-                    dataset_report_item)
-
-        if num_broken_links:
-            organization_report_item["num_broken_links"] = num_broken_links
-            organization_report_item["datasets_with_broken_links"].sort(
-                key=lambda x: x["num_broken_links"], reverse=True)
-            report.append(organization_report_item)
+    organizations = {}
+    datasets = {}
+    for link in broken_links:
+
+        organization = organizations.get(link["organization_id"])
+        if organization is None:
+            organization = organizations[link["organization_id"]] = {
+                "name": link["organization_name"],
+                "display_name": (link["organization_title"]
+                                 or link["organization_name"]),
+                "image_display_url": _image_display_url(
+                    link["organization_image_url"]),
+                "description": link["organization_description"],
+                "num_broken_links": 0,
+                "datasets_with_broken_links": []}
+            report.append(organization)
+
+        dataset = datasets.get(link["dataset_id"])
+        if dataset is None:
+            dataset = datasets[link["dataset_id"]] = {
+                "name": link["dataset_name"],
+                "display_name": (link["dataset_title"]
+                                 or link["dataset_name"]),
+                "num_broken_links": 0,
+                "resources_with_broken_links": []}
+            organization["datasets_with_broken_links"].append(dataset)
+
+        dataset["resources_with_broken_links"].append(link["resource_id"])
+        dataset["num_broken_links"] += 1
+        organization["num_broken_links"] += 1
+
+    num_datasets = count_datasets(organizations.keys())
+    for organization_id, organization in organizations.items():
+        organization["packages"] = num_datasets.get(organization_id, 0)
+        organization["datasets_with_broken_links"].sort(
+            key=lambda x: x["num_broken_links"], reverse=True)
 
     report.sort(key=lambda x: x["num_broken_links"], reverse=True)
 
     return report
 
 
-def _package_search(context=None, data_dict=None):
-    """A simple wrapper for CKAN's package_search API action.
+def _int_param(data_dict, key, default, min_value=0):
+    """Return an integer param from a data_dict, or the default if missing.
 
-    Returns just the "results" part of the response, and not the rest.
+    :raises: toolkit.ValidationError if the param isn't an integer of at least
+        min_value
 
     """
-    return toolkit.get_action("package_search")(context=context,
-                                                data_dict=data_dict)["results"]
+    value = data_dict.get(key)
+    if value is None or value == "":
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError(
+            {key: ["{0} must be an integer".format(key)]})
+    if value < min_value:
+        raise toolkit.ValidationError(
+            {key: ["{0} must be at least {1}".format(key, min_value)]})
+    return value
 
 
 @toolkit.side_effect_free
+@metrics.instrument
 def broken_links_by_organization(context, data_dict):
     """Return a datasets with broken links grouped by organization report.
 
-    Returns a list of all the resources with broken links on the site, grouped
+    Returns a list of the resources with broken links on the site, grouped
     by dataset, with the datasets grouped by organization, and sorted with
     organizations and datasets with the most broken resources first.
 
+    By default all of the site's organizations that have broken links are
+    returned, the params can be used to page through the organizations or to
+    get the report for just one organization.
+
+    The report is cached, see the cache module.
+
+    :param organization: only return the report for this organization
+        (optional)
+    :type organization: string, the organization's id or name
+
+    :param min_broken: only return organizations with at least this many
+        broken links (optional, default: 1)
+    :type min_broken: int
+
+    :param limit: the maximum number of organizations to return (optional,
+        default: no limit)
+    :type limit: int
+
+    :param offset: the number of organizations to skip before the first one
+        returned (optional, default: 0)
+    :type offset: int
+
     Sample output::
 
         [
@@ -216,16 +296,74 @@ def broken_links_by_organization(context, data_dict):
     toolkit.check_access("ckanext_deadoralive_broken_links_by_organization",
                          context, data_dict)
 
-    organization_list = toolkit.get_action("organization_list")
-    return _broken_links_by_organization(
-        context, organization_list, results.all, _package_search)
+    params = dict(
+        organization=data_dict.get("organization") or None,
+        min_broken=_int_param(data_dict, "min_broken", 1, min_value=1),
+        limit=_int_param(data_dict, "limit", None),
+        offset=_int_param(data_dict, "offset", 0),
+    )
+
+    def create():
+        if params == dict(organization=None, min_broken=1, limit=None,
+                          offset=0):
+            # The whole site's report, no need to count the organizations
+            # first.
+            broken_links = results.get_broken_links(organizations_only=True)
+        else:
+            organizations = results.count_broken_links_by_organization(
+                **params)
+            broken_links = results.get_broken_links(
+                organization_ids=[organization_id for organization_id, _
+                                  in organizations])
+        return _broken_links_by_organization(broken_links,
+                                             results.count_datasets)
+
+    return cache.get_or_create(
+        "ckanext_deadoralive_broken_links_by_organization", params, create)
+
+
+def _get_email_for_dataset(link):
+    return (link.get('dataset_maintainer_email')
+            or link.get('dataset_author_email'))
+
+
+def _group_broken_links_by_email(broken_links):
+    """Group a stream of broken links into the by-email report.
 
+    Only datasets that have broken links are ever held in memory, and the
+    email groups are built up incrementally as the broken links stream past.
 
-def _get_email_for_dataset(dataset):
-    return dataset.get('maintainer_email') or dataset.get('author_email')
+    :param broken_links: the site's broken links, as returned by
+        results.get_broken_links()
+
+    :returns: the report items, not sorted and without mailto URLs
+    :rtype: list of dicts
+
+    """
+    emails = {}
+    datasets = {}
+    for link in broken_links:
+        dataset = datasets.get(link["dataset_id"])
+        if dataset is None:
+            dataset = datasets[link["dataset_id"]] = dict(
+                name=link["dataset_name"], title=link["dataset_title"],
+                num_broken_links=0, resources_with_broken_links=[],
+                email=_get_email_for_dataset(link))
+            item = emails.get(dataset["email"])
+            if item is None:
+                item = emails[dataset["email"]] = {
+                    "email": dataset["email"],
+                    "num_broken_links": 0,
+                    "datasets_with_broken_links": []}
+            item["datasets_with_broken_links"].append(dataset)
+        dataset["resources_with_broken_links"].append(link["resource_id"])
+        dataset["num_broken_links"] += 1
+        emails[dataset["email"]]["num_broken_links"] += 1
+    return list(emails.values())
 
 
 @toolkit.side_effect_free
+@metrics.instrument
 def broken_links_by_email(context, data_dict):
     """Return a report of datasets with broken links grouped by email.
 
@@ -233,6 +371,8 @@ def broken_links_by_email(context, data_dict):
     together, intended to make it convenient for sysadmins to email the people
     responsible for datasets about broken links.
 
+    The report is cached, see the cache module.
+
     Sample output::
 
         [
@@ -256,53 +396,20 @@ def broken_links_by_email(context, data_dict):
     toolkit.check_access("ckanext_deadoralive_broken_links_by_email",
                          context, data_dict)
 
-    # Get a dict mapping resource IDs to link checker results.
-    result_dicts = {}
-    for result in results.all():
-        assert result["resource_id"] not in result_dicts
-        result_dicts[result["resource_id"]] = result
-
-    # Get a list of all the broken datasets on the site, each with a sub-list of
-    # all its broken resources.
-    broken_datasets = []
-    for dataset in _package_search(data_dict={'rows': 1000000}):
-        broken_resources = []
-        for resource in dataset.get('resources'):
-            if _is_broken(result_dicts.get(resource["id"])):
-                broken_resources.append(resource["id"])
-        if broken_resources:
-            broken_datasets.append(dict(
-                name=dataset["name"], title=dataset["title"],
-                num_broken_links=len(broken_resources),
-                resources_with_broken_links=broken_resources,
-                email=_get_email_for_dataset(dataset)))
-
-    # Group the broken datasets by email.
-    # We do this as a dict at first because it's easier.
-    emails = {}
-    for dataset in broken_datasets:
-        email = dataset["email"]
-        if email not in emails:
-            emails[email] = {"datasets_with_broken_links": [dataset]}
-        else:
-            emails[email]["datasets_with_broken_links"].append(dataset)
-
-    # Add num. broken links per email, and sort the list of broken datasets for
-    # each email.
-    for email in emails:
-        num_broken_links = 0
-        for dataset in emails[email]["datasets_with_broken_links"]:
-            num_broken_links += dataset["num_broken_links"]
-        emails[email]["num_broken_links"] = num_broken_links
-        # Sort the datasets with most broken links first.
-        emails[email]["datasets_with_broken_links"].sort(
+    return cache.get_or_create("ckanext_deadoralive_broken_links_by_email",
+                               data_dict, _broken_links_by_email)
+
+
+def _broken_links_by_email():
+    """Return the broken links by email report, without caching."""
+    broken_links = results.get_broken_links()
+    report = _group_broken_links_by_email(broken_links)
+
+    # Sort the datasets for each email with the most broken links first.
+    for item in report:
+        item["datasets_with_broken_links"].sort(
             key=lambda x: x["num_broken_links"], reverse=True)
 
-    # Turn out dict mapping emails -> broken datasets into a list.
-    report = []
-    for email, dict_ in emails.items():
-        dict_["email"] = email
-        report.append(dict_)
     # Sort the emails with the most broken links first.
     report.sort(key=lambda x: x["num_broken_links"], reverse=True)
 
@@ -336,3 +443,53 @@ def broken_links_by_email(context, data_dict):
             email=item["email"], subject=subject, body=body)
 
     return report
+
+
+@toolkit.side_effect_free
+@metrics.instrument
+def stats(context, data_dict):
+    """Return counts of the site's link checker results and check queue.
+
+    This is cheap enough to poll often, for example from a monitoring system.
+
+    Sample output::
+
+        {
+          "checked": 9500,
+          "unchecked": 500,
+          "pending": 50,
+          "alive": 9000,
+          "dead": 500,
+          "broken": 300,
+          "requested": 2,
+          "queue_depth": 1200,
+          "oldest_last_checked": "2015-03-01T12:00:00.000000",
+          "lag_seconds": 3600
+        }
+
+    ``unchecked`` is the number of resources that have never been checked,
+    including the ones whose first checks are pending or requested.
+    ``queue_depth`` is the number of resources that are due to be checked now
+    (including the ones that have never been checked) and ``lag_seconds`` is
+    how long the resource that has been due for the longest has been waiting
+    (or null if none are due).
+
+    """
+    toolkit.check_access("ckanext_deadoralive_stats", context, data_dict)
+
+    stats_ = results.get_stats(
+        since=datetime.timedelta(hours=config.recheck_resources_after),
+        pending_since=datetime.timedelta(
+            hours=config.resend_pending_resources_after))
+
+    oldest_last_checked = stats_.pop("oldest_last_checked")
+    if oldest_last_checked:
+        oldest_last_checked = oldest_last_checked.isoformat()
+    stats_["oldest_last_checked"] = oldest_last_checked
+
+    lag = stats_.pop("lag")
+    if lag is not None:
+        lag = int(lag.total_seconds())
+    stats_["lag_seconds"] = lag
+
+    return stats_
@@ -1,7 +1,9 @@
 import ckan.plugins.toolkit as toolkit
 import ckanext.deadoralive.model.results as results
+import ckanext.deadoralive.metrics as metrics
 
 
+@metrics.instrument
 def upsert(context, data_dict, last_checked=None):
     """Save a link check result for a resource.
 
@@ -19,6 +21,19 @@ def upsert(context, data_dict, last_checked=None):
         e.g. "OK", "Not Found", "Internal Server Error"
     :type reason: string
 
+    :param etag: the response's ETag header (optional)
+    :type etag: string
+
+    :param last_modified: the response's Last-Modified header (optional)
+    :type last_modified: string
+
+    :param content_length: the size of the resource's file in bytes
+        (optional)
+    :type content_length: int
+
+    :param content_hash: a hash of the resource's file (optional)
+    :type content_hash: string
+
     """
     toolkit.check_access("ckanext_deadoralive_upsert", context, data_dict)
 
@@ -30,4 +45,84 @@ def upsert(context, data_dict, last_checked=None):
     reason = data_dict.get("reason")
 
     results.upsert(resource_id, alive, status=status, reason=reason,
-                   last_checked=last_checked)
+                   last_checked=last_checked,
+                   **_get_validators(data_dict))
+
+
+def _get_validators(data_dict):
+    """Return the optional HTTP validator and content hash params.
+
+    :raises: toolkit.ValidationError if content_length isn't an integer
+
+    """
+    content_length = data_dict.get("content_length")
+    if content_length is not None and content_length != "":
+        try:
+            content_length = int(content_length)
+        except (TypeError, ValueError):
+            raise toolkit.ValidationError(
+                {"content_length": ["content_length must be an integer"]})
+    else:
+        content_length = None
+    return dict(etag=data_dict.get("etag") or None,
+                last_modified=data_dict.get("last_modified") or None,
+                content_length=content_length,
+                content_hash=data_dict.get("content_hash") or None)
+
+
+@metrics.instrument
+def upsert_many(context, data_dict):
+    """Save the link check results for many resources at once.
+
+    All of the results are saved in a single database transaction, so this is
+    much cheaper than calling ``ckanext_deadoralive_upsert`` once per result.
+
+    :param results: the link check results to save, each a dict with the same
+        params as ``ckanext_deadoralive_upsert``: ``resource_id`` and ``alive``
+        (required) and ``status``, ``reason``, ``etag``, ``last_modified``,
+        ``content_length`` and ``content_hash`` (optional)
+    :type results: list of dicts
+
+    """
+    toolkit.check_access("ckanext_deadoralive_upsert_many", context,
+                         data_dict)
+
+    results_ = data_dict.get("results")
+    if not isinstance(results_, list):
+        raise toolkit.ValidationError(
+            {"results": ["results must be a list of link check results"]})
+    for result in results_:
+        if not isinstance(result, dict) or "resource_id" not in result or (
+                result.get("alive") not in (True, False)):
+            raise toolkit.ValidationError(
+                {"results": ["Each result must have a resource_id and an "
+                             "alive value of true or false"]})
+
+    results.upsert_many([
+        dict(_get_validators(result), resource_id=result["resource_id"],
+             alive=result["alive"], status=result.get("status"),
+             reason=result.get("reason"))
+        for result in results_])
+
+
+@metrics.instrument
+def request_check(context, data_dict):
+    """Ask for a resource's link to be checked as soon as possible.
+
+    The resource will be given to the next link checker that asks for
+    resources to check, ahead of any resources that are waiting for their
+    regular checks.
+
+    :param resource_id: the id of the resource to check
+    :type resource_id: string
+
+    """
+    toolkit.check_access("ckanext_deadoralive_request_check", context,
+                         data_dict)
+
+    resource_id = data_dict.get("resource_id")
+    if not resource_id:
+        raise toolkit.ValidationError(
+            {"resource_id": ["Missing value"]})
+
+    results.request_check([resource_id])
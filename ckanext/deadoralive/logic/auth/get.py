@@ -14,6 +14,12 @@ def get(context, data_dict):
     return dict(success=True)
 
 
+@toolkit.auth_allow_anonymous_access
+def get_many(context, data_dict):
+    """Anyone can get the broken link reports for many resources."""
+    return dict(success=True)
+
+
 @toolkit.auth_allow_anonymous_access
 def broken_links_by_organization(context, data_dict):
     """Anyone can see the broken_links_by_organization report."""
@@ -23,3 +29,13 @@ def broken_links_by_organization(context, data_dict):
 def broken_links_by_email(context, data_dict):
     """Only sysadmins can see the broken_links_by_email report."""
     return dict(success=False)
+
+
+def metrics(context, data_dict):
+    """Only sysadmins and the configured users can see the metrics page."""
+    return dict(success=context.get("user") in config.authorized_users)
+
+
+def stats(context, data_dict):
+    """Only sysadmins and the configured users can get the stats."""
+    return dict(success=context.get("user") in config.authorized_users)
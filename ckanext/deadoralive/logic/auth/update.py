@@ -1,3 +1,4 @@
+import ckan.plugins.toolkit as toolkit
 import ckanext.deadoralive.config as config
 
 
@@ -5,3 +6,25 @@ def upsert(context, data_dict):
     """Only the configured user accounts are allowed to upsert link results."""
 
     return dict(success=context.get("user") in config.authorized_users)
+
+
+def upsert_many(context, data_dict):
+    """Only the configured user accounts are allowed to upsert link results."""
+
+    return upsert(context, data_dict)
+
+
+def request_check(context, data_dict):
+    """Users who can edit a resource can request a link check for it.
+
+    The configured user accounts can request link checks for any resource.
+
+    """
+    if context.get("user") in config.authorized_users:
+        return dict(success=True)
+    try:
+        toolkit.check_access("resource_update", context,
+                             {"id": data_dict.get("resource_id")})
+    except toolkit.NotAuthorized:
+        return dict(success=False)
+    return dict(success=True)
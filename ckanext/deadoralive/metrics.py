@@ -0,0 +1,253 @@
+"""Timing and SQL query count instrumentation for this extension.
+
+Decorating a function with @instrument records, for each call: how long it
+took (in a histogram), the number of SQL statements that were executed
+during the call, the number of rows (or other items) that it returned and
+whether it raised an exception. The metrics are kept in memory in each CKAN
+process and render() returns them in the Prometheus text exposition format,
+for the /deadoralive/metrics page.
+
+The time and SQL statements of a call include those of any other
+instrumented functions that it calls, for example an action function's
+numbers include those of the model functions that it calls.
+
+Calls to generator functions are recorded when the generator is exhausted
+or closed. Their time and SQL statements are only counted while the
+generator is running, not while its caller is using the items it yielded,
+and their rows are the number of items yielded.
+
+"""
+import bisect
+import functools
+import inspect
+import threading
+import time
+
+import sqlalchemy.event
+
+import ckan.model
+
+
+# The upper bounds of the call duration histogram's buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def instrument(func):
+    """Decorate a function to record metrics about its calls.
+
+    The function is identified in the metrics by its module path relative to
+    this extension and its name, for example ``model.results.upsert``.
+
+    """
+    name = "{0}.{1}".format(
+        func.__module__.replace("ckanext.deadoralive.", "", 1),
+        func.__name__)
+
+    if inspect.isgeneratorfunction(func):
+        return _instrument_generator(func, name)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _listen_for_queries()
+        statements_before = _get_statement_count()
+        start = time.time()
+        failed = True
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            _registry.record(name, time.time() - start,
+                             _get_statement_count() - statements_before,
+                             _count_rows(result), failed)
+    return wrapper
+
+
+def _instrument_generator(func, name):
+    """Decorate a generator function to record metrics about its calls."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _listen_for_queries()
+        generator = func(*args, **kwargs)
+        seconds = 0.0
+        statements = 0
+        rows = 0
+        failed = True
+        try:
+            while True:
+                statements_before = _get_statement_count()
+                start = time.time()
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.time() - start
+                    statements += _get_statement_count() - statements_before
+                rows += 1
+                yield item
+            failed = False
+        except GeneratorExit:
+            # The caller closed the generator before it was exhausted.
+            failed = False
+            raise
+        finally:
+            start = time.time()
+            generator.close()
+            seconds += time.time() - start
+            _registry.record(name, seconds, statements, rows, failed)
+    return wrapper
+
+
+def render():
+    """Return all of the recorded metrics in Prometheus text format.
+
+    :rtype: string
+
+    """
+    return _registry.render()
+
+
+def clear():
+    """Forget all of the recorded metrics."""
+    _registry.clear()
+
+
+def _count_rows(result):
+    """Return the number of rows or items in an instrumented function's
+    return value, or 0 if it isn't a collection."""
+    if isinstance(result, (list, tuple, dict, set)):
+        return len(result)
+    return 0
+
+
+# The number of SQL statements executed by each thread so far.
+_statement_counts = threading.local()
+
+
+def _get_statement_count():
+    return getattr(_statement_counts, "count", 0)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    _statement_counts.count = _get_statement_count() + 1
+
+
+_listening_to = set()
+_listen_lock = threading.Lock()
+
+
+def _listen_for_queries():
+    """Start counting the SQL statements sent to CKAN's database engine.
+
+    This is done lazily because CKAN's engine doesn't exist yet when this
+    module is imported.
+
+    """
+    engine = ckan.model.meta.metadata.bind
+    if engine is None or id(engine) in _listening_to:
+        return
+    with _listen_lock:
+        if id(engine) not in _listening_to:
+            sqlalchemy.event.listen(engine, "before_cursor_execute",
+                                    _before_cursor_execute)
+            _listening_to.add(id(engine))
+
+
+class _Metrics(object):
+
+    """The metrics recorded for one instrumented function.
+
+    This is a private class - other modules shouldn't use it.
+
+    """
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.sql_statements = 0
+        self.rows = 0
+        self.errors = 0
+
+    def record(self, seconds, sql_statements, rows, failed):
+        index = bisect.bisect_left(BUCKETS, seconds)
+        if index < len(BUCKETS):
+            self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        self.sql_statements += sql_statements
+        self.rows += rows
+        if failed:
+            self.errors += 1
+
+
+class _Registry(object):
+
+    """All of the metrics recorded in this process.
+
+    This is a private class - other modules shouldn't use it.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def record(self, name, seconds, sql_statements, rows, failed):
+        with self._lock:
+            metrics = self._metrics.get(name)
+            if metrics is None:
+                metrics = self._metrics[name] = _Metrics()
+            metrics.record(seconds, sql_statements, rows, failed)
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._metrics.items())
+            lines = [
+                "# HELP deadoralive_call_duration_seconds The time taken by "
+                "each call to a ckanext-deadoralive function.",
+                "# TYPE deadoralive_call_duration_seconds histogram",
+            ]
+            for name, metrics in items:
+                cumulative = 0
+                for bound, count in zip(BUCKETS, metrics.bucket_counts):
+                    cumulative += count
+                    lines.append(
+                        'deadoralive_call_duration_seconds_bucket'
+                        '{{function="{0}",le="{1}"}} {2}'.format(
+                            name, bound, cumulative))
+                lines.append(
+                    'deadoralive_call_duration_seconds_bucket'
+                    '{{function="{0}",le="+Inf"}} {1}'.format(
+                        name, metrics.count))
+                lines.append(
+                    'deadoralive_call_duration_seconds_sum'
+                    '{{function="{0}"}} {1!r}'.format(name, metrics.sum))
+                lines.append(
+                    'deadoralive_call_duration_seconds_count'
+                    '{{function="{0}"}} {1}'.format(name, metrics.count))
+            for metric, attr, help_ in (
+                    ("deadoralive_sql_statements_total", "sql_statements",
+                     "The number of SQL statements executed by calls to "
+                     "each ckanext-deadoralive function."),
+                    ("deadoralive_rows_returned_total", "rows",
+                     "The number of rows or items returned by calls to "
+                     "each ckanext-deadoralive function."),
+                    ("deadoralive_errors_total", "errors",
+                     "The number of calls to each ckanext-deadoralive "
+                     "function that raised an exception.")):
+                lines.append("# HELP {0} {1}".format(metric, help_))
+                lines.append("# TYPE {0} counter".format(metric))
+                for name, metrics in items:
+                    lines.append('{0}{{function="{1}"}} {2}'.format(
+                        metric, name, getattr(metrics, attr)))
+        return "\n".join(lines) + "\n"
+
+
+_registry = _Registry()
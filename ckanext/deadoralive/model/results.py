@@ -9,29 +9,279 @@ results. Other modules should use these and should not access the results
 database table or ORM objects directly.
 
 """
+import collections
 import datetime
+import hashlib
+import threading
+import urlparse
 
+import pylons.config
 import sqlalchemy
+import sqlalchemy.engine.reflection
+import sqlalchemy.exc
 import sqlalchemy.types as types
 import sqlalchemy.orm.exc
 
+import ckan.lib.munge
 import ckan.model
 import ckan.model.meta
 
+import ckanext.deadoralive.config as config
+import ckanext.deadoralive.metrics as metrics
+
 
 def create_database_table():
     """Create the link_checker_results database table.
 
-    If it doesn't already exist.
+    If it doesn't already exist. If it does already exist, migrate it to the
+    current version of the schema (e.g. add any missing indexes).
 
     This function should be called at CKAN startup time.
 
     """
     if not _link_checker_results_table.exists():
         _link_checker_results_table.create()
+    _migrate()
+
+
+def _migrate():
+    """Run any of the _MIGRATIONS that haven't been run on this database yet.
+
+    The number of migrations that have already been run is recorded in the
+    link_checker_schema_version table. The migrations all run in a single
+    transaction, and on PostgreSQL they're serialized with an advisory lock so
+    that CKAN processes starting up at the same time don't race each other.
+
+    Each migration also checks whether its change has already been made, so
+    it's harmless to run a migration against a table that was created with
+    the current schema already.
+
+    """
+    bind = ckan.model.meta.metadata.bind
+    with bind.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execute(
+                sqlalchemy.text("SELECT pg_advisory_xact_lock(:key)"),
+                key=_MIGRATE_LOCK_KEY)
+
+        if not _schema_version_table.exists(bind=connection):
+            _schema_version_table.create(bind=connection)
+
+        version = connection.execute(
+            sqlalchemy.select([_schema_version_table.c.version])).scalar()
+        if version is None:
+            version = 0
+            connection.execute(_schema_version_table.insert(), version=0)
+
+        for number, migration in enumerate(_MIGRATIONS[version:], version + 1):
+            migration(connection)
+            connection.execute(
+                _schema_version_table.update().values(version=number))
+
+
+def _create_index(connection, index):
+    """Create the given index, unless the database already has it."""
+    inspector = sqlalchemy.engine.reflection.Inspector.from_engine(connection)
+    existing = [index_["name"]
+                for index_ in inspector.get_indexes(index.table.name)]
+    if index.name not in existing:
+        index.create(bind=connection)
+
+
+def _add_column(connection, column):
+    """Add the given column to its table, unless the table already has it.
+
+    """
+    inspector = sqlalchemy.engine.reflection.Inspector.from_engine(connection)
+    existing = [column_["name"]
+                for column_ in inspector.get_columns(column.table.name)]
+    if column.name not in existing:
+        connection.execute("ALTER TABLE {table} ADD COLUMN {column} {type}"
+                           .format(table=column.table.name,
+                                   column=column.name,
+                                   type=column.type.compile(
+                                       dialect=connection.dialect)))
+
+
+def _migration_1_add_indexes(connection):
+    """Add indexes for get_resources_to_check() and the broken link reports.
+
+    """
+    for index in (_pending_last_checked_index, _pending_since_index,
+                  _failing_index):
+        _create_index(connection, index)
+
+
+def _migration_2_add_broken_links_summary(connection):
+    """Add the broken column and fill it in for the existing results.
+
+    (This migration used to add the broken datasets summary table too, see
+    _migration_10_drop_broken_datasets_summary().)
+
+    """
+    _add_column(connection, _link_checker_results_table.c.broken)
+    _create_index(connection, _broken_index)
+    _rebuild_broken_states(connection)
+
+
+def _migration_3_add_generation(connection):
+    """Add the results generation counter table, with its single row."""
+    if not _generation_table.exists(bind=connection):
+        _generation_table.create(bind=connection)
+    _seed_generation(connection)
+
+
+def _seed_generation(connection):
+    """Make sure that the generation table has exactly one row.
+
+    Any extra rows (left by concurrent first calls to _bump_generation()
+    before the row was seeded by migration 3) are merged into one, keeping
+    the highest generation.
+
+    """
+    table = _generation_table
+    rows = connection.execute(
+        sqlalchemy.select([sqlalchemy.func.count(),
+                           sqlalchemy.func.max(table.c.generation)])).first()
+    if rows[0] != 1:
+        connection.execute(table.delete())
+        connection.execute(table.insert(), generation=rows[1] or 0)
+
+
+def _migration_4_add_history(connection):
+    """Add the link check history and reasons tables."""
+    for table in (_reasons_table, _history_table):
+        if not table.exists(bind=connection):
+            table.create(bind=connection)
+
+
+def _migration_5_add_hosts(connection):
+    """Add the results table's host column and the hosts table."""
+    _add_column(connection, _link_checker_results_table.c.host)
+    if not _hosts_table.exists(bind=connection):
+        _hosts_table.create(bind=connection)
+
+
+def _migration_6_add_next_check_at(connection):
+    """Add the results table's next_check_at column and its index."""
+    _add_column(connection, _link_checker_results_table.c.next_check_at)
+    _create_index(connection, _pending_next_check_at_index)
+
+
+def _migration_7_add_priority(connection):
+    """Add the results table's priority column and its index."""
+    _add_column(connection, _link_checker_results_table.c.priority)
+    _create_index(connection, _requested_index)
 
 
-def upsert(resource_id, alive, status=None, reason=None, last_checked=None):
+def _migration_8_add_validators(connection):
+    """Add the results table's HTTP validator and content hash columns."""
+    for column in _VALIDATORS:
+        _add_column(connection, _link_checker_results_table.c[column])
+
+
+def _migration_9_add_url_hash(connection):
+    """Add the results table's url_hash column and its index."""
+    _add_column(connection, _link_checker_results_table.c.url_hash)
+    _create_index(connection, _url_hash_index)
+
+
+def _migration_10_drop_broken_datasets_summary(connection):
+    """Drop the broken datasets summary table.
+
+    Nothing read it, and keeping it up to date slowed down upsert().
+
+    """
+    if connection.dialect.has_table(connection,
+                                    "link_checker_broken_datasets"):
+        connection.execute("DROP TABLE link_checker_broken_datasets")
+
+
+def _migration_11_seed_generation(connection):
+    """Seed the generation table's single row, for databases that ran
+    migration 3 before it did that."""
+    _seed_generation(connection)
+
+
+def _migration_12_fill_in_hosts(connection):
+    """Fill in the hosts of results that were saved without one.
+
+    request_check() didn't use to save hosts, and get_resources_to_check()
+    now uses the saved hosts to apply its per-host limits in SQL. The
+    results are read in chunks, in resource_id order.
+
+    On a new database (e.g. during ``paster db init``) CKAN's resource table
+    may not exist yet, but then there are no hosts to fill in either.
+
+    """
+    table = _link_checker_results_table
+    resource = ckan.model.resource_table
+    if not resource.exists(bind=connection):
+        return
+    from_, package_id = _outerjoin_package_ids(
+        table.join(resource, resource.c.id == table.c.resource_id))
+    last_resource_id = u""
+    while True:
+        q = sqlalchemy.select(
+            [table.c.resource_id, resource.c.url, resource.c.url_type,
+             package_id.label("package_id")],
+            sqlalchemy.and_(table.c.host == None,
+                            table.c.resource_id > last_resource_id),
+            from_obj=from_)
+        q = q.order_by(table.c.resource_id).limit(_FILL_IN_HOSTS_CHUNK_SIZE)
+        rows = connection.execute(q).fetchall()
+        if not rows:
+            break
+        last_resource_id = rows[-1].resource_id
+        hosts = [dict(b_resource_id=row.resource_id,
+                      host=get_host(_get_resource_url(row)))
+                 for row in rows]
+        hosts = [params for params in hosts if params["host"]]
+        if hosts:
+            connection.execute(
+                table.update().where(
+                    table.c.resource_id ==
+                    sqlalchemy.bindparam("b_resource_id")),
+                hosts)
+
+
+_FILL_IN_HOSTS_CHUNK_SIZE = 10000
+
+
+def _migration_13_add_broken_settings(connection):
+    """Add the table of the settings that the broken states were computed
+    with."""
+    if not _broken_settings_table.exists(bind=connection):
+        _broken_settings_table.create(bind=connection)
+
+
+# The list of schema migrations, in the order that they must be run in.
+# Migrations must never be removed or reordered: new ones go on the end.
+_MIGRATIONS = [
+    _migration_1_add_indexes,
+    _migration_2_add_broken_links_summary,
+    _migration_3_add_generation,
+    _migration_4_add_history,
+    _migration_5_add_hosts,
+    _migration_6_add_next_check_at,
+    _migration_7_add_priority,
+    _migration_8_add_validators,
+    _migration_9_add_url_hash,
+    _migration_10_drop_broken_datasets_summary,
+    _migration_11_seed_generation,
+    _migration_12_fill_in_hosts,
+    _migration_13_add_broken_settings,
+]
+
+# An arbitrary application-defined key for PostgreSQL's advisory lock
+# functions, used to serialize schema migrations between processes.
+_MIGRATE_LOCK_KEY = 1685021301
+
+
+@metrics.instrument
+def upsert(resource_id, alive, status=None, reason=None, last_checked=None,
+           etag=None, last_modified=None, content_length=None,
+           content_hash=None):
     """Insert a new result or update the existing result for a resource.
 
     The ``last_checked`` param is for testing and shouldn't need to be used in
@@ -51,27 +301,506 @@ def upsert(resource_id, alive, status=None, reason=None, last_checked=None):
         (e.g. "OK". "Not Found" or "Internal Server Error") or None
     :type reason: string or None
 
+    :param etag: the ETag header of the response, for the link checker to
+        send in an If-None-Match header next time (optional, if None the
+        existing value is kept)
+    :type etag: string or None
+
+    :param last_modified: the Last-Modified header of the response, for the
+        link checker to send in an If-Modified-Since header next time
+        (optional, if None the existing value is kept)
+    :type last_modified: string or None
+
+    :param content_length: the size of the resource's file in bytes
+        (optional, if None the existing value is kept)
+    :type content_length: int or None
+
+    :param content_hash: a hash of the resource's file, to tell whether it
+        has changed (optional, if None the existing value is kept)
+    :type content_hash: string or None
+
+    """
+    upsert_many([dict(resource_id=resource_id, alive=alive, status=status,
+                      reason=reason, last_checked=last_checked, etag=etag,
+                      last_modified=last_modified,
+                      content_length=content_length,
+                      content_hash=content_hash)])
+
+
+@metrics.instrument
+def upsert_many(results_):
+    """Insert new results or update the existing results for many resources.
+
+    This does the same as calling upsert() once for each result, but all of
+    the results are saved with one SELECT, one (executemany) UPDATE and one
+    (executemany) INSERT, in a single transaction. If there are several results
+    for the same resource they're applied in order.
+
+    :param results_: the results to save, each a dict with the same keys as
+        upsert()'s params: ``resource_id`` and ``alive`` (required) and
+        ``status``, ``reason``, ``last_checked``, ``etag``,
+        ``last_modified``, ``content_length`` and ``content_hash``
+        (optional)
+    :type results_: list of dicts
+
     """
+    resource_ids = set(result["resource_id"] for result in results_)
+    if not resource_ids:
+        return
+
     now = _now()
-    try:
-        result = _get(resource_id)
-        result.alive = alive
+    table = _link_checker_results_table
+
+    q = sqlalchemy.select([table], table.c.resource_id.in_(resource_ids))
+    rows = dict((row.resource_id, dict(row.items()))
+                for row in ckan.model.Session.execute(q))
+    if config.deduplicate_urls:
+        results_ = _fan_out(results_, rows)
+    existing = set(rows)
+    was_broken = dict((resource_id, row["broken"] is True)
+                      for resource_id, row in rows.items())
+
+    for result in results_:
+        resource_id = result["resource_id"]
+        alive = result["alive"]
         assert alive in (True, False)
+        row = rows.get(resource_id)
+        if row is None:
+            row = rows[resource_id] = dict(resource_id=resource_id,
+                                           last_successful=None, num_fails=0)
+            row.update((column, None) for column in _VALIDATORS)
+        previous_alive = row.get("alive")
+        previous_interval = None
+        if row.get("next_check_at") and row.get("last_checked"):
+            previous_interval = row["next_check_at"] - row["last_checked"]
+        # A check requested by request_check() while this check was pending
+        # is kept, the link checker may have checked the resource's old URL.
+        requested_while_pending = _requested_while_pending(row)
         if alive is True:
-            result.last_successful = now
-            result.num_fails = 0
+            row["last_successful"] = now
+            row["num_fails"] = 0
         elif alive is False:
-            result.num_fails += 1
-        result.pending = False
-        result.pending_since = None
-        result.status = status
-        result.reason = reason
-    except NoResultForResourceError:
-        result = _LinkCheckerResult(resource_id, alive, status=status,
-                                    reason=reason)
-        ckan.model.Session.add(result)
-    result.last_checked = last_checked or now
+            row["num_fails"] += 1
+        row["alive"] = alive
+        row["pending"] = False
+        row["pending_since"] = None
+        row["status"] = result.get("status")
+        row["reason"] = result.get("reason")
+        row["last_checked"] = result.get("last_checked") or now
+        row["broken"] = _is_broken(row["num_fails"], row["last_successful"],
+                                   now)
+        if requested_while_pending:
+            # Leave the request's priority and time, and don't save the
+            # validators, which may be of the old URL.
+            continue
+        row["priority"] = 0
+        for column in _VALIDATORS:
+            if result.get(column) is not None:
+                row[column] = result[column]
+        if config.adaptive_recheck:
+            row["next_check_at"] = row["last_checked"] + _recheck_interval(
+                alive, previous_alive, previous_interval)
+        else:
+            row["next_check_at"] = None
+
+    # Whether any resource's link has become broken or stopped being broken.
+    flipped = any((row["broken"] is True) != was_broken.get(resource_id, False)
+                  for resource_id, row in rows.items())
+
+    updates = []
+    inserts = []
+    for resource_id, row in rows.items():
+        if resource_id in existing:
+            params = dict(row)
+            params["b_resource_id"] = params.pop("resource_id")
+            updates.append(params)
+        else:
+            inserts.append(row)
+
+    if updates:
+        ckan.model.Session.execute(
+            table.update().where(
+                table.c.resource_id == sqlalchemy.bindparam("b_resource_id")),
+            updates)
+    if inserts:
+        ckan.model.Session.execute(table.insert(), inserts)
+    if flipped:
+        _bump_generation()
+    if config.keep_history:
+        _append_history(results_, now)
     ckan.model.Session.commit()
+    if config.keep_history:
+        _prune_history_periodically()
+
+
+def _requested_while_pending(row):
+    """Return True if the given results row's check was requested by
+    request_check() after the row's pending check was given out."""
+    return bool(row.get("pending") and row.get("priority") and
+                row.get("pending_since") and row.get("next_check_at") and
+                row["next_check_at"] >= row["pending_since"])
+
+
+# The columns that upsert() saves for the link checker to use when it next
+# checks the resource, see get_validators().
+_VALIDATORS = ("etag", "last_modified", "content_length", "content_hash")
+
+
+@metrics.instrument
+def get_validators(resource_ids):
+    """Return the saved HTTP validators and content hashes of some resources.
+
+    These are what the link checker saved the last time it checked each
+    resource, so that it can send a conditional request (with If-None-Match
+    or If-Modified-Since headers) and not download the file again if it
+    hasn't changed.
+
+    :param resource_ids: the ids of the resources
+    :type resource_ids: list of strings
+
+    :returns: one dict for each resource, in the same order as resource_ids,
+        with the keys ``id``, ``etag``, ``last_modified``,
+        ``content_length`` and ``content_hash`` (None for values that haven't
+        been saved)
+    :rtype: list of dicts
+
+    """
+    table = _link_checker_results_table
+    validators = {}
+    if resource_ids:
+        columns = [table.c[column] for column in _VALIDATORS]
+        q = sqlalchemy.select([table.c.resource_id] + columns,
+                              table.c.resource_id.in_(resource_ids))
+        for row in ckan.model.Session.execute(q):
+            validators[row.resource_id] = dict(
+                (column, row[column]) for column in _VALIDATORS)
+    return [dict(validators.get(resource_id,
+                                dict.fromkeys(_VALIDATORS)),
+                 id=resource_id)
+            for resource_id in resource_ids]
+
+
+def _is_broken(num_fails, last_successful, now):
+    """Return True if a result with the given values is of a broken link.
+
+    This implements our configurable "A link is broken if it has been broken
+    for at least N consecutive checks over a period of at least M hours" logic
+    for deciding whether a link is broken or not.
+
+    Returns None (rather than False) for links that have never been checked
+    successfully: they may not pass our test to be marked as broken yet, but
+    we leave them unmarked rather than marking them as working.
+
+    """
+    min_hours_ago = now - datetime.timedelta(
+        hours=config.broken_resource_min_hours)
+    if num_fails >= config.broken_resource_min_fails and (
+            last_successful is None or last_successful < min_hours_ago):
+        return True
+    if last_successful is None:
+        return None
+    return False
+
+
+def _fan_out(results_, rows):
+    """Add copies of the results for the other resources with the same URLs.
+
+    The rows of the other resources' results are added to rows.
+
+    :param rows: the saved results rows of the resources in results_, as a
+        dict mapping resource IDs to row dicts
+    :type rows: dict
+
+    :returns: the results with the copies added
+    :rtype: list of dicts
+
+    """
+    url_hashes = dict((resource_id, row["url_hash"])
+                      for resource_id, row in rows.items() if row["url_hash"])
+    if not url_hashes:
+        return results_
+
+    table = _link_checker_results_table
+    q = sqlalchemy.select([table], sqlalchemy.and_(
+        table.c.url_hash.in_(set(url_hashes.values())),
+        sqlalchemy.not_(table.c.resource_id.in_(rows.keys()))))
+    peers = {}
+    for row in ckan.model.Session.execute(q):
+        rows[row.resource_id] = dict(row.items())
+        peers.setdefault(row.url_hash, []).append(row.resource_id)
+
+    fanned_out = list(results_)
+    for result in results_:
+        url_hash = url_hashes.get(result["resource_id"])
+        for peer_id in peers.get(url_hash, []):
+            fanned_out.append(dict(result, resource_id=peer_id))
+    return fanned_out
+
+
+def _recheck_interval(alive, previous_alive, previous_interval):
+    """Return how long to wait before checking a resource's link again.
+
+    This is used when the ``adaptive_recheck`` setting is on. Links whose
+    result has just changed (from alive to dead or back) are rechecked
+    after ``adaptive_recheck_min_hours``, to find out quickly whether the
+    change sticks. Links that are still alive are rechecked after twice the
+    previous interval, up to ``adaptive_recheck_max_hours``. Other links are
+    rechecked after ``recheck_resources_after`` hours, as when the setting is
+    off.
+
+    :param previous_interval: the interval that was used before this check,
+        or None
+    :type previous_interval: datetime.timedelta
+
+    :rtype: datetime.timedelta
+
+    """
+    interval = datetime.timedelta(hours=config.recheck_resources_after)
+    if previous_alive is not None and alive != previous_alive:
+        return datetime.timedelta(hours=config.adaptive_recheck_min_hours)
+    if alive and previous_alive and previous_interval is not None:
+        interval = max(interval, previous_interval * 2)
+        interval = min(interval, datetime.timedelta(
+            hours=config.adaptive_recheck_max_hours))
+    return interval
+
+
+@metrics.instrument
+def rebuild_broken_states():
+    """Recompute every result's broken state.
+
+    Results' broken states are normally only updated when the resource is
+    checked, so after the broken_resource_min_fails or
+    broken_resource_min_hours settings have been changed they'll be out of date
+    until each resource has been rechecked. This function brings them all up
+    to date at once, and saves the settings that they were computed with
+    (see update_broken_states()).
+
+    """
+    _lock_broken_states()
+    _rebuild_broken_states(ckan.model.Session.connection())
+    table = _broken_settings_table
+    ckan.model.Session.execute(table.delete())
+    ckan.model.Session.execute(table.insert(), _get_broken_settings())
+    _bump_generation()
+    ckan.model.Session.commit()
+
+
+@metrics.instrument
+def update_broken_states():
+    """Recompute every result's broken state if the settings have changed.
+
+    If the broken_resource_min_fails or broken_resource_min_hours settings
+    are different from the ones that the saved broken states were computed
+    with (or those were never saved) this calls rebuild_broken_states().
+
+    This function should be called at CKAN startup time, after
+    create_database_table().
+
+    :returns: whether the broken states were recomputed
+    :rtype: bool
+
+    """
+    # Several CKAN processes starting up at the same time only recompute
+    # the broken states once.
+    _lock_broken_states()
+    table = _broken_settings_table
+    saved = ckan.model.Session.execute(
+        sqlalchemy.select([table.c.min_fails, table.c.min_hours])).first()
+    if saved is not None and dict(saved.items()) == _get_broken_settings():
+        ckan.model.Session.commit()
+        return False
+    rebuild_broken_states()
+    return True
+
+
+def _get_broken_settings():
+    """Return the current broken link settings, as a broken settings table
+    row."""
+    return dict(min_fails=config.broken_resource_min_fails,
+                min_hours=config.broken_resource_min_hours)
+
+
+def _lock_broken_states():
+    """Take the lock that serializes rebuilding the broken states between
+    processes, until the current transaction ends (PostgreSQL only)."""
+    if _dialect_name() == "postgresql":
+        ckan.model.Session.execute(
+            sqlalchemy.text("SELECT pg_advisory_xact_lock(:key)"),
+            {"key": _BROKEN_STATES_LOCK_KEY})
+
+
+# An arbitrary application-defined key for PostgreSQL's advisory lock
+# functions, used to serialize rebuilding the broken states.
+_BROKEN_STATES_LOCK_KEY = 1685021302
+
+
+def get_generation():
+    """Return the current results generation.
+
+    The generation is a counter that's incremented whenever any resource's
+    broken state changes, so the broken link reports can't have changed
+    (except for changes to the datasets and organizations themselves) while
+    the generation stays the same. It's used to invalidate cached reports.
+
+    :rtype: int
+
+    """
+    generation = ckan.model.Session.execute(
+        sqlalchemy.select([_generation_table.c.generation])).scalar()
+    return generation or 0
+
+
+def _bump_generation():
+    """Increment the results generation, in the current transaction.
+
+    The generation table's single row is created by the migrations, so this
+    only ever UPDATEs it.
+
+    """
+    table = _generation_table
+    ckan.model.Session.execute(
+        table.update().values(generation=table.c.generation + 1))
+
+
+def _append_history(results_, now):
+    """Add rows to the link check history table for the given results.
+
+    The rows are added with one (executemany) INSERT, in the current
+    transaction.
+
+    """
+    reason_ids = _get_reason_ids(
+        set(result.get("reason") for result in results_) - set([None]))
+    rows = [dict(resource_id=result["resource_id"],
+                 checked_at=result.get("last_checked") or now,
+                 alive=result["alive"],
+                 status=result.get("status"),
+                 reason_id=reason_ids.get(result.get("reason")))
+            for result in results_]
+    ckan.model.Session.execute(_history_table.insert(), rows)
+
+
+def _get_reason_ids(reasons):
+    """Return the IDs of the given reason strings, adding any new ones.
+
+    The history table stores reasons as IDs of rows in the reasons table
+    instead of storing the same reason strings over and over again.
+
+    :returns: a dict mapping reason strings to IDs
+    :rtype: dict
+
+    """
+    if not reasons:
+        return {}
+    table = _reasons_table
+
+    def select():
+        q = sqlalchemy.select([table.c.reason, table.c.id],
+                              table.c.reason.in_(reasons))
+        return dict((row[0], row[1]) for row in ckan.model.Session.execute(q))
+
+    reason_ids = select()
+    missing = reasons - set(reason_ids)
+    for reason in missing:
+        # Another process may be adding the same reason at the same time, in
+        # which case the unique constraint stops us adding it twice and we
+        # use the other process's row.
+        savepoint = ckan.model.Session.begin_nested()
+        try:
+            ckan.model.Session.execute(table.insert(), dict(reason=reason))
+            savepoint.commit()
+        except sqlalchemy.exc.IntegrityError:
+            savepoint.rollback()
+    if missing:
+        reason_ids = select()
+    return reason_ids
+
+
+@metrics.instrument
+def get_history(resource_id, since=None):
+    """Return the link check history of a resource, oldest check first.
+
+    History is only recorded when the ``keep_history`` setting is on, and
+    is deleted after ``history_retention_days`` days.
+
+    :param resource_id: the resource to return the history of
+    :type resource_id: string
+
+    :param since: only return checks after this time (optional)
+    :type since: datetime.datetime
+
+    :returns: one dict for each check, with the keys ``checked_at``,
+        ``alive``, ``status`` and ``reason``
+    :rtype: list of dicts
+
+    """
+    table = _history_table
+    reasons = _reasons_table
+    q = sqlalchemy.select(
+        [table.c.checked_at, table.c.alive, table.c.status,
+         reasons.c.reason],
+        table.c.resource_id == resource_id,
+        from_obj=table.outerjoin(reasons, reasons.c.id == table.c.reason_id))
+    if since is not None:
+        q = q.where(table.c.checked_at > since)
+    q = q.order_by(table.c.checked_at)
+    return [dict(row.items()) for row in ckan.model.Session.execute(q)]
+
+
+@metrics.instrument
+def prune_history(retention_days=None):
+    """Delete link check history older than the retention period.
+
+    :param retention_days: delete history older than this many days
+        (optional, default: the ``history_retention_days`` setting), if 0
+        nothing is deleted
+    :type retention_days: int
+
+    :returns: the number of history rows deleted
+    :rtype: int
+
+    """
+    if retention_days is None:
+        retention_days = config.history_retention_days
+    if retention_days <= 0:
+        return 0
+    cutoff = _now() - datetime.timedelta(days=retention_days)
+    result = ckan.model.Session.execute(_history_table.delete().where(
+        _history_table.c.checked_at < cutoff))
+    ckan.model.Session.commit()
+    return result.rowcount
+
+
+def _prune_history_periodically():
+    """Call prune_history(), if this process hasn't done so recently.
+
+    This keeps the history table's size bounded without needing a cron job,
+    without adding a DELETE to every upsert.
+
+    """
+    global _last_pruned
+    with _prune_lock:
+        if (_last_pruned is not None and
+                _now() - _last_pruned < _PRUNE_HISTORY_EVERY):
+            return
+        _last_pruned = _now()
+    prune_history()
+
+
+_prune_lock = threading.Lock()
+_last_pruned = None
+_PRUNE_HISTORY_EVERY = datetime.timedelta(hours=1)
+
+
+def _rebuild_broken_states(connection):
+    """Recompute every result's broken state with one UPDATE."""
+    table = _link_checker_results_table
+    connection.execute(table.update().values(broken=sqlalchemy.case(
+        [(_is_broken_clause(config.broken_resource_min_fails,
+                            config.broken_resource_min_hours), True),
+         (table.c.last_successful == None, None)],
+        else_=False)))
 
 
 class NoResultForResourceError(Exception):
@@ -88,6 +817,7 @@ def _get(resource_id):
     return result
 
 
+@metrics.instrument
 def get(resource_id):
     """Return the result for the given resource ID.
 
@@ -103,9 +833,34 @@ def get(resource_id):
     return _get(resource_id).as_dict()
 
 
+@metrics.instrument
+def get_many(resource_ids):
+    """Return the results for all of the given resource IDs, in one query.
+
+    :param resource_ids: the ids of the resources whose results should be
+        returned
+    :type resource_ids: iterable of strings
+
+    :returns: a dict mapping resource IDs to result dicts, resource IDs that
+        have no results are not included
+    :rtype: dict
+
+    """
+    resource_ids = list(resource_ids)
+    if not resource_ids:
+        return {}
+    q = ckan.model.Session.query(_LinkCheckerResult)
+    q = q.filter(_LinkCheckerResult.resource_id.in_(resource_ids))
+    return dict((result.resource_id, result.as_dict()) for result in q)
+
+
+@metrics.instrument
 def all():
     """Return all the link checker results.
 
+    This loads all of the results into memory at once, use iter_results() to
+    go through lots of results.
+
     :rtype: list of dicts
 
     """
@@ -113,8 +868,415 @@ def all():
             ckan.model.Session.query(_LinkCheckerResult).all()]
 
 
+@metrics.instrument
+def iter_results(columns=None, chunk_size=1000):
+    """Iterate over the link checker results without loading them all at once.
+
+    Unlike all() this doesn't create an ORM object and a dict for each
+    result. The rows are read from a server-side cursor ``chunk_size`` rows
+    at a time and yielded as lightweight namedtuples with only the requested
+    columns, so site-wide reports can go through all of the results in
+    constant memory. Datetimes are left as datetime objects.
+
+    The results are yielded in resource_id order.
+
+    :param columns: the names of the columns to get, for example
+        ``["resource_id", "alive", "last_checked"]`` (optional, default: all
+        of the columns)
+    :type columns: list of strings
+
+    :param chunk_size: the number of rows to fetch from the database at once
+    :type chunk_size: int
+
+    :raises ValueError: if any of the columns don't exist
+
+    :returns: an iterator of namedtuples with the columns as attributes
+
+    """
+    table = _link_checker_results_table
+    if columns is None:
+        columns = table.c.keys()
+    columns = tuple(columns)
+    unknown = [name for name in columns if name not in table.c]
+    if unknown:
+        raise ValueError("No such columns: {0}".format(", ".join(unknown)))
+    row_class = _get_row_class(columns)
+
+    q = sqlalchemy.select([table.c[name] for name in columns])
+    q = q.order_by(table.c.resource_id)
+    connection = ckan.model.Session.connection().execution_options(
+        stream_results=True)
+    result = connection.execute(q)
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row_class._make(row)
+    finally:
+        result.close()
+
+
+def _get_row_class(columns):
+    """Return the namedtuple class for iter_results() rows with the given
+    columns, creating it the first time it's needed."""
+    row_class = _row_classes.get(columns)
+    if row_class is None:
+        row_class = _row_classes[columns] = collections.namedtuple(
+            "LinkCheckerResult", columns)
+    return row_class
+
+
+_row_classes = {}
+
+
+@metrics.instrument
+def get_broken_links(organizations_only=False, organization_ids=None,
+                     include_results=False):
+    """Iterate over all of the site's broken links, with their datasets.
+
+    A resource's link is broken if the broken state saved by its last upsert()
+    is True (see _is_broken()).
+
+    This is done with a single query that joins the results table with CKAN's
+    resource, package and group tables, using an index on the saved broken
+    state, so the cost depends on the number of broken links rather than on
+    the number of organizations or datasets. The rows are streamed from the
+    database (using a server-side cursor on PostgreSQL) rather than all being
+    loaded into memory at once.
+
+    Only active resources of active, public datasets are returned.
+
+    :param organizations_only: only return broken links of datasets that
+        belong to an active organization (optional, default: False)
+    :type organizations_only: bool
+
+    :param organization_ids: only return broken links of datasets that belong
+        to these organizations (optional, default: all organizations)
+    :type organization_ids: iterable of strings
+
+    :param include_results: also return each resource's URL (the same URL
+        that CKAN's resource_show returns, see get_resource_url()) and link
+        checker result, with the extra keys ``url``, ``status``, ``reason``,
+        ``num_fails``, ``last_checked`` and ``last_successful`` (optional,
+        default: False)
+    :type include_results: bool
+
+    :returns: one dict for each broken link, with the keys ``resource_id``,
+        ``dataset_id``, ``dataset_name``, ``dataset_title``,
+        ``dataset_maintainer_email``, ``dataset_author_email``,
+        ``organization_id``, ``organization_name``, ``organization_title``,
+        ``organization_image_url`` and ``organization_description`` (the
+        organization values are None for datasets with no organization),
+        sorted by organization name, then most-recently-modified dataset
+        first, then the resource's position in its dataset
+    :rtype: iterator of dicts
+
+    """
+    table = _link_checker_results_table
+    resource = ckan.model.resource_table
+    package = ckan.model.package_table
+    group = ckan.model.group_table
+
+    columns = [
+        table.c.resource_id,
+        package.c.id.label("dataset_id"),
+        package.c.name.label("dataset_name"),
+        package.c.title.label("dataset_title"),
+        package.c.maintainer_email.label("dataset_maintainer_email"),
+        package.c.author_email.label("dataset_author_email"),
+        group.c.id.label("organization_id"),
+        group.c.name.label("organization_name"),
+        group.c.title.label("organization_title"),
+        group.c.image_url.label("organization_image_url"),
+        group.c.description.label("organization_description"),
+    ]
+    if include_results:
+        columns.extend([resource.c.url, resource.c.url_type,
+                        table.c.status, table.c.reason, table.c.num_fails,
+                        table.c.last_checked, table.c.last_successful])
+    q = _select_broken_links(columns)
+    if organizations_only:
+        q = q.where(group.c.id != None)
+    if organization_ids is not None:
+        organization_ids = list(organization_ids)
+        if not organization_ids:
+            return
+        q = q.where(group.c.id.in_(organization_ids))
+    q = q.order_by(group.c.name, package.c.metadata_modified.desc(),
+                   resource.c.position)
+    q = q.execution_options(stream_results=True)
+
+    for row in ckan.model.Session.execute(q):
+        link = dict(row.items())
+        if include_results:
+            link["url"] = get_resource_url(
+                link["url"], link.pop("url_type"), link["resource_id"],
+                link["dataset_id"])
+        yield link
+
+
+@metrics.instrument
+def count_broken_links_by_organization(organization=None, min_broken=1,
+                                       limit=None, offset=0):
+    """Return the organizations that have broken links, most broken first.
+
+    This is one page of the organizations that get_broken_links() would
+    return broken links for, counted with one query, so that the broken links
+    by organization report can be paged through and filtered without reading
+    all of the site's broken links.
+
+    :param organization: only count this organization (optional)
+    :type organization: string, the organization's id or name
+
+    :param min_broken: only return organizations with at least this many
+        broken links (optional, default: 1)
+    :type min_broken: int
+
+    :param limit: the maximum number of organizations to return (optional,
+        default: no limit)
+    :type limit: int
+
+    :param offset: the number of organizations to skip (optional, default: 0)
+    :type offset: int
+
+    :returns: (organization ID, number of broken links) tuples, sorted with
+        the organizations with the most broken links first and then by name
+    :rtype: list of tuples
+
+    """
+    group = ckan.model.group_table
+    num_broken_links = sqlalchemy.func.count(
+        _link_checker_results_table.c.resource_id)
+
+    q = _select_broken_links([group.c.id, num_broken_links])
+    q = q.where(group.c.id != None)
+    if organization:
+        q = q.where(sqlalchemy.or_(group.c.id == organization,
+                                   group.c.name == organization))
+    q = q.group_by(group.c.id, group.c.name)
+    if min_broken > 1:
+        q = q.having(num_broken_links >= min_broken)
+    q = q.order_by(num_broken_links.desc(), group.c.name)
+    q = q.limit(limit).offset(offset)
+
+    return [(row[0], row[1]) for row in ckan.model.Session.execute(q)]
+
+
+def _select_broken_links(columns):
+    """Return a select of the given columns for each of the site's broken
+    links.
+
+    The results table is joined with CKAN's resource and package tables, and
+    outer-joined with the group table for the datasets' organizations.
+
+    """
+    table = _link_checker_results_table
+    resource = ckan.model.resource_table
+    package = ckan.model.package_table
+    group = ckan.model.group_table
+
+    from_ = table.join(resource, resource.c.id == table.c.resource_id)
+    from_ = _join_packages(from_)
+    from_ = from_.outerjoin(group, sqlalchemy.and_(
+        group.c.id == package.c.owner_org,
+        group.c.state == "active",
+        group.c.is_organization == True))
+
+    q = sqlalchemy.select(columns, from_obj=from_)
+    return q.where(sqlalchemy.and_(
+        table.c.broken == True,
+        resource.c.state == "active",
+        package.c.state == "active",
+        package.c.private == False,
+    ))
+
+
+@metrics.instrument
+def get_stats(since, pending_since):
+    """Return counts of the link checker results and of the check queue.
+
+    Everything is counted by one aggregate query over the results table
+    (with a subquery for the resources that have no results), so this is
+    cheap enough to call often, for example from a monitoring system.
+
+    ``since`` and ``pending_since`` have the same meanings as in
+    get_resources_to_check(), resources that it would give out are counted
+    as queued.
+
+    :returns: a dict with the keys:
+
+        ``checked``: the number of resources that have been checked at
+        least once
+        ``unchecked``: the number of resources that have never been checked,
+        whether they have no results yet or only a pending or requested
+        first check
+        ``pending``: the number of resources that have been given out to be
+        checked and whose results haven't come back yet
+        ``alive``, ``dead``: the numbers of resources whose last check found
+        their links alive or dead
+        ``broken``: the number of resources whose links are broken
+        ``requested``: the number of resources whose checks have been
+        requested by request_check()
+        ``queue_depth``: the number of resources that are due to be checked
+        now (including the unchecked ones)
+        ``oldest_last_checked``: the time of the oldest last check (datetime
+        or None)
+        ``lag``: how long the resource that has been due to be checked for
+        the longest has been waiting, not counting unchecked resources
+        (timedelta, or None if no resources with results are due)
+
+    :rtype: dict
+
+    """
+    now = _now()
+    table = _link_checker_results_table
+    resource = ckan.model.resource_table
+
+    not_requested = sqlalchemy.func.coalesce(table.c.priority, 0) == 0
+    # These are the same as get_resources_to_check()'s kinds of resource.
+    requested = sqlalchemy.and_(table.c.pending == False,
+                                table.c.priority > 0)
+    stale = sqlalchemy.and_(table.c.pending == False, not_requested,
+                            table.c.next_check_at == None,
+                            table.c.last_checked < now - since)
+    due = sqlalchemy.and_(table.c.pending == False, not_requested,
+                          table.c.next_check_at <= now)
+    expired = sqlalchemy.and_(table.c.pending == True,
+                              table.c.pending_since < now - pending_since)
+
+    def count_if(clause):
+        return sqlalchemy.func.sum(sqlalchemy.case([(clause, 1)], else_=0))
+
+    def min_if(clause, column):
+        return sqlalchemy.func.min(sqlalchemy.case([(clause, column)],
+                                                   else_=None))
+
+    # An alias, so that the subquery isn't correlated with the outer query's
+    # results table.
+    results_alias = table.alias()
+    no_results = sqlalchemy.select(
+        [sqlalchemy.func.count(resource.c.id)],
+        ~sqlalchemy.exists([results_alias.c.resource_id],
+                           results_alias.c.resource_id == resource.c.id))
+
+    q = sqlalchemy.select([
+        count_if(table.c.last_checked != None).label("checked"),
+        count_if(table.c.last_checked == None).label("never_checked"),
+        no_results.as_scalar().label("no_results"),
+        count_if(table.c.pending == True).label("pending"),
+        count_if(table.c.alive == True).label("alive"),
+        count_if(table.c.alive == False).label("dead"),
+        count_if(table.c.broken == True).label("broken"),
+        count_if(requested).label("requested"),
+        count_if(sqlalchemy.or_(requested, stale, due, expired)).label(
+            "queued"),
+        sqlalchemy.func.min(table.c.last_checked).label(
+            "oldest_last_checked"),
+        min_if(requested, table.c.next_check_at).label("oldest_requested"),
+        min_if(stale, table.c.last_checked).label("oldest_stale"),
+        min_if(due, table.c.next_check_at).label("oldest_due"),
+        min_if(expired, table.c.pending_since).label("oldest_expired"),
+    ])
+    row = ckan.model.Session.execute(q).first()
+
+    # When each kind of queued resource became due to be checked.
+    due_times = [time for time in (
+        row.oldest_requested,
+        row.oldest_stale and row.oldest_stale + since,
+        row.oldest_due,
+        row.oldest_expired and row.oldest_expired + pending_since)
+        if time is not None]
+    if due_times:
+        lag = max(now - min(due_times), datetime.timedelta(0))
+    else:
+        lag = None
+
+    return dict(
+        checked=row.checked or 0,
+        unchecked=(row.never_checked or 0) + row.no_results,
+        pending=row.pending or 0,
+        alive=row.alive or 0,
+        dead=row.dead or 0,
+        broken=row.broken or 0,
+        requested=row.requested or 0,
+        # Resources that have results are queued if they're requested,
+        # stale, due or expired, whether or not they've ever been checked.
+        queue_depth=(row.queued or 0) + row.no_results,
+        oldest_last_checked=row.oldest_last_checked,
+        lag=lag,
+    )
+
+
+@metrics.instrument
+def count_datasets(organization_ids):
+    """Return the number of active, public datasets in each organization.
+
+    :param organization_ids: the ids of the organizations to count
+    :type organization_ids: iterable of strings
+
+    :returns: a dict mapping organization IDs to numbers of datasets,
+        organizations that have no datasets are not included
+    :rtype: dict
+
+    """
+    organization_ids = list(organization_ids)
+    if not organization_ids:
+        return {}
+    package = ckan.model.package_table
+    q = sqlalchemy.select(
+        [package.c.owner_org, sqlalchemy.func.count(package.c.id)],
+        sqlalchemy.and_(package.c.owner_org.in_(organization_ids),
+                        package.c.state == "active",
+                        package.c.private == False))
+    q = q.group_by(package.c.owner_org)
+    return dict((row[0], row[1]) for row in ckan.model.Session.execute(q))
+
+
+def _is_broken_clause(min_fails, min_hours):
+    """Return a SQL expression that's true for results of broken links.
+
+    This is the SQL version of _is_broken()'s "broken for at least min_fails
+    consecutive checks over a period of at least min_hours hours" rule.
+
+    """
+    table = _link_checker_results_table
+    min_hours_ago = _now() - datetime.timedelta(hours=min_hours)
+    clause = sqlalchemy.and_(
+        table.c.num_fails >= min_fails,
+        sqlalchemy.or_(table.c.last_successful == None,
+                       table.c.last_successful < min_hours_ago))
+    if min_fails > 0:
+        # A result with any fails is always one whose last check failed,
+        # saying so lets the database use the partial "failing" index.
+        clause = sqlalchemy.and_(table.c.alive == False, clause)
+    return clause
+
+
+def _join_packages(from_):
+    """Join CKAN's package table onto a FROM clause containing resource.
+
+    In CKAN 2.2 resources belong to packages through the resource_group table,
+    in later versions of CKAN the resource table has a package_id column.
+
+    """
+    resource = ckan.model.resource_table
+    package = ckan.model.package_table
+    resource_group = getattr(ckan.model, "resource_group_table", None)
+    if resource_group is not None:
+        from_ = from_.join(
+            resource_group,
+            resource_group.c.id == resource.c.resource_group_id)
+        return from_.join(package,
+                          package.c.id == resource_group.c.package_id)
+    return from_.join(package, package.c.id == resource.c.package_id)
+
+
 # FIXME: What about resources belonging to private datasets?
-def get_resources_to_check(n, since=None, pending_since=None):
+@metrics.instrument
+def get_resources_to_check(n, since=None, pending_since=None, max_per_host=0,
+                           host_cooldown=None, include_urls=False):
     """Return up to ``n`` resources to be checked for dead or alive links.
 
     This function has side effects! Pending results will be added to the
@@ -123,7 +1285,10 @@ def get_resources_to_check(n, since=None, pending_since=None):
     them soon. Resources with pending results won't be given out to another link
     checker again for a while.
 
-    Resources that don't have any results in the database will be returned first
+    Resources whose checks have been requested with request_check() will be
+    returned first (sorted with the oldest requests first).
+
+    Resources that don't have any results in the database will be returned next
     (sorted with the oldest resources first).
 
     If there are less than ``n`` resources that have no results, then we start
@@ -135,6 +1300,11 @@ def get_resources_to_check(n, since=None, pending_since=None):
     Resources that have completed results from less than ``since`` ago will
     never be returned.
 
+    When the ``adaptive_recheck`` setting is on, upsert() saves a next check
+    time for each resource instead, and ``since`` isn't used for those
+    resources: they're returned (sorted together with the resources above)
+    once their next check time has come.
+
     If there are still less than ``n`` resources, then we start re-checking
     resources that have pending results that we haven't received yet.  Resources
     that have a pending result from longer than ``pending_since`` ago will be
@@ -146,6 +1316,29 @@ def get_resources_to_check(n, since=None, pending_since=None):
     If that still makes less than ``n`` resources then less than ``n``
     resources will be returned.
 
+    When the ``deduplicate_urls`` setting is on, only one resource is
+    returned for each distinct URL (see _get_url_hash()). The other resources
+    with the same URL are made pending too, and upsert() saves the returned
+    resource's result for all of them.
+
+    The resources returned are interleaved by the host names in their URLs,
+    taking one resource from each host in turn, so that a link checker
+    working through them doesn't send all of its requests to one server at
+    once. ``max_per_host`` limits the number of resources from any one host in
+    each batch, and ``host_cooldown`` stops resources from a host being
+    returned again until some time after the last batch that included that
+    host. Both limits are applied by the database query, before the batch
+    is cut to ``n`` resources, so resources from other hosts fill the batch
+    instead. Resources held back by these limits are left for later calls:
+    with ``host_cooldown``, no resources may be returned even though some are
+    due, if all of them are on hosts that are cooling down (get_stats()'s
+    ``queue_depth`` still counts them).
+
+    It's safe for several link checkers to call this function at the same
+    time: selecting the resources and marking them as pending is done as one
+    locked transaction, so concurrent callers always get disjoint batches of
+    resources.
+
     :param n: the maximum number of resources to return
     :type n: int
 
@@ -157,8 +1350,23 @@ def get_resources_to_check(n, since=None, pending_since=None):
         delta will not be returned (optional, default: 2 hours)
     :type pending_since: datetime.timedelta
 
-    :returns: the list of resource IDs to be checked
-    :rtype: list of strings
+    :param max_per_host: the maximum number of resources from the same host to
+        return, 0 for no limit (optional, default: 0)
+    :type max_per_host: int
+
+    :param host_cooldown: resources from hosts that had resources returned
+        within this time delta will not be returned (optional, default: no
+        cooldown)
+    :type host_cooldown: datetime.timedelta
+
+    :param include_urls: return each resource's URL with its ID, the same
+        URL that CKAN's resource_show returns (see get_resource_url())
+        (optional, default: False)
+    :type include_urls: bool
+
+    :returns: the list of resource IDs to be checked or, if ``include_urls``
+        is true, a list of dicts with the keys ``id`` and ``url``
+    :rtype: list of strings or list of dicts
 
     """
     if since is None:
@@ -167,63 +1375,580 @@ def get_resources_to_check(n, since=None, pending_since=None):
     if pending_since is None:
         pending_since = datetime.timedelta(hours=2)
 
-    # Get the IDs of all the resources that have no results, oldest resources
-    # first.
-    resources_with_link_checks = ckan.model.Session.query(
-        _LinkCheckerResult.resource_id)
-    q = ckan.model.Session.query(ckan.model.Resource.id)
-    q = q.filter(~ckan.model.Resource.id.in_(resources_with_link_checks))
-    q = q.order_by(ckan.model.Resource.last_modified.asc())
-    resources_to_check = [row[0] for row in q]
-
-    if len(resources_to_check) >= n:
-        return _make_pending(resources_to_check[:n])
-
-    # Get the IDs of all the resources that:
-    # - Do have results
-    # - Do not have any pending results
-    # - The last result is from > ``since`` ago.
-    since_time_ago = _now() - since
-    q = ckan.model.Session.query(_LinkCheckerResult.resource_id)
-    q = q.filter_by(pending=False)
-    q = q.filter(_LinkCheckerResult.last_checked < since_time_ago)
-    q = q.order_by(_LinkCheckerResult.last_checked.asc())
-    resources_to_check.extend([row[0] for row in q])
-
-    if len(resources_to_check) >= n:
-        return _make_pending(resources_to_check[:n])
-
-    # Get the IDs of all the resources that have a pending result from >
-    # ``pending_since`` ago.
-    pending_time_ago = _now() - pending_since
-    q = ckan.model.Session.query(_LinkCheckerResult.resource_id)
-    q = q.filter_by(pending=True)
-    q = q.filter(_LinkCheckerResult.pending_since < pending_time_ago)
-    q = q.order_by(_LinkCheckerResult.pending_since.asc())
-    resources_to_check.extend([row[0] for row in q])
-
-    return _make_pending(resources_to_check[:n])
+    with _lease_lock:
+        try:
+            _lock_for_leasing()
+
+            cooling_hosts = set()
+            if host_cooldown:
+                cooling_hosts = _get_cooling_hosts(host_cooldown)
+
+            rows = _get_candidates(n, since, pending_since,
+                                   max_per_host=max_per_host,
+                                   exclude_hosts=cooling_hosts)
+            urls = collections.OrderedDict(
+                (row.resource_id, _get_resource_url(row)) for row in rows)
+            candidates = [(row.resource_id,
+                           row.host or get_host(urls[row.resource_id]))
+                          for row in rows]
+            if config.deduplicate_urls:
+                candidates = _deduplicate(candidates, urls)
+            resources_to_check = _interleave_by_host(candidates, n,
+                                                     max_per_host)
+            peers = []
+            if config.deduplicate_urls:
+                peers = _get_peers(resources_to_check, urls)
+            _make_pending(resources_to_check + peers, urls=urls)
+        except Exception:
+            # Don't leave the advisory lock held by an open transaction.
+            ckan.model.Session.rollback()
+            raise
+
+    if include_urls:
+        return [dict(id=resource_id, url=urls[resource_id])
+                for resource_id in resources_to_check]
+    return resources_to_check
+
+
+def get_resource_url(url, url_type, resource_id, package_id):
+    """Return a resource's URL the same way that CKAN's resource_show does.
+
+    The resource table's url column only holds the filename of uploaded
+    resources (``url_type`` "upload"), and other resources' URLs may not have
+    a scheme. Like CKAN's resource_dictize(), this returns the resource's
+    download URL for uploads and adds "http://" to URLs without a scheme.
+    The download URL is built from the ckan.site_url setting rather than with
+    url_for(), because the built-in link checker isn't running in a web
+    request.
+
+    """
+    if not url:
+        return url
+    if url_type == "upload":
+        filename = ckan.lib.munge.munge_filename(url.split("/")[-1])
+        return u"{0}/dataset/{1}/resource/{2}/download/{3}".format(
+            pylons.config["ckan.site_url"].rstrip("/"), package_id,
+            resource_id, filename)
+    try:
+        scheme = urlparse.urlsplit(url).scheme
+    except ValueError:
+        return url
+    if not scheme:
+        return u"http://" + url.lstrip("/")
+    return url
+
+
+def _get_resource_url(row):
+    """Call get_resource_url() with the ``url``, ``url_type``,
+    ``resource_id`` and ``package_id`` columns of a row."""
+    return get_resource_url(row.url, row.url_type, row.resource_id,
+                            row.package_id)
+
+
+def _outerjoin_package_ids(from_):
+    """Outer join the resources' package IDs onto a FROM clause containing
+    CKAN's resource table.
+
+    See _join_packages() for the difference between CKAN versions.
+
+    :returns: the new FROM clause and the package ID column
+
+    """
+    resource = ckan.model.resource_table
+    resource_group = getattr(ckan.model, "resource_group_table", None)
+    if resource_group is not None:
+        from_ = from_.outerjoin(
+            resource_group,
+            resource_group.c.id == resource.c.resource_group_id)
+        return from_, resource_group.c.package_id
+    return from_, resource.c.package_id
+
+
+def get_host(url):
+    """Return the host name of the given URL, or None if it doesn't have one.
+
+    Host names are lowercased, so different spellings of the same host are
+    the same.
+
+    """
+    if not url:
+        return None
+    try:
+        return urlparse.urlparse(url).hostname
+    except ValueError:
+        return None
+
+
+def _get_url_hash(url):
+    """Return a hash of the normalized form of the given URL, or None.
+
+    URLs that differ only in the case of their scheme and host name, in
+    whitespace around them, in a default port number, in an empty path or in
+    their fragment identifier are the same URL for link checking purposes
+    and have the same hash.
+
+    """
+    if not url:
+        return None
+    try:
+        parts = urlparse.urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ""
+    if port and (scheme, port) not in (("http", 80), ("https", 443)):
+        netloc = u"{0}:{1}".format(netloc, port)
+    if "@" in parts.netloc:
+        netloc = parts.netloc.rpartition("@")[0] + "@" + netloc
+    normalized = urlparse.urlunsplit(
+        (scheme, netloc, parts.path or "/", parts.query, ""))
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def _deduplicate(candidates, urls):
+    """Return the candidates without the ones whose URLs are repeated.
+
+    The first candidate with each URL is kept.
+
+    """
+    seen = set()
+    deduplicated = []
+    for resource_id, host in candidates:
+        url_hash = _get_url_hash(urls.get(resource_id))
+        if url_hash is not None and url_hash in seen:
+            continue
+        seen.add(url_hash)
+        deduplicated.append((resource_id, host))
+    return deduplicated
+
+
+def _get_peers(resource_ids, urls):
+    """Return the other resources that have the same URLs as the given ones.
+
+    These are the resources with the same URL hashes among the candidates
+    (urls) and in the saved results.
+
+    :rtype: list of strings
+
+    """
+    url_hashes = set(_get_url_hash(urls.get(resource_id))
+                     for resource_id in resource_ids) - set([None])
+    if not url_hashes:
+        return []
+    peers = set(resource_id for resource_id, url in urls.items()
+                if _get_url_hash(url) in url_hashes)
+    table = _link_checker_results_table
+    q = sqlalchemy.select([table.c.resource_id],
+                          table.c.url_hash.in_(url_hashes))
+    peers.update(row.resource_id for row in ckan.model.Session.execute(q))
+    return list(peers - set(resource_ids))
+
+
+def _get_cooling_hosts(host_cooldown):
+    """Return the hosts that had resources given out within host_cooldown.
+
+    :rtype: set of strings
+
+    """
+    table = _hosts_table
+    q = sqlalchemy.select([table.c.host],
+                          table.c.last_leased > _now() - host_cooldown)
+    return set(row.host for row in ckan.model.Session.execute(q))
+
+
+def _interleave_by_host(candidates, n, max_per_host):
+    """Pick up to n resources from candidates, taking from each host in turn.
+
+    Hosts take turns in the order of their first candidate and each host's
+    resources keep their order from candidates, so when all the candidates
+    are on the same host this is the same as taking the first n.
+
+    :param candidates: (resource ID, host) tuples, in priority order
+    :type candidates: list of tuples
+
+    :param max_per_host: the maximum number of resources to pick from the
+        same host, 0 for no limit (resources with no host aren't limited, the
+        same as in _get_candidates())
+    :type max_per_host: int
+
+    :returns: the picked resource IDs
+    :rtype: list of strings
+
+    """
+    queues = collections.OrderedDict()
+    for resource_id, host in candidates:
+        queues.setdefault(host, collections.deque()).append(resource_id)
+    if max_per_host:
+        for host, queue in queues.items():
+            if host is not None:
+                queues[host] = collections.deque(list(queue)[:max_per_host])
+
+    picked = []
+    while queues and len(picked) < n:
+        for host in list(queues.keys()):
+            picked.append(queues[host].popleft())
+            if not queues[host]:
+                del queues[host]
+            if len(picked) == n:
+                break
+    return picked
+
+
+@metrics.instrument
+def request_check(resource_ids, url_changed=False):
+    """Ask for the given resources to be checked as soon as possible.
+
+    The resources will be returned by get_resources_to_check() before any
+    others (unless they're already pending), whenever they were last checked.
+    Their priority goes back to normal when their next result is saved by
+    upsert(). If a resource is pending when its check is requested, the
+    result of the pending check (which may be of the resource's old URL) is
+    saved but the request is kept, so the resource is checked again.
+
+    :param resource_ids: the IDs of the resources to check
+    :type resource_ids: iterable of strings
+
+    :param url_changed: the resources' URLs have changed, so forget their
+        saved HTTP validators, content hashes and URL hashes (optional,
+        default: False)
+    :type url_changed: bool
+
+    """
+    resource_ids = set(resource_ids)
+    if not resource_ids:
+        return
+    now = _now()
+    table = _link_checker_results_table
+    resource = ckan.model.resource_table
+
+    q = sqlalchemy.select([table.c.resource_id],
+                          table.c.resource_id.in_(resource_ids))
+    existing = set(row.resource_id for row in ckan.model.Session.execute(q))
+
+    # The hosts of the resources' URLs, for get_resources_to_check()'s
+    # per-host limits. They're only saved for new results and changed URLs.
+    hosts = {}
+    if url_changed or existing != resource_ids:
+        from_, package_id = _outerjoin_package_ids(resource)
+        q = sqlalchemy.select(
+            [resource.c.id.label("resource_id"), resource.c.url,
+             resource.c.url_type, package_id.label("package_id")],
+            resource.c.id.in_(resource_ids), from_obj=from_)
+        hosts = dict((row.resource_id, get_host(_get_resource_url(row)))
+                     for row in ckan.model.Session.execute(q))
+
+    if existing:
+        values = dict(priority=1, next_check_at=now)
+        if url_changed:
+            values.update(dict.fromkeys(_VALIDATORS))
+            values["url_hash"] = None
+        ckan.model.Session.execute(
+            table.update().where(table.c.resource_id.in_(existing))
+            .values(**values))
+        if url_changed:
+            ckan.model.Session.execute(
+                table.update().where(
+                    table.c.resource_id ==
+                    sqlalchemy.bindparam("b_resource_id")),
+                [dict(b_resource_id=resource_id,
+                      host=hosts.get(resource_id))
+                 for resource_id in existing])
+
+    new = [dict(resource_id=resource_id, alive=None, last_checked=None,
+                last_successful=None, num_fails=0, pending=False,
+                pending_since=None, status=None, reason=None, priority=1,
+                next_check_at=now, host=hosts.get(resource_id))
+           for resource_id in resource_ids if resource_id not in existing]
+    if new:
+        ckan.model.Session.execute(table.insert(), new)
+
+    ckan.model.Session.commit()
+
+
+# Serializes get_resources_to_check() calls between threads of this process.
+_lease_lock = threading.Lock()
+
+# An arbitrary application-defined key for PostgreSQL's advisory lock
+# functions, used to serialize get_resources_to_check() calls between
+# processes.
+_LEASE_LOCK_KEY = 1685021300
+
+
+def _dialect_name():
+    return ckan.model.Session.get_bind().dialect.name
+
+
+def _lock_for_leasing():
+    """Take the lock that get_resources_to_check() holds until it commits.
+
+    Row-level locking (``SELECT ... FOR UPDATE SKIP LOCKED``) can't be used
+    here because resources that have never been checked don't have a results
+    row to lock yet. Instead, on PostgreSQL we take a transaction-scoped
+    advisory lock which is released automatically when _make_pending() commits
+    (or when the transaction is rolled back). Other databases fall back on
+    the in-process _lease_lock only.
+
+    """
+    if _dialect_name() == "postgresql":
+        ckan.model.Session.execute(
+            sqlalchemy.text("SELECT pg_advisory_xact_lock(:key)"),
+            {"key": _LEASE_LOCK_KEY})
+
+
+def _get_candidates(n, since, pending_since, max_per_host=0,
+                    exclude_hosts=()):
+    """Return up to ``n`` rows of resources that are due to be checked.
+
+    All the kinds of resource described in get_resources_to_check() are
+    selected in a single UNION ALL query, each branch tagged with a priority
+    and a sort key, and the database does the sorting and the limiting.
+    Each branch is limited to ``n`` rows as well, so that the database can
+    stop reading each branch's index early instead of sorting the whole
+    backlog.
+
+    With a ``max_per_host`` limit each branch is limited to ``n`` times
+    _HOST_POOL_FACTOR rows instead, because the first ``n`` rows of a branch
+    may all be on the same host. Then each candidate is numbered within its
+    host (with ``row_number() OVER (PARTITION BY host ...)``) and only the
+    first ``max_per_host`` candidates of each host are kept. Candidates with
+    no host aren't limited. If a branch's first ``n`` times
+    _HOST_POOL_FACTOR rows are on fewer than ``n / max_per_host`` hosts, less
+    than ``n`` rows may be returned even though more are due.
+
+    Resources from the given ``exclude_hosts`` are left out.
+
+    Resources that have results use the host saved in their results, those
+    that don't have any yet use the host of their URL (see _sql_host()).
+
+    Each returned row has ``resource_id``, ``priority``, ``url``,
+    ``url_type``, ``package_id`` and ``host`` attributes (pass it to
+    _get_resource_url() for the resource's full URL).
+
+    """
+    now = _now()
+    table = _link_checker_results_table
+    resource = ckan.model.resource_table
+
+    # Resources whose checks have been requested by request_check() and
+    # that aren't pending, oldest request first.
+    requested = sqlalchemy.select(
+        [table.c.resource_id,
+         sqlalchemy.literal_column("0").label("priority"),
+         table.c.next_check_at.label("sort_key"),
+         table.c.host],
+        sqlalchemy.and_(table.c.pending == False, table.c.priority > 0))
+    requested = requested.order_by(table.c.next_check_at.asc())
+
+    # The remaining branches leave out requested resources, so that they
+    # aren't returned twice.
+    not_requested = sqlalchemy.func.coalesce(table.c.priority, 0) == 0
+
+    # Resources that have no results, oldest resources first.
+    unchecked_host = _sql_host(resource.c.url)
+    unchecked = sqlalchemy.select(
+        [resource.c.id.label("resource_id"),
+         sqlalchemy.literal_column("1").label("priority"),
+         resource.c.last_modified.label("sort_key"),
+         unchecked_host.label("host")],
+        ~sqlalchemy.exists([table.c.resource_id],
+                           table.c.resource_id == resource.c.id))
+    unchecked = unchecked.order_by(resource.c.last_modified.asc())
+
+    # Resources that do have results, do not have any pending results, and
+    # whose last result is from > ``since`` ago.
+    stale = sqlalchemy.select(
+        [table.c.resource_id,
+         sqlalchemy.literal_column("2").label("priority"),
+         table.c.last_checked.label("sort_key"),
+         table.c.host],
+        sqlalchemy.and_(table.c.pending == False,
+                        not_requested,
+                        table.c.next_check_at == None,
+                        table.c.last_checked < now - since))
+    stale = stale.order_by(table.c.last_checked.asc())
+
+    # Resources that do not have any pending results, and whose own next
+    # check time (saved by upsert() when the adaptive_recheck setting is on)
+    # has come. These are sorted together with the stale resources.
+    due = sqlalchemy.select(
+        [table.c.resource_id,
+         sqlalchemy.literal_column("2").label("priority"),
+         table.c.next_check_at.label("sort_key"),
+         table.c.host],
+        sqlalchemy.and_(table.c.pending == False,
+                        not_requested,
+                        table.c.next_check_at <= now))
+    due = due.order_by(table.c.next_check_at.asc())
+
+    # Resources that have a pending result from > ``pending_since`` ago.
+    expired = sqlalchemy.select(
+        [table.c.resource_id,
+         sqlalchemy.literal_column("3").label("priority"),
+         table.c.pending_since.label("sort_key"),
+         table.c.host],
+        sqlalchemy.and_(table.c.pending == True,
+                        table.c.pending_since < now - pending_since))
+    expired = expired.order_by(table.c.pending_since.asc())
+
+    if exclude_hosts:
+        exclude_hosts = list(exclude_hosts)
+
+        def not_excluded(host):
+            return sqlalchemy.or_(host == None,
+                                  sqlalchemy.not_(host.in_(exclude_hosts)))
+        requested = requested.where(not_excluded(table.c.host))
+        unchecked = unchecked.where(not_excluded(unchecked_host))
+        stale = stale.where(not_excluded(table.c.host))
+        due = due.where(not_excluded(table.c.host))
+        expired = expired.where(not_excluded(table.c.host))
+
+    # Wrap each branch in a subquery so that its ORDER BY and LIMIT are
+    # allowed inside the UNION.
+    branches = []
+    for branch in (requested, unchecked, stale, due, expired):
+        if max_per_host:
+            branch = branch.limit(n * _HOST_POOL_FACTOR)
+        else:
+            branch = branch.limit(n)
+        branch = branch.alias()
+        branches.append(sqlalchemy.select(
+            [branch.c.resource_id, branch.c.priority, branch.c.sort_key,
+             branch.c.host]))
+    candidates = sqlalchemy.union_all(*branches).alias("candidates")
+
+    if max_per_host:
+        host_rank = sqlalchemy.func.row_number().over(
+            partition_by=candidates.c.host,
+            order_by=[candidates.c.priority.asc(),
+                      candidates.c.sort_key.asc()])
+        candidates = sqlalchemy.select(
+            [candidates, host_rank.label("host_rank")]).alias("ranked")
+
+    from_, package_id = _outerjoin_package_ids(candidates.outerjoin(
+        resource, resource.c.id == candidates.c.resource_id))
+    q = sqlalchemy.select(
+        [candidates.c.resource_id, candidates.c.priority, resource.c.url,
+         resource.c.url_type, package_id.label("package_id"),
+         candidates.c.host],
+        from_obj=from_)
+    if max_per_host:
+        q = q.where(sqlalchemy.or_(candidates.c.host == None,
+                                   candidates.c.host_rank <= max_per_host))
+    q = q.order_by(candidates.c.priority.asc(), candidates.c.sort_key.asc())
+    q = q.limit(n)
+    return ckan.model.Session.execute(q).fetchall()
+
+
+# With a max_per_host limit, _get_candidates() reads this many times n rows
+# from each branch of its query before applying the limit.
+_HOST_POOL_FACTOR = 10
+
+
+def _sql_host(url):
+    """Return a SQL expression for the host name of the given URL column.
+
+    This is the SQL version of get_host(), for resources that don't have a
+    saved host yet. It uses a PostgreSQL regular expression, on other
+    databases it's always NULL (so those resources aren't limited by host).
+
+    """
+    if _dialect_name() != "postgresql":
+        return sqlalchemy.cast(sqlalchemy.null(), types.UnicodeText)
+    return sqlalchemy.func.nullif(
+        sqlalchemy.func.substring(sqlalchemy.func.lower(url), _HOST_PATTERN),
+        "")
+
+
+# Matches a URL's scheme and user info, capturing its host name.
+_HOST_PATTERN = r"^[a-z][a-z0-9+.-]*://(?:[^/?#@]*@)?([^/?#:]*)"
 
 
 def _now():
     return datetime.datetime.utcnow()
 
 
-def _make_pending(resource_ids, pending_since=None):
-    """Make the results for the given resource IDs as pending."""
-    now = _now()
-    for resource_id in resource_ids:
-        try:
-            result = _get(resource_id)
-        except NoResultForResourceError:
-            result = _LinkCheckerResult(resource_id, None, pending=True)
-            ckan.model.Session.add(result)
-        result.pending = True
-        result.pending_since = pending_since or now
+def _make_pending(resource_ids, pending_since=None, urls=None):
+    """Make the results for the given resource IDs as pending.
+
+    Existing results are updated with a single UPDATE and results are created
+    for the resources that don't have any yet with a single INSERT, all in one
+    transaction.
+
+    :param urls: a dict mapping resource IDs to their URLs, whose hosts and
+        hashes are saved in the results and whose hosts' last leased times
+        are saved in the hosts table (optional)
+    :type urls: dict
+
+    """
+    pending_since = pending_since or _now()
+    table = _link_checker_results_table
+    urls = dict((resource_id, urls[resource_id])
+                for resource_id in resource_ids if resource_id in (urls or {}))
+    hosts = dict((resource_id, get_host(url))
+                 for resource_id, url in urls.items())
+    url_hashes = dict((resource_id, _get_url_hash(url))
+                      for resource_id, url in urls.items())
+
+    if resource_ids:
+        q = sqlalchemy.select(
+            [table.c.resource_id, table.c.host, table.c.url_hash],
+            table.c.resource_id.in_(resource_ids))
+        existing = dict((row.resource_id, (row.host, row.url_hash))
+                        for row in ckan.model.Session.execute(q))
+
+        if existing:
+            ckan.model.Session.execute(
+                table.update()
+                .where(table.c.resource_id.in_(existing.keys()))
+                .values(pending=True, pending_since=pending_since))
+
+        # Only results whose resource's URL has changed (or was never saved)
+        # need their host and URL hash updating.
+        changed = [dict(b_resource_id=resource_id, host=hosts[resource_id],
+                        url_hash=url_hashes[resource_id])
+                   for resource_id, saved in existing.items()
+                   if resource_id in urls and saved != (
+                       hosts[resource_id], url_hashes[resource_id])]
+        if changed:
+            ckan.model.Session.execute(
+                table.update().where(
+                    table.c.resource_id ==
+                    sqlalchemy.bindparam("b_resource_id")),
+                changed)
+
+        new = [dict(resource_id=resource_id, alive=None, last_checked=None,
+                    last_successful=None, num_fails=0, pending=True,
+                    pending_since=pending_since, status=None, reason=None,
+                    host=hosts.get(resource_id),
+                    url_hash=url_hashes.get(resource_id))
+               for resource_id in resource_ids if resource_id not in existing]
+        if new:
+            ckan.model.Session.execute(table.insert(), new)
+
+        _touch_hosts(set(hosts.values()) - set([None]), pending_since)
+
     ckan.model.Session.commit()
     return resource_ids
 
 
+def _touch_hosts(hosts, last_leased):
+    """Set the last leased time of the given hosts in the hosts table."""
+    if not hosts:
+        return
+    table = _hosts_table
+    q = sqlalchemy.select([table.c.host], table.c.host.in_(hosts))
+    existing = set(row.host for row in ckan.model.Session.execute(q))
+    if existing:
+        ckan.model.Session.execute(
+            table.update().where(table.c.host.in_(existing))
+            .values(last_leased=last_leased))
+    new = [dict(host=host, last_leased=last_leased)
+           for host in hosts if host not in existing]
+    if new:
+        ckan.model.Session.execute(table.insert(), new)
+
+
 _link_checker_results_table = sqlalchemy.Table(
     'link_checker_results', ckan.model.meta.metadata,
     sqlalchemy.Column('resource_id', types.UnicodeText, primary_key=True),
@@ -235,6 +1960,122 @@ _link_checker_results_table = sqlalchemy.Table(
     sqlalchemy.Column('pending_since', types.DateTime, nullable=True),
     sqlalchemy.Column('status', types.Integer, nullable=True),
     sqlalchemy.Column('reason', types.UnicodeText, nullable=True),
+    sqlalchemy.Column('broken', types.Boolean, nullable=True),
+    sqlalchemy.Column('host', types.UnicodeText, nullable=True),
+    sqlalchemy.Column('next_check_at', types.DateTime, nullable=True),
+    sqlalchemy.Column('priority', types.Integer, nullable=True),
+    sqlalchemy.Column('etag', types.UnicodeText, nullable=True),
+    sqlalchemy.Column('last_modified', types.UnicodeText, nullable=True),
+    sqlalchemy.Column('content_length', types.BigInteger, nullable=True),
+    sqlalchemy.Column('content_hash', types.UnicodeText, nullable=True),
+    sqlalchemy.Column('url_hash', types.UnicodeText, nullable=True),
+)
+
+# For get_resources_to_check()'s "not checked recently" query.
+_pending_last_checked_index = sqlalchemy.Index(
+    'idx_link_checker_results_pending_last_checked',
+    _link_checker_results_table.c.pending,
+    _link_checker_results_table.c.last_checked)
+
+# For get_resources_to_check()'s "next check time has come" query.
+_pending_next_check_at_index = sqlalchemy.Index(
+    'idx_link_checker_results_pending_next_check_at',
+    _link_checker_results_table.c.pending,
+    _link_checker_results_table.c.next_check_at)
+
+# For get_resources_to_check()'s "requested check" query.
+_requested_index = sqlalchemy.Index(
+    'idx_link_checker_results_requested',
+    _link_checker_results_table.c.next_check_at,
+    postgresql_where=sqlalchemy.text('priority > 0'))
+
+# For finding the results of resources with the same URL.
+_url_hash_index = sqlalchemy.Index(
+    'idx_link_checker_results_url_hash',
+    _link_checker_results_table.c.url_hash)
+
+# For get_resources_to_check()'s "expired pending check" query.
+_pending_since_index = sqlalchemy.Index(
+    'idx_link_checker_results_pending_since',
+    _link_checker_results_table.c.pending_since,
+    postgresql_where=sqlalchemy.text('pending'))
+
+# For finding broken links, which have to be failing (alive is false).
+_failing_index = sqlalchemy.Index(
+    'idx_link_checker_results_failing',
+    _link_checker_results_table.c.num_fails,
+    _link_checker_results_table.c.last_successful,
+    postgresql_where=sqlalchemy.text('NOT alive'))
+
+
+# For finding broken links by their saved broken state.
+_broken_index = sqlalchemy.Index(
+    'idx_link_checker_results_broken',
+    _link_checker_results_table.c.broken,
+    postgresql_where=sqlalchemy.text('broken'))
+
+
+# Link check reason strings, stored once each and referred to by ID from the
+# history table.
+_reasons_table = sqlalchemy.Table(
+    'link_checker_reasons', ckan.model.meta.metadata,
+    sqlalchemy.Column('id', types.Integer, primary_key=True),
+    sqlalchemy.Column('reason', types.UnicodeText, nullable=False,
+                      unique=True),
+)
+
+# An append-only log of every link check result, written by upsert() when the
+# keep_history setting is on. Unlike link_checker_results this has one row
+# per check, so its columns are kept small and it has no primary key.
+_history_table = sqlalchemy.Table(
+    'link_checker_history', ckan.model.meta.metadata,
+    sqlalchemy.Column('resource_id', types.UnicodeText, nullable=False),
+    sqlalchemy.Column('checked_at', types.DateTime, nullable=False),
+    sqlalchemy.Column('alive', types.Boolean, nullable=False),
+    sqlalchemy.Column('status', types.SmallInteger, nullable=True),
+    sqlalchemy.Column('reason_id', types.Integer,
+                      sqlalchemy.ForeignKey('link_checker_reasons.id'),
+                      nullable=True),
+)
+
+# For get_history().
+_history_resource_id_index = sqlalchemy.Index(
+    'idx_link_checker_history_resource_id_checked_at',
+    _history_table.c.resource_id, _history_table.c.checked_at)
+
+# For prune_history().
+_history_checked_at_index = sqlalchemy.Index(
+    'idx_link_checker_history_checked_at', _history_table.c.checked_at)
+
+
+# The host names of resources' URLs, with the last time that a resource from
+# each host was given out by get_resources_to_check().
+_hosts_table = sqlalchemy.Table(
+    'link_checker_hosts', ckan.model.meta.metadata,
+    sqlalchemy.Column('host', types.UnicodeText, primary_key=True),
+    sqlalchemy.Column('last_leased', types.DateTime, nullable=False),
+)
+
+
+# A single-row table holding the broken link settings that the results' broken
+# states were computed with, see update_broken_states().
+_broken_settings_table = sqlalchemy.Table(
+    'link_checker_broken_settings', ckan.model.meta.metadata,
+    sqlalchemy.Column('min_fails', types.Integer, nullable=False),
+    sqlalchemy.Column('min_hours', types.Integer, nullable=False),
+)
+
+
+# A single-row table holding the results generation, see get_generation().
+_generation_table = sqlalchemy.Table(
+    'link_checker_results_generation', ckan.model.meta.metadata,
+    sqlalchemy.Column('generation', types.Integer, nullable=False),
+)
+
+
+_schema_version_table = sqlalchemy.Table(
+    'link_checker_schema_version', ckan.model.meta.metadata,
+    sqlalchemy.Column('version', types.Integer, nullable=False),
 )
 
 
@@ -270,6 +2111,7 @@ class _LinkCheckerResult(object):
             self.pending_since = now
         else:
             self.pending_since = None
+        self.broken = _is_broken(self.num_fails, self.last_successful, now)
 
     def as_dict(self):
         """Return a dictionary representation of this link checker result."""
@@ -299,6 +2141,7 @@ class _LinkCheckerResult(object):
             pending_since=pending_since,
             status=self.status,
             reason=self.reason,
+            broken=self.broken,
         )
 
 
@@ -19,12 +19,14 @@ class DeadOrAlivePlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IRoutes, inherit=True)
     plugins.implements(plugins.IAuthFunctions)
+    # IResourceController's create and update hooks are only called by CKAN
+    # 2.3 and later.
+    if hasattr(plugins, "IResourceController"):
+        plugins.implements(plugins.IResourceController, inherit=True)
 
     # IConfigurable
 
     def configure(self, config_):
-        results.create_database_table()
-
         # Update the class variables for the config settings with the values
         # from the config file, *if* they're in the config file.
         config.recheck_resources_after = toolkit.asint(config_.get(
@@ -46,6 +48,54 @@ class DeadOrAlivePlugin(plugins.SingletonPlugin):
             config_.get(
                 "ckanext.deadoralive.authorized_users",
                 config.authorized_users))
+        config.report_cache_ttl = toolkit.asint(
+            config_.get(
+                "ckanext.deadoralive.report_cache_ttl",
+                config.report_cache_ttl))
+        config.report_cache_size = toolkit.asint(
+            config_.get(
+                "ckanext.deadoralive.report_cache_size",
+                config.report_cache_size))
+        config.report_cache_backend = config_.get(
+            "ckanext.deadoralive.report_cache_backend",
+            config.report_cache_backend)
+        config.adaptive_recheck = toolkit.asbool(
+            config_.get(
+                "ckanext.deadoralive.adaptive_recheck",
+                config.adaptive_recheck))
+        config.adaptive_recheck_min_hours = toolkit.asint(
+            config_.get(
+                "ckanext.deadoralive.adaptive_recheck_min_hours",
+                config.adaptive_recheck_min_hours))
+        config.adaptive_recheck_max_hours = toolkit.asint(
+            config_.get(
+                "ckanext.deadoralive.adaptive_recheck_max_hours",
+                config.adaptive_recheck_max_hours))
+        config.max_resources_per_host = toolkit.asint(
+            config_.get(
+                "ckanext.deadoralive.max_resources_per_host",
+                config.max_resources_per_host))
+        config.host_cooldown = toolkit.asint(
+            config_.get(
+                "ckanext.deadoralive.host_cooldown",
+                config.host_cooldown))
+        config.deduplicate_urls = toolkit.asbool(
+            config_.get(
+                "ckanext.deadoralive.deduplicate_urls",
+                config.deduplicate_urls))
+        config.keep_history = toolkit.asbool(
+            config_.get(
+                "ckanext.deadoralive.keep_history",
+                config.keep_history))
+        config.history_retention_days = toolkit.asint(
+            config_.get(
+                "ckanext.deadoralive.history_retention_days",
+                config.history_retention_days))
+
+        # This comes after reading the config settings because migrations may
+        # need them (e.g. to work out which links are broken).
+        results.create_database_table()
+        results.update_broken_states()
 
     # IConfigurer
 
@@ -64,11 +114,15 @@ class DeadOrAlivePlugin(plugins.SingletonPlugin):
             "ckanext_deadoralive_get_resources_to_check":
                 get.get_resources_to_check,
             "ckanext_deadoralive_upsert": update.upsert,
+            "ckanext_deadoralive_upsert_many": update.upsert_many,
+            "ckanext_deadoralive_request_check": update.request_check,
             "ckanext_deadoralive_get": get.get,
+            "ckanext_deadoralive_get_many": get.get_many,
             "ckanext_deadoralive_broken_links_by_organization":
                 get.broken_links_by_organization,
             "ckanext_deadoralive_broken_links_by_email":
                 get.broken_links_by_email,
+            "ckanext_deadoralive_stats": get.stats,
         }
 
     # ITemplateHelpers
@@ -76,6 +130,8 @@ class DeadOrAlivePlugin(plugins.SingletonPlugin):
     def get_helpers(self):
         return {
             "ckanext_deadoralive_get": helpers.get_results,
+            "ckanext_deadoralive_get_for_dataset":
+                helpers.get_results_for_dataset,
         }
 
     # IRoutes
@@ -105,6 +161,25 @@ class DeadOrAlivePlugin(plugins.SingletonPlugin):
             "/deadoralive/upsert",
             controller="ckanext.deadoralive.controllers:BrokenLinksController",
             action="upsert")
+        map_.connect(
+            "/deadoralive/upsert_many",
+            controller="ckanext.deadoralive.controllers:BrokenLinksController",
+            action="upsert_many")
+        map_.connect(
+            "deadoralive_broken_links_csv",
+            "/deadoralive/broken_links.csv",
+            controller="ckanext.deadoralive.controllers:BrokenLinksController",
+            action="broken_links_csv")
+        map_.connect(
+            "deadoralive_broken_links_jsonl",
+            "/deadoralive/broken_links.jsonl",
+            controller="ckanext.deadoralive.controllers:BrokenLinksController",
+            action="broken_links_jsonl")
+        map_.connect(
+            "deadoralive_metrics",
+            "/deadoralive/metrics",
+            controller="ckanext.deadoralive.controllers:BrokenLinksController",
+            action="metrics")
 
         return map_
 
@@ -114,12 +189,42 @@ class DeadOrAlivePlugin(plugins.SingletonPlugin):
         return {
             "ckanext_deadoralive_upsert":
                 ckanext.deadoralive.logic.auth.update.upsert,
+            "ckanext_deadoralive_upsert_many":
+                ckanext.deadoralive.logic.auth.update.upsert_many,
+            "ckanext_deadoralive_request_check":
+                ckanext.deadoralive.logic.auth.update.request_check,
             "ckanext_deadoralive_get_resources_to_check":
                 ckanext.deadoralive.logic.auth.get.get_resources_to_check,
             "ckanext_deadoralive_get":
                 ckanext.deadoralive.logic.auth.get.get,
+            "ckanext_deadoralive_get_many":
+                ckanext.deadoralive.logic.auth.get.get_many,
             "ckanext_deadoralive_broken_links_by_organization":
                 ckanext.deadoralive.logic.auth.get.broken_links_by_organization,
             "ckanext_deadoralive_broken_links_by_email":
                 ckanext.deadoralive.logic.auth.get.broken_links_by_email,
+            "ckanext_deadoralive_metrics":
+                ckanext.deadoralive.logic.auth.get.metrics,
+            "ckanext_deadoralive_stats":
+                ckanext.deadoralive.logic.auth.get.stats,
         }
+
+    # IResourceController
+
+    def after_create(self, context, resource):
+        # Check new resources' links before the resources waiting for their
+        # regular checks.
+        results.request_check([resource["id"]])
+
+    def before_update(self, context, current, resource):
+        if current.get("url") != resource.get("url"):
+            context.setdefault("deadoralive_changed_urls", set()).add(
+                current["id"])
+
+    def after_update(self, context, resource):
+        # Check resources whose URLs have changed as soon as possible too,
+        # forgetting what was saved about the old URL.
+        # This is done after the update, rather than in before_update(),
+        # because request_check() commits.
+        if resource["id"] in context.get("deadoralive_changed_urls", ()):
+            results.request_check([resource["id"]], url_changed=True)
@@ -1,9 +1,14 @@
+import datetime
+import uuid
+
 import factory
 
 import ckan.model
 import ckan.new_tests.helpers as helpers
 import ckan.new_tests.factories as factories
 
+import ckanext.deadoralive.model.results as results
+
 
 # This function is copy-pasted from CKAN's master branch because we need it
 # here and it's not on CKAN's release-v2.2 branch which we're working against.
@@ -124,3 +129,117 @@ class Sysadmin(factory.Factory):
         user_dict = helpers.call_action('user_show', id=user.id,
                                         context={'user': user.name})
         return user_dict
+
+
+def bulk_create_resources(num_resources, resources_per_dataset=5,
+                          datasets_per_organization=50, num_hosts=100,
+                          chunk_size=10000):
+    """Insert lots of organizations, datasets and resources at once.
+
+    The rows are inserted directly into CKAN's database tables with executemany
+    INSERTs, which is much faster than the factories above (which go through
+    CKAN's action functions) but skips CKAN's validation, revisions, search
+    index etc. This is for benchmarks that need hundreds of thousands of
+    resources.
+
+    Each resource's URL is on one of ``num_hosts`` different hosts.
+
+    :returns: the IDs of the resources that were created
+    :rtype: list of strings
+
+    """
+    resource_table = ckan.model.resource_table
+    package_table = ckan.model.package_table
+    group_table = ckan.model.group_table
+    resource_group_table = getattr(ckan.model, "resource_group_table", None)
+    connection = ckan.model.Session.connection()
+
+    num_datasets = -(-num_resources // resources_per_dataset)
+    num_organizations = -(-num_datasets // datasets_per_organization)
+
+    organizations = []
+    for i in range(num_organizations):
+        organizations.append(dict(
+            id=unicode(uuid.uuid4()), name=u"bulk_organization_{0}".format(i),
+            title=u"Bulk Organization {0}".format(i), type=u"organization",
+            is_organization=True, approval_status=u"approved",
+            state=u"active"))
+    connection.execute(group_table.insert(), organizations)
+
+    resource_ids = []
+    for start in range(0, num_datasets, chunk_size):
+        datasets = []
+        resource_groups = []
+        resources = []
+        for i in range(start, min(start + chunk_size, num_datasets)):
+            dataset_id = unicode(uuid.uuid4())
+            datasets.append(dict(
+                id=dataset_id, name=u"bulk_dataset_{0}".format(i),
+                title=u"Bulk Dataset {0}".format(i), type=u"dataset",
+                owner_org=organizations[i // datasets_per_organization]["id"],
+                maintainer_email=u"maintainer_{0}@example.com".format(i % 10),
+                private=False, state=u"active"))
+            if resource_group_table is not None:
+                resource_group_id = unicode(uuid.uuid4())
+                resource_groups.append(dict(
+                    id=resource_group_id, package_id=dataset_id,
+                    label=u"default", state=u"active"))
+            for position in range(resources_per_dataset):
+                n = i * resources_per_dataset + position
+                if n >= num_resources:
+                    break
+                resource = dict(
+                    id=unicode(uuid.uuid4()), position=position,
+                    url=u"http://host{0}.example.com/resource/{1}".format(
+                        n % num_hosts, n),
+                    state=u"active")
+                if resource_group_table is not None:
+                    resource["resource_group_id"] = resource_group_id
+                else:
+                    resource["package_id"] = dataset_id
+                resources.append(resource)
+                resource_ids.append(resource["id"])
+        connection.execute(package_table.insert(), datasets)
+        if resource_groups:
+            connection.execute(resource_group_table.insert(), resource_groups)
+        connection.execute(resource_table.insert(), resources)
+
+    ckan.model.Session.commit()
+    return resource_ids
+
+
+def bulk_create_results(resource_ids, checked_fraction=0.8,
+                        broken_fraction=0.1, chunk_size=10000):
+    """Insert link checker results for lots of resources at once.
+
+    The first ``checked_fraction`` of the resources get results from a check
+    a week ago (so they're all due to be rechecked), ``broken_fraction`` of
+    all the resources are broken and the rest of the checked ones are working.
+    The others are left unchecked.
+
+    Like bulk_create_resources() this inserts the rows directly, and then
+    recomputes their broken states with the current settings.
+
+    """
+    table = results._link_checker_results_table
+    connection = ckan.model.Session.connection()
+    now = datetime.datetime.utcnow()
+    last_checked = now - datetime.timedelta(days=7)
+    num_checked = int(len(resource_ids) * checked_fraction)
+    num_broken = int(len(resource_ids) * broken_fraction)
+
+    for start in range(0, num_checked, chunk_size):
+        rows = []
+        for i in range(start, min(start + chunk_size, num_checked)):
+            broken = i < num_broken
+            rows.append(dict(
+                resource_id=resource_ids[i], alive=not broken,
+                last_checked=last_checked,
+                last_successful=(None if broken else last_checked),
+                num_fails=(10 if broken else 0), pending=False,
+                status=(404 if broken else 200),
+                reason=(u"Not Found" if broken else u"OK"), broken=broken))
+        connection.execute(table.insert(), rows)
+
+    ckan.model.Session.commit()
+    results.rebuild_broken_states()
@@ -6,6 +6,7 @@ import pylons.config as config
 import webtest
 
 import ckanext.deadoralive.model.results as results
+import ckanext.deadoralive.cache as cache
 import ckanext.deadoralive.logic.action.update as update
 
 
@@ -138,6 +139,9 @@ class FunctionalTestBaseClass():
         model.Session.close_all()
         model.repo.rebuild_db()
         results.create_database_table()
+        # The results generation starts again from 0 in the new database, so
+        # reports cached by previous tests would be wrongly reused.
+        cache.clear()
 
     @classmethod
     def teardown_class(cls):
@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
 """Tests for logic/action/get.py."""
-import datetime
+import nose.tools
 
 import ckan.new_tests.helpers as helpers
+import ckan.plugins.toolkit as toolkit
 import ckanext.deadoralive.tests.helpers as custom_helpers
 import ckan.new_tests.factories as factories
 import ckanext.deadoralive.tests.factories as custom_factories
 import ckanext.deadoralive.logic.action.get as get
 import ckanext.deadoralive.config as config
+import ckanext.deadoralive.model.results as results
 
 
 class TestGetResourcesToCheck(custom_helpers.FunctionalTestBaseClass):
@@ -28,6 +30,44 @@ class TestGetResourcesToCheck(custom_helpers.FunctionalTestBaseClass):
 
         assert len(resource_ids) == 3
 
+    def test_include_validators(self):
+        resource = custom_factories.Resource()
+        helpers.call_action("ckanext_deadoralive_upsert",
+                            resource_id=resource["id"], alive=True,
+                            etag='"abc"', content_length="1024")
+        helpers.call_action("ckanext_deadoralive_request_check",
+                            resource_id=resource["id"])
+
+        resources = helpers.call_action(
+            "ckanext_deadoralive_get_resources_to_check",
+            include_validators="true")
+
+        assert resources == [dict(id=resource["id"], etag='"abc"',
+                                  last_modified=None, content_length=1024,
+                                  content_hash=None)]
+
+    def test_include_urls(self):
+        resource = custom_factories.Resource(url="http://example.com/data")
+
+        resources = helpers.call_action(
+            "ckanext_deadoralive_get_resources_to_check",
+            include_urls="true")
+
+        assert resources == [dict(id=resource["id"],
+                                  url="http://example.com/data")]
+
+    def test_include_urls_and_validators(self):
+        resource = custom_factories.Resource(url="http://example.com/data")
+
+        resources = helpers.call_action(
+            "ckanext_deadoralive_get_resources_to_check",
+            include_urls=True, include_validators=True)
+
+        assert resources == [dict(id=resource["id"],
+                                  url="http://example.com/data", etag=None,
+                                  last_modified=None, content_length=None,
+                                  content_hash=None)]
+
     # TODO: Test config setting reading and defaults, test that they get
     #       passed to model.
     # TODO: Test invalid config setting (move config setting parsing into its
@@ -36,125 +76,216 @@ class TestGetResourcesToCheck(custom_helpers.FunctionalTestBaseClass):
     # TODO: Test validation.
 
 
-class TestBrokenLinksByOrganization(custom_helpers.FunctionalTestBaseClass):
+class TestGetMany(custom_helpers.FunctionalTestBaseClass):
+    """Tests for the get_many() action function."""
 
-    def test_when_there_are_no_organizations(self):
+    def test_get_many(self):
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        dataset = custom_factories.Dataset()
+        resource_1 = custom_factories.Resource(package_id=dataset["id"])
+        resource_2 = custom_factories.Resource(package_id=dataset["id"])
+        resource_3 = custom_factories.Resource(package_id=dataset["id"])
+        custom_helpers.make_broken((resource_1,), user)
+        custom_helpers.make_working((resource_2,), user)
 
-        def organization_list(context=None, data_dict=None):
-            return []
+        results = helpers.call_action(
+            "ckanext_deadoralive_get_many",
+            resource_ids=[resource_1["id"], resource_2["id"],
+                          resource_3["id"]])
 
-        def all_results():
-            return []
+        assert sorted(results.keys()) == sorted([resource_1["id"],
+                                                 resource_2["id"]])
+        assert results[resource_1["id"]]["broken"] is True
+        assert results[resource_2["id"]]["broken"] is False
 
-        def package_search(*args, **kwargs):
-            return []
+    def test_get_many_returns_the_saved_broken_state(self):
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        resource = custom_factories.Resource()
+        custom_helpers.make_broken((resource,), user)
+        original = config.broken_resource_min_fails
+        try:
+            # Changing the setting doesn't change the saved broken states
+            # until they're rebuilt (at startup, by update_broken_states()).
+            config.broken_resource_min_fails = 10
 
-        report = get._broken_links_by_organization(
-            None, organization_list, all_results, package_search)
+            results_ = helpers.call_action("ckanext_deadoralive_get_many",
+                                           resource_ids=[resource["id"]])
+            assert results_[resource["id"]]["broken"] is True
 
-        assert report == []
+            results.rebuild_broken_states()
+
+            results_ = helpers.call_action("ckanext_deadoralive_get_many",
+                                           resource_ids=[resource["id"]])
+            assert results_[resource["id"]]["broken"] is not True
+        finally:
+            config.broken_resource_min_fails = original
+
+    def test_get_many_with_comma_separated_string(self):
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        resource_1 = custom_factories.Resource()
+        resource_2 = custom_factories.Resource()
+        custom_helpers.make_working((resource_1, resource_2), user)
+
+        results = helpers.call_action(
+            "ckanext_deadoralive_get_many",
+            resource_ids=",".join([resource_1["id"], resource_2["id"]]))
 
-    def test_with_org_with_no_datasets(self):
+        assert len(results) == 2
 
-        def organization_list(context=None, data_dict=None):
-            return [{
-                "name": "test_org",
-                "image_display_url": "",
-                "description": "",
-                "packages": "",
-            }]
+    def test_get_many_with_invalid_resource_ids(self):
+        for resource_ids in ({"id": "foo"}, [1, 2], ["foo", None]):
+            nose.tools.assert_raises(
+                toolkit.ValidationError, helpers.call_action,
+                "ckanext_deadoralive_get_many", resource_ids=resource_ids)
 
-        def all_results():
-            return []
+    def test_get_many_with_too_many_resource_ids(self):
+        resource_ids = ["resource_{0}".format(i)
+                        for i in range(get.MAX_RESOURCE_IDS + 1)]
 
-        def package_search(*args, **kwargs):
-            return []
+        nose.tools.assert_raises(
+            toolkit.ValidationError, helpers.call_action,
+            "ckanext_deadoralive_get_many", resource_ids=resource_ids)
 
-        report = get._broken_links_by_organization(
-            None, organization_list, all_results, package_search)
+        assert helpers.call_action(
+            "ckanext_deadoralive_get_many",
+            resource_ids=resource_ids[:get.MAX_RESOURCE_IDS]) == {}
 
-        assert report == [], ("Organizations with no broken datasets should "
-                              "not be listed in the report.")
 
-    def test_with_dataset_with_no_resources(self):
+class TestBrokenLinksByOrganization(custom_helpers.FunctionalTestBaseClass):
 
-        def organization_list(context=None, data_dict=None):
-            return [{
-                "name": "test_org",
-                "image_display_url": "",
-                "description": "",
-                "packages": "",
-            }]
+    def _broken_link(self, resource_id, dataset_id, organization_id):
+        return {
+            "resource_id": resource_id,
+            "dataset_id": dataset_id,
+            "dataset_name": dataset_id,
+            "dataset_title": None,
+            "organization_id": organization_id,
+            "organization_name": organization_id,
+            "organization_title": None,
+            "organization_image_url": "",
+            "organization_description": "",
+        }
 
-        def all_results():
-            return []
+    def test_when_there_are_no_broken_links(self):
 
-        def package_search(*args, **kwargs):
-            return [
-                {"name": "test_dataset",
-                 "resources": [],
-                 },
-            ]
+        def count_datasets(organization_ids):
+            return {}
 
-        report = get._broken_links_by_organization(
-            None, organization_list, all_results, package_search)
+        report = get._broken_links_by_organization([], count_datasets)
 
         assert report == []
 
-    def test_organization_with_no_broken_links(self):
-
-        def organization_list(context=None, data_dict=None):
-            return [{
-                "name": "test_org",
-                "image_display_url": "",
-                "description": "",
-                "packages": "",
-            }]
-
-        def all_results():
-            now = datetime.datetime.now().isoformat()
-            results = []
-            for i in range(1, 10):
-                results.append({
-                    "resource_id": "test_resource_{0}".format(i),
-                    "alive": True,
-                    "last_checked": now,
-                    "last_successful": now,
-                    "num_fails": 0,
-                    "pending": False,
-                    "pending_since": None,
-                    "status": None,
-                    "reason": None,
-                })
-            return results
-
-        def package_search(*args, **kwargs):
-            return [
-                {"name": "test_dataset_1",
-                 "resources": [
-                     {"id": "test_resource_1"},
-                     {"id": "test_resource_2"},
-                     {"id": "test_resource_3"}
-                 ]},
-                {"name": "test_dataset_2",
-                 "resources": [
-                     {"id": "test_resource_4"},
-                     {"id": "test_resource_5"},
-                     {"id": "test_resource_6"}
-                 ]},
-                {"name": "test_dataset_3",
-                 "resources": [
-                     {"id": "test_resource_7"},
-                     {"id": "test_resource_8"},
-                     {"id": "test_resource_9"}
-                 ]}
-            ]
-
-        report = get._broken_links_by_organization(
-            None, organization_list, all_results, package_search)
+    def test_grouping_and_sorting(self):
+        """Broken links should be grouped by dataset and organization and
+        sorted most broken links first."""
+
+        def count_datasets(organization_ids):
+            assert sorted(organization_ids) == ["org_1", "org_2"]
+            return {"org_1": 5, "org_2": 2}
+
+        broken_links = [
+            self._broken_link("resource_1", "dataset_1", "org_1"),
+            self._broken_link("resource_2", "dataset_2", "org_2"),
+            self._broken_link("resource_3", "dataset_2", "org_2"),
+            self._broken_link("resource_4", "dataset_3", "org_2"),
+        ]
+
+        report = get._broken_links_by_organization(broken_links,
+                                                   count_datasets)
+
+        assert [org["name"] for org in report] == ["org_2", "org_1"]
+        assert [org["num_broken_links"] for org in report] == [3, 1]
+        assert [org["packages"] for org in report] == [2, 5]
+        assert report[0]["display_name"] == "org_2"
+        org_2_datasets = report[0]["datasets_with_broken_links"]
+        assert [dataset["name"] for dataset in org_2_datasets] == [
+            "dataset_2", "dataset_3"]
+        assert org_2_datasets[0]["num_broken_links"] == 2
+        assert org_2_datasets[0]["resources_with_broken_links"] == [
+            "resource_2", "resource_3"]
+
+    def test_private_datasets_are_not_reported(self):
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        org = factories.Organization()
+        dataset = custom_factories.Dataset(owner_org=org["id"], private=True)
+        resource = custom_factories.Resource(package_id=dataset["id"])
+        custom_helpers.make_broken((resource,), user)
+
+        report = helpers.call_action(
+            "ckanext_deadoralive_broken_links_by_organization")
 
         assert report == []
 
+    def test_organizations_with_more_than_ten_datasets(self):
+        """All of an organization's datasets should be reported, not just the
+        first page of search results."""
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        org = factories.Organization()
+        resources = []
+        for i in range(12):
+            dataset = custom_factories.Dataset(owner_org=org["id"])
+            resources.append(
+                custom_factories.Resource(package_id=dataset["id"]))
+        custom_helpers.make_broken(resources, user)
+
+        report = helpers.call_action(
+            "ckanext_deadoralive_broken_links_by_organization")
+
+        assert len(report) == 1
+        assert report[0]["num_broken_links"] == 12
+        assert len(report[0]["datasets_with_broken_links"]) == 12
+        assert report[0]["packages"] == 12
+
+    def _make_organization(self, user, num_broken_links):
+        org = factories.Organization()
+        dataset = custom_factories.Dataset(owner_org=org["id"])
+        resources = [custom_factories.Resource(package_id=dataset["id"])
+                     for i in range(num_broken_links)]
+        custom_helpers.make_broken(resources, user)
+        return org
+
+    def test_limit_and_offset(self):
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        self._make_organization(user, 3)
+        org_2 = self._make_organization(user, 2)
+        org_3 = self._make_organization(user, 1)
+
+        report = helpers.call_action(
+            "ckanext_deadoralive_broken_links_by_organization",
+            limit=2, offset=1)
+
+        assert [org["name"] for org in report] == [org_2["name"],
+                                                   org_3["name"]]
+        assert report[0]["num_broken_links"] == 2
+
+    def test_organization_and_min_broken(self):
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        org_1 = self._make_organization(user, 2)
+        org_2 = self._make_organization(user, 1)
+
+        report = helpers.call_action(
+            "ckanext_deadoralive_broken_links_by_organization",
+            organization=org_2["name"])
+        assert [org["name"] for org in report] == [org_2["name"]]
+
+        report = helpers.call_action(
+            "ckanext_deadoralive_broken_links_by_organization",
+            min_broken="2")
+        assert [org["name"] for org in report] == [org_1["name"]]
+
+    def test_invalid_limit(self):
+        nose.tools.assert_raises(
+            toolkit.ValidationError, helpers.call_action,
+            "ckanext_deadoralive_broken_links_by_organization",
+            limit="ten")
+
     def test_mix_of_broken_and_working_links(self):
         user = factories.User()
         config.authorized_users = [user["name"]]
@@ -229,6 +360,37 @@ class TestBrokenLinksByOrganization(custom_helpers.FunctionalTestBaseClass):
 class TestBrokenLinksByEmail(custom_helpers.FunctionalTestBaseClass):
     """Tests for the broken_links_by_email() API action."""
 
+    def test_group_broken_links_by_email(self):
+        """Broken links should be grouped by dataset, then by the dataset's
+        maintainer email or (if it has none) its author email."""
+        def link(resource_id, dataset_id, maintainer_email, author_email):
+            return dict(resource_id=resource_id, dataset_id=dataset_id,
+                        dataset_name=dataset_id, dataset_title=dataset_id,
+                        dataset_maintainer_email=maintainer_email,
+                        dataset_author_email=author_email)
+
+        report = get._group_broken_links_by_email([
+            link("resource_1", "dataset_1", "maintainer@test.com", None),
+            link("resource_2", "dataset_1", "maintainer@test.com", None),
+            link("resource_3", "dataset_2", None, "author@test.com"),
+            link("resource_4", "dataset_3", "maintainer@test.com",
+                 "author@test.com"),
+            link("resource_5", "dataset_4", None, None),
+        ])
+        report = dict((item["email"], item) for item in report)
+
+        assert sorted(report.keys()) == [
+            None, "author@test.com", "maintainer@test.com"]
+        maintainer = report["maintainer@test.com"]
+        assert maintainer["num_broken_links"] == 3
+        assert [dataset["name"] for dataset in
+                maintainer["datasets_with_broken_links"]] == [
+                    "dataset_1", "dataset_3"]
+        assert maintainer["datasets_with_broken_links"][0][
+            "resources_with_broken_links"] == ["resource_1", "resource_2"]
+        assert report["author@test.com"]["num_broken_links"] == 1
+        assert report[None]["num_broken_links"] == 1
+
     def test_with_no_datasets(self):
         """When there are no datasets or resources it should return []."""
         result = helpers.call_action(
@@ -428,3 +590,33 @@ class TestBrokenLinksByEmail(custom_helpers.FunctionalTestBaseClass):
         custom_helpers.make_broken((resource,), user)
 
         helpers.call_action("ckanext_deadoralive_broken_links_by_email")
+
+
+class TestStats(custom_helpers.FunctionalTestBaseClass):
+    """Tests for the stats() action function.
+
+    The counting is tested in the model tests, here we just test the stuff
+    that the action function itself does.
+
+    """
+    def test_stats(self):
+        custom_factories.Resource()
+        resource = custom_factories.Resource()
+        helpers.call_action("ckanext_deadoralive_upsert",
+                            resource_id=resource["id"], alive=True)
+
+        stats = helpers.call_action("ckanext_deadoralive_stats")
+
+        assert stats["checked"] == 1
+        assert stats["unchecked"] == 1
+        assert stats["alive"] == 1
+        assert stats["queue_depth"] == 1
+        assert stats["lag_seconds"] is None
+        assert isinstance(stats["oldest_last_checked"], basestring)
+        assert "lag" not in stats
+
+    def test_stats_with_no_resources(self):
+        stats = helpers.call_action("ckanext_deadoralive_stats")
+
+        assert stats["checked"] == 0
+        assert stats["oldest_last_checked"] is None
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 """Tests for logic/action/update.py."""
 
+import nose.tools
+
 import ckan.new_tests.helpers as helpers
+import ckan.plugins.toolkit as toolkit
 
 import ckanext.deadoralive.tests.helpers as custom_helpers
 import ckanext.deadoralive.tests.factories as factories
@@ -40,3 +43,56 @@ class TestUpsert(custom_helpers.FunctionalTestBaseClass):
         assert result["alive"] is True
         assert result["status"] == 200
         assert result["reason"] == u"Alleß ökäy!"
+
+
+class TestUpsertMany(custom_helpers.FunctionalTestBaseClass):
+
+    def test_upsert_many(self):
+        """Call upsert_many() with several results then get() each one."""
+        resource_1 = factories.Resource()
+        resource_2 = factories.Resource()
+
+        helpers.call_action(
+            "ckanext_deadoralive_upsert_many",
+            results=[
+                dict(resource_id=resource_1["id"], alive=True, status=200,
+                     reason="OK"),
+                dict(resource_id=resource_2["id"], alive=False, status=404,
+                     reason="Not Found"),
+            ])
+
+        result_1 = helpers.call_action("ckanext_deadoralive_get",
+                                       resource_id=resource_1["id"])
+        result_2 = helpers.call_action("ckanext_deadoralive_get",
+                                       resource_id=resource_2["id"])
+        assert result_1["alive"] is True
+        assert result_1["status"] == 200
+        assert result_2["alive"] is False
+        assert result_2["reason"] == "Not Found"
+
+    def test_upsert_many_with_invalid_results(self):
+        for results in (None, "foo", [{"alive": True}],
+                        [{"resource_id": "foo"}]):
+            nose.tools.assert_raises(
+                toolkit.ValidationError, helpers.call_action,
+                "ckanext_deadoralive_upsert_many", results=results)
+
+
+class TestRequestCheck(custom_helpers.FunctionalTestBaseClass):
+
+    def test_request_check(self):
+        """A requested resource should be the next resource given out."""
+        factories.Resource()
+        resource = factories.Resource()
+
+        helpers.call_action("ckanext_deadoralive_request_check",
+                            resource_id=resource["id"])
+
+        resources_to_check = helpers.call_action(
+            "ckanext_deadoralive_get_resources_to_check", n=1)
+        assert resources_to_check == [resource["id"]]
+
+    def test_request_check_with_no_resource_id(self):
+        nose.tools.assert_raises(
+            toolkit.ValidationError, helpers.call_action,
+            "ckanext_deadoralive_request_check")
@@ -48,6 +48,16 @@ class TestGet(custom_helpers.FunctionalTestBaseClass):
             assert custom_helpers.call_auth(
                 "ckanext_deadoralive_get", context=context) is True
 
+    def test_anyone_can_get_many(self):
+        user_1 = factories.User()
+        user_2 = factories.User()
+        config.authorized_users = [user_1["name"]]
+
+        for user in (user_1["name"], user_2["name"], '127.0.0.1'):
+            context = dict(user=user, model=model)
+            assert custom_helpers.call_auth(
+                "ckanext_deadoralive_get_many", context=context) is True
+
     def test_anyone_can_get_broken_links_report(self):
         user_1 = factories.User()
         user_2 = factories.User()
@@ -79,3 +89,59 @@ class TestGet(custom_helpers.FunctionalTestBaseClass):
         assert custom_helpers.call_auth(
             "ckanext_deadoralive_broken_links_by_email",
             context=context) is True
+
+
+class TestMetrics(custom_helpers.FunctionalTestBaseClass):
+
+    def test_configured_users_can_get_metrics(self):
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        context = dict(user=user["name"], model=model)
+        assert custom_helpers.call_auth(
+            "ckanext_deadoralive_metrics", context=context) is True
+
+    def test_sysadmins_can_get_metrics(self):
+        sysadmin = custom_factories.Sysadmin()
+        config.authorized_users = []
+        context = dict(user=sysadmin["name"], model=model)
+        assert custom_helpers.call_auth(
+            "ckanext_deadoralive_metrics", context=context) is True
+
+    def test_other_users_cannot_get_metrics(self):
+        user_1 = factories.User()
+        user_2 = factories.User()
+        config.authorized_users = [user_1["name"]]
+
+        for user in (user_2["name"], '127.0.0.1'):
+            context = dict(user=user, model=model)
+            nose.tools.assert_raises(
+                toolkit.NotAuthorized, custom_helpers.call_auth,
+                "ckanext_deadoralive_metrics", context=context)
+
+
+class TestStats(custom_helpers.FunctionalTestBaseClass):
+
+    def test_configured_users_can_get_stats(self):
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        context = dict(user=user["name"], model=model)
+        assert custom_helpers.call_auth(
+            "ckanext_deadoralive_stats", context=context) is True
+
+    def test_sysadmins_can_get_stats(self):
+        sysadmin = custom_factories.Sysadmin()
+        config.authorized_users = []
+        context = dict(user=sysadmin["name"], model=model)
+        assert custom_helpers.call_auth(
+            "ckanext_deadoralive_stats", context=context) is True
+
+    def test_other_users_cannot_get_stats(self):
+        user_1 = factories.User()
+        user_2 = factories.User()
+        config.authorized_users = [user_1["name"]]
+
+        for user in (user_2["name"], '127.0.0.1'):
+            context = dict(user=user, model=model)
+            nose.tools.assert_raises(
+                toolkit.NotAuthorized, custom_helpers.call_auth,
+                "ckanext_deadoralive_stats", context=context)
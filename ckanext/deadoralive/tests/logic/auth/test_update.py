@@ -5,6 +5,7 @@ import ckan.new_tests.factories as factories
 import ckan.plugins.toolkit as toolkit
 import ckanext.deadoralive.config as config
 import ckanext.deadoralive.tests.helpers as custom_helpers
+import ckanext.deadoralive.tests.factories as custom_factories
 
 
 class TestUpsert(custom_helpers.FunctionalTestBaseClass):
@@ -32,3 +33,57 @@ class TestUpsert(custom_helpers.FunctionalTestBaseClass):
         nose.tools.assert_raises(toolkit.NotAuthorized,
                                  custom_helpers.call_auth,
                                  "ckanext_deadoralive_upsert", context=context)
+
+
+class TestUpsertMany(custom_helpers.FunctionalTestBaseClass):
+
+    def test_configured_users_can_upsert_many(self):
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        context = dict(user=user["name"], model=model)
+        assert custom_helpers.call_auth(
+            "ckanext_deadoralive_upsert_many", context=context) is True
+
+    def test_other_users_cannot_upsert_many(self):
+        user_1 = factories.User()
+        user_2 = factories.User()
+        config.authorized_users = [user_1["name"]]
+        context = dict(user=user_2["name"], model=model)
+        nose.tools.assert_raises(toolkit.NotAuthorized,
+                                 custom_helpers.call_auth,
+                                 "ckanext_deadoralive_upsert_many",
+                                 context=context)
+
+
+class TestRequestCheck(custom_helpers.FunctionalTestBaseClass):
+
+    def test_configured_users_can_request_checks(self):
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        resource = custom_factories.Resource()
+        context = dict(user=user["name"], model=model)
+        assert custom_helpers.call_auth(
+            "ckanext_deadoralive_request_check", context=context,
+            resource_id=resource["id"]) is True
+
+    def test_editors_can_request_checks(self):
+        user = factories.User()
+        organization = factories.Organization(
+            users=[{"name": user["name"], "capacity": "editor"}])
+        dataset = custom_factories.Dataset(owner_org=organization["id"])
+        resource = custom_factories.Resource(package_id=dataset["id"])
+        context = dict(user=user["name"], model=model)
+        assert custom_helpers.call_auth(
+            "ckanext_deadoralive_request_check", context=context,
+            resource_id=resource["id"]) is True
+
+    def test_other_users_cannot_request_checks(self):
+        user = factories.User()
+        organization = factories.Organization()
+        dataset = custom_factories.Dataset(owner_org=organization["id"])
+        resource = custom_factories.Resource(package_id=dataset["id"])
+        context = dict(user=user["name"], model=model)
+        nose.tools.assert_raises(toolkit.NotAuthorized,
+                                 custom_helpers.call_auth,
+                                 "ckanext_deadoralive_request_check",
+                                 context=context, resource_id=resource["id"])
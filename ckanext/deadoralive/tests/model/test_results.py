@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 """Tests for model/results.py."""
 import datetime
+import threading
 
 import nose.tools
+import pylons.config
+import sqlalchemy.engine.reflection
 
+import ckan.model
+import ckan.new_tests.factories as ckan_factories
 import ckan.new_tests.helpers as helpers
 
+import ckanext.deadoralive.config as config
 import ckanext.deadoralive.model.results as results
 import ckanext.deadoralive.tests.factories as factories
 
@@ -14,6 +20,82 @@ def strptime(datetime_string):
     return datetime.datetime.strptime(datetime_string, "%Y-%m-%dT%H:%M:%S.%f")
 
 
+def _index_names():
+    inspector = sqlalchemy.engine.reflection.Inspector.from_engine(
+        ckan.model.meta.metadata.bind)
+    return [index["name"]
+            for index in inspector.get_indexes("link_checker_results")]
+
+
+class TestCreateDatabaseTable(object):
+    """Tests for the create_database_table() function."""
+
+    def setup(self):
+        helpers.reset_db()
+
+    def test_it_creates_the_indexes(self):
+        results.create_database_table()
+
+        for index in (results._pending_last_checked_index,
+                      results._pending_since_index, results._failing_index):
+            assert index.name in _index_names()
+
+    def test_it_records_the_schema_version(self):
+        results.create_database_table()
+
+        version = ckan.model.Session.execute(
+            "SELECT version FROM link_checker_schema_version").scalar()
+        assert version == len(results._MIGRATIONS)
+
+    def test_it_can_be_run_more_than_once(self):
+        results.create_database_table()
+        results.create_database_table()
+
+        num_rows = ckan.model.Session.execute(
+            "SELECT count(*) FROM link_checker_schema_version").scalar()
+        assert num_rows == 1
+
+    def test_it_migrates_a_table_with_no_indexes(self):
+        """Tables created by older versions of the extension, which have no
+        indexes and no schema version, should get the indexes added."""
+        results.create_database_table()
+        for index in (results._pending_last_checked_index,
+                      results._pending_since_index, results._failing_index):
+            index.drop(bind=ckan.model.meta.metadata.bind)
+        results._schema_version_table.drop(bind=ckan.model.meta.metadata.bind)
+
+        results.create_database_table()
+
+        for index in (results._pending_last_checked_index,
+                      results._pending_since_index, results._failing_index):
+            assert index.name in _index_names()
+
+    def test_it_seeds_the_generation_row(self):
+        results.create_database_table()
+
+        num_rows = ckan.model.Session.execute(
+            "SELECT count(*) FROM link_checker_results_generation").scalar()
+        assert num_rows == 1
+        assert results.get_generation() == 0
+
+    def test_it_merges_duplicate_generation_rows(self):
+        """Databases where the first bumps of the generation raced each other
+        and inserted two rows should end up with one row."""
+        results.create_database_table()
+        ckan.model.Session.execute(results._generation_table.insert(),
+                                   dict(generation=5))
+        ckan.model.Session.execute(
+            "UPDATE link_checker_schema_version SET version = 10")
+        ckan.model.Session.commit()
+
+        results.create_database_table()
+
+        num_rows = ckan.model.Session.execute(
+            "SELECT count(*) FROM link_checker_results_generation").scalar()
+        assert num_rows == 1
+        assert results.get_generation() == 5
+
+
 class TestUpsertAndGet(object):
     """Tests for the upsert() and get() functions."""
     def setup(self):
@@ -299,6 +381,589 @@ class TestUpsertAndGet(object):
         assert result["reason"] == "Unauthorized"
 
 
+class TestUpsertMany(object):
+    """Tests for the upsert_many() function."""
+
+    def setup(self):
+        results.create_database_table()
+        helpers.reset_db()
+
+    def test_with_no_results(self):
+        results.upsert_many([])
+        assert results.all() == []
+
+    def test_insert_and_update_many(self):
+        """New results should be inserted and existing ones updated."""
+        results.upsert("test_resource_1", True)
+
+        results.upsert_many([
+            dict(resource_id="test_resource_1", alive=False, status=500,
+                 reason="Internal Server Error"),
+            dict(resource_id="test_resource_2", alive=True, status=200,
+                 reason="OK"),
+            dict(resource_id="test_resource_3", alive=False),
+        ])
+
+        result_1 = results.get("test_resource_1")
+        assert result_1["alive"] is False
+        assert result_1["num_fails"] == 1
+        assert result_1["last_successful"] is not None
+        assert result_1["status"] == 500
+        assert result_1["reason"] == "Internal Server Error"
+
+        result_2 = results.get("test_resource_2")
+        assert result_2["alive"] is True
+        assert result_2["num_fails"] == 0
+        assert result_2["status"] == 200
+
+        result_3 = results.get("test_resource_3")
+        assert result_3["alive"] is False
+        assert result_3["num_fails"] == 1
+        assert result_3["last_successful"] is None
+
+    def test_many_results_for_the_same_resource(self):
+        """Several results for one resource should be applied in order."""
+        results.upsert_many([
+            dict(resource_id="test_resource_id", alive=False),
+            dict(resource_id="test_resource_id", alive=False),
+            dict(resource_id="test_resource_id", alive=False, status=404),
+        ])
+
+        result = results.get("test_resource_id")
+        assert result["num_fails"] == 3
+        assert result["status"] == 404
+
+    def test_it_resets_pending(self):
+        results._make_pending(["test_resource_1", "test_resource_2"])
+
+        results.upsert_many([
+            dict(resource_id="test_resource_1", alive=True),
+            dict(resource_id="test_resource_2", alive=False),
+        ])
+
+        for resource_id in ("test_resource_1", "test_resource_2"):
+            result = results.get(resource_id)
+            assert result["pending"] is False
+            assert result["pending_since"] is None
+
+
+class TestHistory(object):
+    """Tests for the link check history."""
+
+    def setup(self):
+        helpers.reset_db()
+        results.create_database_table()
+        self.original_keep_history = config.keep_history
+        config.keep_history = True
+
+    def teardown(self):
+        config.keep_history = self.original_keep_history
+
+    def test_upsert_appends_to_the_history(self):
+        results.upsert("test_resource_1", True, status=200, reason="OK")
+        results.upsert("test_resource_1", False, status=404,
+                       reason="Not Found")
+        results.upsert("test_resource_2", False, status=404,
+                       reason="Not Found")
+
+        history = results.get_history("test_resource_1")
+
+        assert [(check["alive"], check["status"], check["reason"])
+                for check in history] == [
+                    (True, 200, "OK"), (False, 404, "Not Found")]
+        assert history[0]["checked_at"] <= history[1]["checked_at"]
+
+    def test_reasons_are_only_stored_once(self):
+        results.upsert_many([
+            dict(resource_id="test_resource_1", alive=False,
+                 reason="Not Found"),
+            dict(resource_id="test_resource_2", alive=False,
+                 reason="Not Found"),
+        ])
+        results.upsert("test_resource_3", False, reason="Not Found")
+
+        num_reasons = ckan.model.Session.execute(
+            "SELECT count(*) FROM link_checker_reasons").scalar()
+        assert num_reasons == 1
+        assert len(results.get_history("test_resource_3")) == 1
+
+    def test_no_history_when_turned_off(self):
+        config.keep_history = False
+
+        results.upsert("test_resource_1", True)
+
+        assert results.get_history("test_resource_1") == []
+
+    def test_prune_history(self):
+        long_ago = datetime.datetime.utcnow() - datetime.timedelta(days=40)
+        results.upsert("test_resource_1", False, last_checked=long_ago)
+        results.upsert("test_resource_1", True)
+
+        assert results.prune_history(retention_days=30) == 1
+
+        history = results.get_history("test_resource_1")
+        assert [check["alive"] for check in history] == [True]
+
+
+class TestValidators(object):
+    """Tests for saving and getting resources' HTTP validators."""
+
+    def setup(self):
+        helpers.reset_db()
+        results.create_database_table()
+
+    def test_validators_are_saved_and_kept(self):
+        """Validators should be saved, and kept by later results that don't
+        have them."""
+        results.upsert("test_resource", True, etag='"abc"',
+                       last_modified="Wed, 21 Oct 2015 07:28:00 GMT",
+                       content_length=5 * 1024 ** 3, content_hash="sha1:123")
+        results.upsert("test_resource", True, status=304)
+
+        assert results.get_validators(["test_resource"]) == [dict(
+            id="test_resource", etag='"abc"',
+            last_modified="Wed, 21 Oct 2015 07:28:00 GMT",
+            content_length=5 * 1024 ** 3, content_hash="sha1:123")]
+
+    def test_get_validators_for_resources_without_results(self):
+        results.upsert("test_resource_2", True, etag='"abc"')
+
+        validators = results.get_validators(["test_resource_1",
+                                             "test_resource_2"])
+
+        assert [v["id"] for v in validators] == ["test_resource_1",
+                                                 "test_resource_2"]
+        assert validators[0]["etag"] is None
+        assert validators[1]["etag"] == '"abc"'
+
+    def test_request_check_for_a_changed_url_clears_validators(self):
+        results.upsert("test_resource", True, etag='"abc"')
+
+        results.request_check(["test_resource"], url_changed=True)
+
+        assert results.get_validators(["test_resource"])[0]["etag"] is None
+
+
+class TestGetMany(object):
+    """Tests for the get_many() function."""
+
+    def setup(self):
+        results.create_database_table()
+        helpers.reset_db()
+
+    def test_with_no_resource_ids(self):
+        assert results.get_many([]) == {}
+
+    def test_get_many(self):
+        results.upsert("test_resource_1", True, status=200)
+        results.upsert("test_resource_2", False, status=404)
+        results.upsert("test_resource_3", True)
+
+        results_ = results.get_many(
+            ["test_resource_1", "test_resource_2", "no_such_resource"])
+
+        assert sorted(results_.keys()) == ["test_resource_1",
+                                           "test_resource_2"]
+        assert results_["test_resource_1"]["status"] == 200
+        assert results_["test_resource_2"]["status"] == 404
+        assert results_["test_resource_2"]["alive"] is False
+
+
+class TestGetBrokenLinks(object):
+    """Tests for the get_broken_links() function."""
+
+    def setup(self):
+        helpers.reset_db()
+        results.create_database_table()
+
+    def _fail(self, resource_id, times):
+        for i in range(times):
+            results.upsert(resource_id, False)
+
+    def test_broken_link_rule(self):
+        """Only links that have failed enough times over a long enough period
+        should be returned."""
+        org = ckan_factories.Organization()
+        dataset = factories.Dataset(owner_org=org["id"])
+        never_worked = factories.Resource(package_id=dataset["id"])["id"]
+        recently_worked = factories.Resource(package_id=dataset["id"])["id"]
+        not_enough_fails = factories.Resource(package_id=dataset["id"])["id"]
+        working = factories.Resource(package_id=dataset["id"])["id"]
+
+        self._fail(never_worked, 3)
+        results.upsert(recently_worked, True)
+        self._fail(recently_worked, 3)
+        self._fail(not_enough_fails, 2)
+        results.upsert(working, True)
+
+        broken_links = list(
+            results.get_broken_links())
+
+        assert [link["resource_id"] for link in broken_links] == [
+            never_worked]
+        link = broken_links[0]
+        assert link["dataset_id"] == dataset["id"]
+        assert link["dataset_name"] == dataset["name"]
+        assert link["organization_id"] == org["id"]
+        assert link["organization_name"] == org["name"]
+
+    def test_include_results(self):
+        dataset = factories.Dataset()
+        resource = factories.Resource(package_id=dataset["id"],
+                                      url="http://example.com/broken")
+        for i in range(3):
+            results.upsert(resource["id"], False, status=404,
+                           reason="Not Found")
+
+        link, = results.get_broken_links(include_results=True)
+
+        assert link["url"] == "http://example.com/broken"
+        assert link["status"] == 404
+        assert link["reason"] == "Not Found"
+        assert link["num_fails"] == 3
+        assert link["last_successful"] is None
+        assert isinstance(link["last_checked"], datetime.datetime)
+
+    def test_include_results_of_an_uploaded_resource(self):
+        """An uploaded resource's URL should be the download URL that
+        resource_show returns, not the filename saved in the database."""
+        dataset = factories.Dataset()
+        resource = factories.Resource(package_id=dataset["id"])
+        ckan.model.Session.execute(
+            "UPDATE resource SET url = 'data.csv', url_type = 'upload' "
+            "WHERE id = :id", {"id": resource["id"]})
+        ckan.model.Session.commit()
+        self._fail(resource["id"], 3)
+
+        link, = results.get_broken_links(include_results=True)
+
+        assert link["url"] == (
+            u"{0}/dataset/{1}/resource/{2}/download/data.csv".format(
+                pylons.config["ckan.site_url"].rstrip("/"), dataset["id"],
+                resource["id"]))
+        assert "url_type" not in link
+
+    def test_results_are_not_included_by_default(self):
+        resource = factories.Resource()["id"]
+        self._fail(resource, 3)
+
+        link, = results.get_broken_links()
+
+        assert "url" not in link
+        assert "status" not in link
+
+    def test_with_min_hours_0(self):
+        org = ckan_factories.Organization()
+        dataset = factories.Dataset(owner_org=org["id"])
+        resource = factories.Resource(package_id=dataset["id"])["id"]
+        original_min_hours = config.broken_resource_min_hours
+        config.broken_resource_min_hours = 0
+        try:
+            results.upsert(resource, True)
+            self._fail(resource, 3)
+            broken_links = list(results.get_broken_links())
+        finally:
+            config.broken_resource_min_hours = original_min_hours
+
+        assert [link["resource_id"] for link in broken_links] == [resource]
+
+    def test_datasets_without_organizations(self):
+        """Datasets with no organization should only be returned when
+        organizations_only is False."""
+        dataset = factories.Dataset(maintainer_email="test@test.com")
+        resource = factories.Resource(package_id=dataset["id"])["id"]
+        self._fail(resource, 3)
+
+        broken_links = list(
+            results.get_broken_links())
+        assert [link["resource_id"] for link in broken_links] == [resource]
+        assert broken_links[0]["organization_id"] is None
+        assert broken_links[0]["dataset_maintainer_email"] == "test@test.com"
+
+        assert list(results.get_broken_links(organizations_only=True)) == []
+
+    def test_count_datasets(self):
+        org_1 = ckan_factories.Organization()
+        org_2 = ckan_factories.Organization()
+        factories.Dataset(owner_org=org_1["id"])
+        factories.Dataset(owner_org=org_1["id"])
+        factories.Dataset(owner_org=org_2["id"])
+
+        assert results.count_datasets([org_1["id"], org_2["id"]]) == {
+            org_1["id"]: 2, org_2["id"]: 1}
+
+    def test_filtering_by_organization_ids(self):
+        org_1 = ckan_factories.Organization()
+        org_2 = ckan_factories.Organization()
+        resource_1 = factories.Resource(
+            package_id=factories.Dataset(owner_org=org_1["id"])["id"])["id"]
+        resource_2 = factories.Resource(
+            package_id=factories.Dataset(owner_org=org_2["id"])["id"])["id"]
+        self._fail(resource_1, 3)
+        self._fail(resource_2, 3)
+
+        broken_links = list(
+            results.get_broken_links(organization_ids=[org_2["id"]]))
+
+        assert [link["resource_id"] for link in broken_links] == [resource_2]
+        assert list(results.get_broken_links(organization_ids=[])) == []
+
+
+class TestCountBrokenLinksByOrganization(object):
+    """Tests for the count_broken_links_by_organization() function."""
+
+    def setup(self):
+        helpers.reset_db()
+        results.create_database_table()
+
+    def _make_organization(self, name, num_broken_links):
+        org = ckan_factories.Organization(name=name)
+        dataset = factories.Dataset(owner_org=org["id"])
+        for i in range(num_broken_links):
+            resource_id = factories.Resource(package_id=dataset["id"])["id"]
+            for j in range(3):
+                results.upsert(resource_id, False)
+        return org["id"]
+
+    def test_sorting(self):
+        """Organizations should be sorted most broken links first, then by
+        name."""
+        org_b = self._make_organization("org-b", 1)
+        org_a = self._make_organization("org-a", 1)
+        org_c = self._make_organization("org-c", 2)
+
+        assert results.count_broken_links_by_organization() == [
+            (org_c, 2), (org_a, 1), (org_b, 1)]
+
+    def test_limit_and_offset(self):
+        org_a = self._make_organization("org-a", 3)
+        org_b = self._make_organization("org-b", 2)
+        self._make_organization("org-c", 1)
+
+        assert results.count_broken_links_by_organization(
+            limit=1, offset=1) == [(org_b, 2)]
+        assert results.count_broken_links_by_organization(limit=1) == [
+            (org_a, 3)]
+
+    def test_min_broken(self):
+        org_a = self._make_organization("org-a", 2)
+        self._make_organization("org-b", 1)
+
+        assert results.count_broken_links_by_organization(min_broken=2) == [
+            (org_a, 2)]
+
+    def test_organization(self):
+        self._make_organization("org-a", 2)
+        org_b = self._make_organization("org-b", 1)
+
+        assert results.count_broken_links_by_organization(
+            organization="org-b") == [(org_b, 1)]
+        assert results.count_broken_links_by_organization(
+            organization=org_b) == [(org_b, 1)]
+
+
+class TestGetStats(object):
+    """Tests for the get_stats() function."""
+
+    def setup(self):
+        helpers.reset_db()
+        results.create_database_table()
+        self.since = datetime.timedelta(hours=48)
+        self.pending_since = datetime.timedelta(hours=2)
+
+    def _get_stats(self):
+        return results.get_stats(since=self.since,
+                                 pending_since=self.pending_since)
+
+    def test_with_no_resources(self):
+        stats = self._get_stats()
+
+        assert stats == dict(checked=0, unchecked=0, pending=0, alive=0,
+                             dead=0, broken=0, requested=0, queue_depth=0,
+                             oldest_last_checked=None, lag=None)
+
+    def test_counts(self):
+        factories.Resource()
+        working = factories.Resource()
+        results.upsert(working["id"], True)
+        broken = factories.Resource()
+        for _ in range(3):
+            results.upsert(broken["id"], False)
+        pending = factories.Resource()
+        results.upsert(pending["id"], True)
+        results._make_pending([pending["id"]])
+
+        stats = self._get_stats()
+
+        assert stats["checked"] == 3
+        assert stats["unchecked"] == 1
+        assert stats["pending"] == 1
+        assert stats["alive"] == 2
+        assert stats["dead"] == 1
+        assert stats["broken"] == 1
+        assert stats["requested"] == 0
+        # Only the unchecked resource is due to be checked.
+        assert stats["queue_depth"] == 1
+        assert stats["lag"] is None
+
+    def test_leased_resources_that_were_never_checked(self):
+        """Resources that have been given out to a link checker but whose
+        results haven't come back yet have still never been checked."""
+        resource = factories.Resource()
+        assert results.get_resources_to_check(10) == [resource["id"]]
+
+        stats = self._get_stats()
+
+        assert stats["checked"] == 0
+        assert stats["unchecked"] == 1
+        assert stats["pending"] == 1
+        assert stats["queue_depth"] == 0
+
+    def test_requested_resources_that_were_never_checked(self):
+        resource = factories.Resource()
+        results.request_check([resource["id"]])
+
+        stats = self._get_stats()
+
+        assert stats["checked"] == 0
+        assert stats["unchecked"] == 1
+        assert stats["requested"] == 1
+        assert stats["queue_depth"] == 1
+
+    def test_stale_resources_are_queued(self):
+        now = datetime.datetime.utcnow()
+        three_days_ago = now - datetime.timedelta(days=3)
+        one_day_ago = now - datetime.timedelta(days=1)
+        stale = factories.Resource()
+        results.upsert(stale["id"], True, last_checked=three_days_ago)
+        recent = factories.Resource()
+        results.upsert(recent["id"], True, last_checked=one_day_ago)
+
+        stats = self._get_stats()
+
+        assert stats["queue_depth"] == 1
+        assert stats["oldest_last_checked"] == three_days_ago
+        # The stale resource has been due since 48 hours after it was checked.
+        lag_hours = stats["lag"].total_seconds() / 3600
+        assert 23.9 < lag_hours < 24.1
+
+    def test_requested_resources_are_queued(self):
+        resource = factories.Resource()
+        results.upsert(resource["id"], True)
+        results.request_check([resource["id"]])
+
+        stats = self._get_stats()
+
+        assert stats["requested"] == 1
+        assert stats["queue_depth"] == 1
+        assert stats["lag"] >= datetime.timedelta(0)
+
+    def test_expired_pending_resources_are_queued(self):
+        resource = factories.Resource()
+        results.upsert(resource["id"], True)
+        results._make_pending(
+            [resource["id"]],
+            pending_since=datetime.datetime.utcnow() -
+            datetime.timedelta(hours=3))
+
+        stats = self._get_stats()
+
+        assert stats["pending"] == 1
+        assert stats["queue_depth"] == 1
+        lag_hours = stats["lag"].total_seconds() / 3600
+        assert 0.9 < lag_hours < 1.1
+
+
+class TestBrokenStates(object):
+    """Tests for the saved broken states."""
+
+    def setup(self):
+        helpers.reset_db()
+        results.create_database_table()
+
+    def _fail(self, resource_id, times):
+        for i in range(times):
+            results.upsert(resource_id, False)
+
+    def test_broken_state_is_saved(self):
+        results._make_pending(["test_resource_1"])
+        assert results.get("test_resource_1")["broken"] is None
+
+        results.upsert("test_resource_2", True)
+        assert results.get("test_resource_2")["broken"] is False
+
+        self._fail("test_resource_3", 3)
+        assert results.get("test_resource_3")["broken"] is True
+
+        results.upsert("test_resource_3", True)
+        assert results.get("test_resource_3")["broken"] is False
+
+    def test_counts_when_links_break_and_get_fixed(self):
+        org = ckan_factories.Organization()
+        dataset_1 = factories.Dataset(owner_org=org["id"])
+        dataset_2 = factories.Dataset(owner_org=org["id"])
+        resource_1 = factories.Resource(package_id=dataset_1["id"])["id"]
+        resource_2 = factories.Resource(package_id=dataset_1["id"])["id"]
+        resource_3 = factories.Resource(package_id=dataset_2["id"])["id"]
+
+        for resource_id in (resource_1, resource_2, resource_3):
+            self._fail(resource_id, 3)
+
+        assert results.count_broken_links_by_organization() == [
+            (org["id"], 3)]
+
+        # More failed checks of already-broken links don't change the counts.
+        self._fail(resource_1, 1)
+        results.upsert(resource_3, True)
+
+        assert results.count_broken_links_by_organization() == [
+            (org["id"], 2)]
+
+    def test_rebuild_broken_states(self):
+        """Rebuilding should apply changed broken link settings to all the
+        existing results."""
+        org = ckan_factories.Organization()
+        dataset = factories.Dataset(owner_org=org["id"])
+        resource_1 = factories.Resource(package_id=dataset["id"])["id"]
+        resource_2 = factories.Resource(package_id=dataset["id"])["id"]
+        self._fail(resource_1, 3)
+        self._fail(resource_2, 2)
+
+        original_min_fails = config.broken_resource_min_fails
+        config.broken_resource_min_fails = 2
+        try:
+            results.rebuild_broken_states()
+        finally:
+            config.broken_resource_min_fails = original_min_fails
+
+        assert results.get(resource_2)["broken"] is True
+        assert results.count_broken_links_by_organization() == [
+            (org["id"], 2)]
+
+    def test_update_broken_states_when_the_settings_change(self):
+        """update_broken_states() should rebuild the broken states only when
+        the settings are different from the ones they were computed with."""
+        self._fail("test_resource_1", 2)
+        # The settings have never been saved.
+        assert results.update_broken_states() is True
+        assert results.update_broken_states() is False
+        assert results.get("test_resource_1")["broken"] is False
+
+        original_min_fails = config.broken_resource_min_fails
+        config.broken_resource_min_fails = 2
+        try:
+            generation = results.get_generation()
+            assert results.update_broken_states() is True
+            assert results.get("test_resource_1")["broken"] is True
+            assert results.get_generation() > generation
+            assert results.update_broken_states() is False
+        finally:
+            config.broken_resource_min_fails = original_min_fails
+
+        assert results.update_broken_states() is True
+        assert results.get("test_resource_1")["broken"] is False
+
+
 class TestGetResourcesToCheck(object):
     """Tests for the get_resources_to_check() function."""
 
@@ -521,6 +1186,30 @@ class TestGetResourcesToCheck(object):
         assert resources_to_check == [resource_1, resource_2, resource_3,
                                       resource_4, resource_5]
 
+    def test_that_it_orders_and_limits_across_all_kinds_of_resource(self):
+        """Never-checked resources should come first, then resources that
+        weren't checked recently, then resources with expired pending checks,
+        and only ``n`` resources should be returned in total."""
+        now = datetime.datetime.utcnow()
+
+        expired_1 = factories.Resource()['id']
+        expired_2 = factories.Resource()['id']
+        results._make_pending([expired_1, expired_2],
+                              now - datetime.timedelta(hours=5))
+        stale_1 = factories.Resource()['id']
+        stale_2 = factories.Resource()['id']
+        results.upsert(stale_2, True,
+                       last_checked=now - datetime.timedelta(hours=40))
+        results.upsert(stale_1, True,
+                       last_checked=now - datetime.timedelta(hours=30))
+        unchecked_1 = factories.Resource()['id']
+        unchecked_2 = factories.Resource()['id']
+
+        resources_to_check = results.get_resources_to_check(5)
+
+        assert resources_to_check == [unchecked_1, unchecked_2, stale_2,
+                                      stale_1, expired_1]
+
     def test_that_it_creates_pending_checks(self):
         """get_resources_to_check() should create pending link checker results
         for all the resources it returns."""
@@ -546,6 +1235,30 @@ class TestGetResourcesToCheck(object):
             result = results.get(resource)
             assert result["pending"] is True
 
+    def test_concurrent_calls_get_disjoint_batches(self):
+        """Link checkers polling at the same time should never be given the
+        same resources."""
+        import ckan.model
+
+        resource_ids = [factories.Resource()['id'] for i in range(20)]
+        batches = []
+
+        def get_batch():
+            try:
+                batches.append(results.get_resources_to_check(5))
+            finally:
+                ckan.model.Session.remove()
+
+        threads = [threading.Thread(target=get_batch) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        returned = [resource_id for batch in batches for resource_id in batch]
+        assert len(batches) == 4
+        assert sorted(returned) == sorted(resource_ids)
+
     def test_custom_shorter_since(self):
         """If given a shorter ``since`` time it should return resources that
         have been checked more recently."""
@@ -600,6 +1313,349 @@ class TestGetResourcesToCheck(object):
 
         assert results_ == []
 
+    def test_requested_resources_are_returned_first(self):
+        """Requested resources should be returned before unchecked ones,
+        however recently they were checked, until their next result."""
+        factories.Resource()
+        resource = factories.Resource()["id"]
+        results.upsert(resource, True)
+
+        results.request_check([resource])
+        first = results.get_resources_to_check(1)
+        results.upsert(resource, True)
+        second = results.get_resources_to_check(10)
+
+        assert first == [resource]
+        assert resource not in second
+
+    def test_request_check_while_pending_is_kept(self):
+        """A check requested while the resource is pending (e.g. because
+        its URL changed) shouldn't be lost when the pending check's result,
+        which may be of the old URL, comes back."""
+        factories.Resource()
+        resource = factories.Resource()["id"]
+        results.upsert(resource, True)
+        results.request_check([resource])
+        assert results.get_resources_to_check(1) == [resource]
+
+        results.request_check([resource], url_changed=True)
+        results.upsert(resource, True, etag='"old"')
+
+        assert results.get_validators([resource])[0]["etag"] is None
+        assert results.get_resources_to_check(1) == [resource]
+
+        results.upsert(resource, True, etag='"new"')
+
+        assert results.get_validators([resource])[0]["etag"] == '"new"'
+        assert resource not in results.get_resources_to_check(10)
+
+    def test_request_check_for_an_unchecked_resource(self):
+        factories.Resource()
+        resource = factories.Resource()["id"]
+
+        results.request_check([resource])
+
+        assert results.get_resources_to_check(10)[0] == resource
+
+    def test_include_urls(self):
+        resource_1 = factories.Resource(url="http://a.example.com/1")["id"]
+        resource_2 = factories.Resource(url="http://a.example.com/2")["id"]
+
+        resources = results.get_resources_to_check(10, include_urls=True)
+
+        assert resources == [
+            dict(id=resource_1, url="http://a.example.com/1"),
+            dict(id=resource_2, url="http://a.example.com/2")]
+
+    def test_include_urls_of_uploaded_resources(self):
+        """Uploaded resources should get the download URL that
+        resource_show returns, not the filename saved in the database."""
+        resource = factories.Resource()
+        ckan.model.Session.execute(
+            "UPDATE resource SET url = 'data.csv', url_type = 'upload' "
+            "WHERE id = :id", {"id": resource["id"]})
+        ckan.model.Session.commit()
+
+        resources = results.get_resources_to_check(10, include_urls=True)
+
+        url = u"{0}/dataset/{1}/resource/{2}/download/data.csv".format(
+            pylons.config["ckan.site_url"].rstrip("/"),
+            resource["package_id"], resource["id"])
+        assert resources == [dict(id=resource["id"], url=url)]
+        assert self._get_host(resource["id"]) == results.get_host(url)
+
+    def test_include_urls_without_a_scheme(self):
+        resource = factories.Resource()["id"]
+        ckan.model.Session.execute(
+            "UPDATE resource SET url = 'a.example.com/data.csv' "
+            "WHERE id = :id", {"id": resource})
+        ckan.model.Session.commit()
+
+        resources = results.get_resources_to_check(10, include_urls=True)
+
+        assert resources == [
+            dict(id=resource, url="http://a.example.com/data.csv")]
+        assert self._get_host(resource) == "a.example.com"
+
+    def test_interleave_by_host(self):
+        candidates = [("a_1", "a"), ("a_2", "a"), ("a_3", "a"), ("b_1", "b"),
+                      ("c_1", "c"), ("b_2", "b")]
+
+        assert results._interleave_by_host(candidates, 10, 0) == [
+            "a_1", "b_1", "c_1", "a_2", "b_2", "a_3"]
+        assert results._interleave_by_host(candidates, 4, 0) == [
+            "a_1", "b_1", "c_1", "a_2"]
+        assert results._interleave_by_host(candidates, 10, 1) == [
+            "a_1", "b_1", "c_1"]
+
+    def test_interleave_by_host_does_not_limit_resources_with_no_host(self):
+        candidates = [("x_1", None), ("x_2", None), ("a_1", "a"),
+                      ("a_2", "a"), ("x_3", None)]
+
+        assert results._interleave_by_host(candidates, 10, 1) == [
+            "x_1", "a_1", "x_2", "x_3"]
+
+    def test_resources_are_interleaved_by_host(self):
+        """Resources should be returned taking one from each host in turn."""
+        a_1 = factories.Resource(url="http://a.example.com/1")["id"]
+        a_2 = factories.Resource(url="http://A.example.com/2")["id"]
+        b_1 = factories.Resource(url="http://b.example.com/1")["id"]
+
+        results_ = results.get_resources_to_check(10)
+
+        assert results_ == [a_1, b_1, a_2]
+
+    def test_max_per_host(self):
+        a_1 = factories.Resource(url="http://a.example.com/1")["id"]
+        factories.Resource(url="http://a.example.com/2")
+        b_1 = factories.Resource(url="http://b.example.com/1")["id"]
+
+        results_ = results.get_resources_to_check(10, max_per_host=1)
+
+        assert results_ == [a_1, b_1]
+
+    def test_host_cooldown(self):
+        """Resources from a host that was just given out shouldn't be given
+        out again until the cooldown has passed."""
+        factories.Resource(url="http://a.example.com/1")
+        factories.Resource(url="http://a.example.com/2")
+        b_1 = factories.Resource(url="http://b.example.com/1")["id"]
+        cooldown = datetime.timedelta(minutes=5)
+
+        first = results.get_resources_to_check(1, host_cooldown=cooldown)
+        second = results.get_resources_to_check(10, host_cooldown=cooldown)
+
+        assert len(first) == 1
+        assert second == [b_1]
+
+    def test_max_per_host_fills_the_batch_from_other_hosts(self):
+        """The per-host limit shouldn't shrink the batch when the oldest
+        resources are all on the same host."""
+        a_1 = factories.Resource(url="http://a.example.com/1")["id"]
+        for i in range(10):
+            factories.Resource(url="http://a.example.com/{0}".format(i + 2))
+        b_1 = factories.Resource(url="http://b.example.com/1")["id"]
+
+        results_ = results.get_resources_to_check(2, max_per_host=1)
+
+        assert results_ == [a_1, b_1]
+
+    def test_max_per_host_with_checked_resources(self):
+        a_1 = factories.Resource(url="http://a.example.com/1")["id"]
+        a_2 = factories.Resource(url="http://a.example.com/2")["id"]
+        b_1 = factories.Resource(url="http://b.example.com/1")["id"]
+        results.request_check([a_1, a_2, b_1])
+
+        results_ = results.get_resources_to_check(10, max_per_host=1)
+
+        assert len(results_) == 2
+        assert b_1 in results_
+        assert a_1 in results_ or a_2 in results_
+
+    def test_max_per_host_with_resources_with_no_host(self):
+        """Resources with no host shouldn't be limited by max_per_host."""
+        resources = [factories.Resource()["id"] for i in range(3)]
+        ckan.model.Session.execute("UPDATE resource SET url = ''")
+        ckan.model.Session.commit()
+
+        results_ = results.get_resources_to_check(3, max_per_host=1)
+
+        assert sorted(results_) == sorted(resources)
+
+    def test_host_cooldown_with_many_resources_on_the_cooling_host(self):
+        """Resources from other hosts should be given out even when all the
+        oldest resources are on a host that's cooling down."""
+        for i in range(10):
+            factories.Resource(url="http://a.example.com/{0}".format(i))
+        b_1 = factories.Resource(url="http://b.example.com/1")["id"]
+        cooldown = datetime.timedelta(minutes=5)
+
+        results.get_resources_to_check(1, host_cooldown=cooldown)
+        second = results.get_resources_to_check(2, host_cooldown=cooldown)
+
+        assert second == [b_1]
+
+    def _get_host(self, resource_id):
+        return ckan.model.Session.execute(
+            "SELECT host FROM link_checker_results WHERE resource_id = :id",
+            {"id": resource_id}).scalar()
+
+    def test_hosts_are_saved(self):
+        resource = factories.Resource(url="http://a.example.com/1")["id"]
+
+        results.get_resources_to_check(10)
+
+        assert self._get_host(resource) == "a.example.com"
+
+    def test_request_check_saves_the_host(self):
+        resource = factories.Resource(url="http://a.example.com/1")["id"]
+
+        results.request_check([resource])
+        assert self._get_host(resource) == "a.example.com"
+
+        ckan.model.Session.execute(
+            "UPDATE resource SET url = :url WHERE id = :id",
+            {"url": "http://b.example.com/1", "id": resource})
+        results.request_check([resource], url_changed=True)
+        assert self._get_host(resource) == "b.example.com"
+
+    def test_migration_fills_in_missing_hosts(self):
+        resource = factories.Resource(url="http://a.example.com/1")["id"]
+        results.request_check([resource])
+        ckan.model.Session.execute(
+            "UPDATE link_checker_results SET host = NULL")
+        ckan.model.Session.execute(
+            "UPDATE link_checker_schema_version SET version = 11")
+        ckan.model.Session.commit()
+
+        results.create_database_table()
+
+        assert self._get_host(resource) == "a.example.com"
+
+
+class TestAdaptiveRecheck(object):
+    """Tests for the per-resource next check times."""
+
+    def setup(self):
+        helpers.reset_db()
+        results.create_database_table()
+        self.original_adaptive_recheck = config.adaptive_recheck
+        config.adaptive_recheck = True
+
+    def teardown(self):
+        config.adaptive_recheck = self.original_adaptive_recheck
+
+    def _interval(self, resource_id):
+        row = ckan.model.Session.execute(
+            "SELECT last_checked, next_check_at FROM link_checker_results "
+            "WHERE resource_id = :id", {"id": resource_id}).first()
+        return row.next_check_at - row.last_checked
+
+    def test_interval_doubles_while_alive(self):
+        base = datetime.timedelta(hours=config.recheck_resources_after)
+
+        results.upsert("test_resource", True)
+        assert self._interval("test_resource") == base
+        results.upsert("test_resource", True)
+        assert self._interval("test_resource") == base * 2
+        results.upsert("test_resource", True)
+        assert self._interval("test_resource") == base * 4
+
+    def test_interval_is_capped(self):
+        for i in range(20):
+            results.upsert("test_resource", True)
+
+        assert self._interval("test_resource") == datetime.timedelta(
+            hours=config.adaptive_recheck_max_hours)
+
+    def test_changed_results_are_rechecked_sooner(self):
+        results.upsert("test_resource", True)
+        results.upsert("test_resource", True)
+
+        results.upsert("test_resource", False)
+
+        assert self._interval("test_resource") == datetime.timedelta(
+            hours=config.adaptive_recheck_min_hours)
+
+    def test_no_next_check_time_when_turned_off(self):
+        config.adaptive_recheck = False
+
+        results.upsert("test_resource", True)
+
+        next_check_at = ckan.model.Session.execute(
+            "SELECT next_check_at FROM link_checker_results").scalar()
+        assert next_check_at is None
+
+    def test_resources_are_returned_when_their_next_check_is_due(self):
+        due = factories.Resource()["id"]
+        not_due = factories.Resource()["id"]
+        long_ago = datetime.datetime.utcnow() - datetime.timedelta(days=60)
+        results.upsert(due, True, last_checked=long_ago)
+        # Its last check was long ago, but its next check isn't due yet.
+        results.upsert(not_due, True, last_checked=long_ago)
+        ckan.model.Session.execute(
+            "UPDATE link_checker_results SET next_check_at = :next "
+            "WHERE resource_id = :id",
+            {"next": datetime.datetime.utcnow() + datetime.timedelta(days=1),
+             "id": not_due})
+        ckan.model.Session.commit()
+
+        assert results.get_resources_to_check(10) == [due]
+
+
+class TestDeduplicateURLs(object):
+    """Tests for checking each distinct URL only once."""
+
+    def setup(self):
+        helpers.reset_db()
+        results.create_database_table()
+        self.original_deduplicate_urls = config.deduplicate_urls
+        config.deduplicate_urls = True
+
+    def teardown(self):
+        config.deduplicate_urls = self.original_deduplicate_urls
+
+    def test_url_hash(self):
+        url_hash = results._get_url_hash("http://example.com/data?x=1")
+
+        for url in (" HTTP://Example.COM/data?x=1 ",
+                    "http://example.com:80/data?x=1",
+                    "http://example.com/data?x=1#section"):
+            assert results._get_url_hash(url) == url_hash
+        for url in ("http://example.com/Data?x=1",
+                    "http://example.com/data?x=2",
+                    "https://example.com/data?x=1"):
+            assert results._get_url_hash(url) != url_hash
+        assert results._get_url_hash(
+            "http://example.com") == results._get_url_hash(
+                "http://example.com/")
+        assert results._get_url_hash(None) is None
+
+    def test_each_url_is_given_out_once(self):
+        resource_1 = factories.Resource(url="http://example.com/1")["id"]
+        factories.Resource(url="http://EXAMPLE.com/1")
+        resource_3 = factories.Resource(url="http://example.com/3")["id"]
+
+        first = results.get_resources_to_check(10)
+        second = results.get_resources_to_check(10)
+
+        assert first == [resource_1, resource_3]
+        assert second == []
+
+    def test_results_are_saved_for_resources_with_the_same_url(self):
+        resource_1 = factories.Resource(url="http://example.com/1")["id"]
+        resource_2 = factories.Resource(url="http://example.com/1")["id"]
+        resource_3 = factories.Resource(url="http://example.com/3")["id"]
+        results.get_resources_to_check(10)
+
+        results.upsert(resource_1, False, status=404)
+
+        result_2 = results.get(resource_2)
+        assert result_2["alive"] is False
+        assert result_2["status"] == 404
+        assert result_2["pending"] is False
+        assert results.get(resource_3)["alive"] is None
+
 
 class TestAll(object):
     """Tests for the all() function."""
@@ -629,3 +1685,51 @@ class TestAll(object):
         assert results_[0]["resource_id"] == "test_resource_1"
         assert results_[1]["resource_id"] == "test_resource_2"
         assert results_[2]["resource_id"] == "test_resource_3"
+
+
+class TestIterResults(object):
+    """Tests for the iter_results() function."""
+
+    def setup(self):
+        results.create_database_table()
+        helpers.reset_db()
+
+    def test_with_no_results(self):
+        assert list(results.iter_results()) == []
+
+    def test_all_columns(self):
+        results.upsert("test_resource_id", True, status=200, reason="OK")
+
+        results_ = list(results.iter_results())
+
+        assert len(results_) == 1
+        result = results_[0]
+        assert result.resource_id == "test_resource_id"
+        assert result.alive is True
+        assert result.status == 200
+        assert result.reason == "OK"
+        assert isinstance(result.last_checked, datetime.datetime)
+
+    def test_some_columns(self):
+        results.upsert("test_resource_id", False)
+
+        results_ = list(results.iter_results(columns=["resource_id",
+                                                      "num_fails"]))
+
+        assert results_ == [("test_resource_id", 1)]
+        assert results_[0]._fields == ("resource_id", "num_fails")
+
+    def test_unknown_column(self):
+        nose.tools.assert_raises(
+            ValueError, list, results.iter_results(columns=["resource_id",
+                                                            "nonexistent"]))
+
+    def test_chunks(self):
+        resource_ids = ["test_resource_{0}".format(i) for i in range(5)]
+        for resource_id in resource_ids:
+            results.upsert(resource_id, True)
+
+        results_ = list(results.iter_results(columns=["resource_id"],
+                                             chunk_size=2))
+
+        assert [result.resource_id for result in results_] == resource_ids
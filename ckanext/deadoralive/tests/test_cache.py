@@ -0,0 +1,108 @@
+"""Tests for cache.py."""
+import ckan.new_tests.helpers as helpers
+import ckan.new_tests.factories as factories
+
+import ckanext.deadoralive.cache as cache
+import ckanext.deadoralive.config as config
+import ckanext.deadoralive.model.results as results
+import ckanext.deadoralive.tests.helpers as custom_helpers
+import ckanext.deadoralive.tests.factories as custom_factories
+
+
+class TestLRUCache(object):
+    """Unit tests for the in-process LRU cache."""
+
+    def test_get_missing_key(self):
+        lru = cache._LRUCache()
+        assert lru.get("key") is cache._MISSING
+
+    def test_set_and_get(self):
+        lru = cache._LRUCache()
+        lru.set("key", "value", ttl=60, max_size=10)
+        assert lru.get("key") == "value"
+
+    def test_expired_items_are_not_returned(self):
+        lru = cache._LRUCache()
+        lru.set("key", "value", ttl=-1, max_size=10)
+        assert lru.get("key") is cache._MISSING
+
+    def test_least_recently_used_item_is_evicted(self):
+        lru = cache._LRUCache()
+        lru.set("a", 1, ttl=60, max_size=2)
+        lru.set("b", 2, ttl=60, max_size=2)
+        lru.get("a")
+        lru.set("c", 3, ttl=60, max_size=2)
+
+        assert lru.get("a") == 1
+        assert lru.get("b") is cache._MISSING
+        assert lru.get("c") == 3
+
+
+class TestGetOrCreate(custom_helpers.FunctionalTestBaseClass):
+
+    def setup(self):
+        custom_helpers.FunctionalTestBaseClass.setup(self)
+        self.original_ttl = config.report_cache_ttl
+        config.report_cache_ttl = 300
+        self.calls = []
+
+    def teardown(self):
+        config.report_cache_ttl = self.original_ttl
+
+    def _create(self):
+        self.calls.append(1)
+        return len(self.calls)
+
+    def test_report_is_only_created_once(self):
+        assert cache.get_or_create("report", {}, self._create) == 1
+        assert cache.get_or_create("report", {}, self._create) == 1
+        assert len(self.calls) == 1
+
+    def test_params_are_cached_separately(self):
+        assert cache.get_or_create("report", {"a": 1}, self._create) == 1
+        assert cache.get_or_create("report", {"a": 2}, self._create) == 2
+
+    def test_changing_config_invalidates_the_cache(self):
+        original = config.broken_resource_min_fails
+        try:
+            assert cache.get_or_create("report", {}, self._create) == 1
+            config.broken_resource_min_fails = original + 1
+            results.update_broken_states()
+            assert cache.get_or_create("report", {}, self._create) == 2
+        finally:
+            config.broken_resource_min_fails = original
+            results.update_broken_states()
+
+    def test_caching_can_be_disabled(self):
+        config.report_cache_ttl = 0
+        assert cache.get_or_create("report", {}, self._create) == 1
+        assert cache.get_or_create("report", {}, self._create) == 2
+
+    def test_upsert_that_breaks_a_link_invalidates_the_cache(self):
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        organization = factories.Organization()
+        dataset = custom_factories.Dataset(owner_org=organization["id"])
+        resource = custom_factories.Resource(package_id=dataset["id"])
+        generation = results.get_generation()
+
+        report = helpers.call_action(
+            "ckanext_deadoralive_broken_links_by_organization")
+        assert report == []
+
+        custom_helpers.make_broken((resource,), user)
+        assert results.get_generation() > generation
+
+        report = helpers.call_action(
+            "ckanext_deadoralive_broken_links_by_organization")
+        assert len(report) == 1
+
+    def test_upsert_that_changes_nothing_keeps_the_generation(self):
+        user = factories.User()
+        resource = custom_factories.Resource()
+        custom_helpers.make_working((resource,), user)
+        generation = results.get_generation()
+
+        custom_helpers.make_working((resource,), user)
+
+        assert results.get_generation() == generation
@@ -0,0 +1,373 @@
+"""Tests for checker.py.
+
+These run the link checker against a stub HTTP server on localhost.
+
+"""
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+
+import pylons.config
+import requests.exceptions
+
+import ckan.model
+import ckanext.deadoralive.checker as checker
+import ckanext.deadoralive.config as config
+import ckanext.deadoralive.model.results as results
+import ckanext.deadoralive.tests.helpers as custom_helpers
+import ckanext.deadoralive.tests.factories as custom_factories
+
+
+class _StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.concurrent += 1
+            server.max_concurrent = max(server.max_concurrent,
+                                        server.concurrent)
+        try:
+            self._respond()
+        finally:
+            with server.lock:
+                server.concurrent -= 1
+
+    def _respond(self):
+        if self.path.startswith("/slow"):
+            time.sleep(0.2)
+            self._send(200, "OK")
+        elif self.path == "/etag":
+            if self.headers.get("If-None-Match") == '"abc"':
+                self._send(304, "Not Modified")
+            else:
+                self._send(200, "OK", {"ETag": '"abc"',
+                                       "Last-Modified":
+                                       "Wed, 21 Oct 2015 07:28:00 GMT"})
+        elif self.path == "/timeout":
+            time.sleep(2)
+            self._send(200, "OK")
+        elif self.path == "/error":
+            self._send(500, "Internal Server Error")
+        elif self.path == "/missing":
+            self._send(404, "Not Found")
+        else:
+            self._send(200, "OK")
+
+    def _send(self, status, reason, headers=None):
+        body = "" if status == 304 else "Hello world"
+        self.send_response(status, reason)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           _StubHandler)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.requests = []
+        self.concurrent = 0
+        self.max_concurrent = 0
+
+    def url(self, path):
+        return "http://127.0.0.1:{0}{1}".format(self.server_address[1], path)
+
+
+_server = None
+
+
+def setup_module():
+    global _server
+    _server = _StubServer()
+    thread = threading.Thread(target=_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+def teardown_module():
+    _server.shutdown()
+    _server.server_close()
+
+
+class TestCheckURL(object):
+    """Tests for the check_url() function."""
+
+    def setup(self):
+        self.server = _server
+        self.server.reset()
+        self.session = checker._make_session(2)
+
+    def teardown(self):
+        self.session.close()
+
+    def test_working_link(self):
+        result = checker.check_url(self.session, self.server.url("/ok"), 5)
+
+        assert result["alive"] is True
+        assert result["status"] == 200
+        assert result["reason"] == "OK"
+        assert result["content_length"] == len("Hello world")
+
+    def test_not_found(self):
+        result = checker.check_url(self.session, self.server.url("/missing"),
+                                   5)
+
+        assert result["alive"] is False
+        assert result["status"] == 404
+        assert result["reason"] == "Not Found"
+
+    def test_server_error(self):
+        result = checker.check_url(self.session, self.server.url("/error"), 5)
+
+        assert result["alive"] is False
+        assert result["status"] == 500
+
+    def test_timeout(self):
+        result = checker.check_url(self.session,
+                                   self.server.url("/timeout"), 0.5)
+
+        assert result["alive"] is False
+        assert result["status"] is None
+        assert result["reason"]
+
+    def test_connection_refused(self):
+        # Find a port that nothing is listening on.
+        server = _StubServer()
+        url = server.url("/ok")
+        server.server_close()
+
+        result = checker.check_url(self.session, url, 5)
+
+        assert result["alive"] is False
+        assert result["status"] is None
+        assert result["reason"]
+
+    def test_invalid_url(self):
+        for url in (None, "", "not a url"):
+            result = checker.check_url(self.session, url, 5)
+
+            assert result["alive"] is False
+            assert result["status"] is None
+            assert result["reason"]
+
+    def test_it_returns_the_validators(self):
+        result = checker.check_url(self.session, self.server.url("/etag"), 5)
+
+        assert result["etag"] == '"abc"'
+        assert result["last_modified"] == "Wed, 21 Oct 2015 07:28:00 GMT"
+
+    def test_not_modified_is_alive(self):
+        result = checker.check_url(self.session, self.server.url("/etag"), 5,
+                                   validators=dict(etag='"abc"'))
+
+        assert result["alive"] is True
+        assert result["status"] == 304
+
+    def test_non_ascii_error_message(self):
+        def get(*args, **kwargs):
+            raise requests.exceptions.ConnectionError(u"Verbindung f\xfcr")
+        self.session.get = get
+
+        result = checker.check_url(self.session, self.server.url("/ok"), 5)
+
+        assert result["alive"] is False
+        assert result["reason"] == u"Verbindung f\xfcr"
+
+
+class TestCheckResource(object):
+    """Tests for the _check_resource() function."""
+
+    def test_unexpected_error(self):
+        """An unexpected error checking a link should save the link as dead,
+        not crash the batch."""
+        class Session(object):
+            def get(self, *args, **kwargs):
+                raise RuntimeError(u"Unexpected \xfc")
+
+        result = checker._check_resource(
+            dict(id="test_resource", url="http://example.com/"),
+            session=Session(), limiter=checker._HostLimiter(2), timeout=5)
+
+        assert result["resource_id"] == "test_resource"
+        assert result["alive"] is False
+        assert result["status"] is None
+        assert result["reason"] == "RuntimeError"
+
+
+class TestRun(custom_helpers.FunctionalTestBaseClass):
+    """Tests for the run() function."""
+
+    def setup(self):
+        custom_helpers.FunctionalTestBaseClass.setup(self)
+        self.server = _server
+        self.server.reset()
+
+    def test_it_saves_the_results(self):
+        working = custom_factories.Resource(url=self.server.url("/ok"))
+        broken = custom_factories.Resource(url=self.server.url("/missing"))
+
+        stats = checker.run(concurrency=2)
+
+        assert stats == dict(checked=2, alive=1, dead=1)
+        assert results.get(working["id"])["alive"] is True
+        assert results.get(working["id"])["status"] == 200
+        assert results.get(broken["id"])["alive"] is False
+        assert results.get(broken["id"])["status"] == 404
+        assert results.get(broken["id"])["pending"] is False
+
+    def test_uploaded_resource(self):
+        """Uploaded resources should be checked at their download URL, the
+        URL that resource_show returns."""
+        resource = custom_factories.Resource()
+        ckan.model.Session.execute(
+            "UPDATE resource SET url = 'data.csv', url_type = 'upload' "
+            "WHERE id = :id", {"id": resource["id"]})
+        ckan.model.Session.commit()
+        original_site_url = pylons.config["ckan.site_url"]
+        pylons.config["ckan.site_url"] = self.server.url("")
+        try:
+            stats = checker.run()
+        finally:
+            pylons.config["ckan.site_url"] = original_site_url
+
+        assert stats == dict(checked=1, alive=1, dead=0)
+        assert self.server.requests == [
+            "/dataset/{0}/resource/{1}/download/data.csv".format(
+                resource["package_id"], resource["id"])]
+        assert results.get(resource["id"])["alive"] is True
+
+    def test_it_does_not_recheck_resources_that_were_just_checked(self):
+        custom_factories.Resource(url=self.server.url("/ok"))
+        checker.run()
+        self.server.reset()
+
+        stats = checker.run()
+
+        assert stats["checked"] == 0
+        assert self.server.requests == []
+
+    def test_it_checks_all_the_batches(self):
+        for _ in range(5):
+            custom_factories.Resource(url=self.server.url("/ok"))
+
+        stats = checker.run(batch_size=2)
+
+        assert stats["checked"] == 5
+        assert len(self.server.requests) == 5
+
+    def test_max_batches(self):
+        for _ in range(5):
+            custom_factories.Resource(url=self.server.url("/ok"))
+
+        stats = checker.run(batch_size=2, max_batches=1)
+
+        assert stats["checked"] == 2
+
+    def test_it_saves_and_sends_the_validators(self):
+        resource = custom_factories.Resource(url=self.server.url("/etag"))
+        checker.run()
+        assert results.get_validators([resource["id"]])[0]["etag"] == '"abc"'
+
+        results.request_check([resource["id"]])
+        checker.run()
+
+        assert results.get(resource["id"])["status"] == 304
+        assert results.get_validators([resource["id"]])[0]["etag"] == '"abc"'
+
+    def test_per_host_limit(self):
+        for _ in range(6):
+            custom_factories.Resource(url=self.server.url("/slow"))
+
+        checker.run(concurrency=6, per_host=2)
+
+        assert self.server.max_concurrent <= 2
+        assert len(self.server.requests) == 6
+
+    def test_concurrency(self):
+        for _ in range(6):
+            custom_factories.Resource(url=self.server.url("/slow"))
+
+        checker.run(concurrency=3, per_host=0)
+
+        assert 1 < self.server.max_concurrent <= 3
+
+    def test_stop(self):
+        custom_factories.Resource(url=self.server.url("/ok"))
+        stop = threading.Event()
+        stop.set()
+
+        stats = checker.run(stop=stop)
+
+        assert stats["checked"] == 0
+        assert self.server.requests == []
+
+    def test_it_waits_for_hosts_to_cool_down(self):
+        """When all the resources that are due are on a host that's cooling
+        down the checker should wait, not stop."""
+        for _ in range(2):
+            custom_factories.Resource(url=self.server.url("/ok"))
+        original_host_cooldown = config.host_cooldown
+        config.host_cooldown = 1
+        try:
+            stats = checker.run(batch_size=1)
+        finally:
+            config.host_cooldown = original_host_cooldown
+
+        assert stats["checked"] == 2
+        assert len(self.server.requests) == 2
+
+
+class TestRunProcesses(custom_helpers.FunctionalTestBaseClass):
+    """Tests for the run_processes() function."""
+
+    def setup(self):
+        custom_helpers.FunctionalTestBaseClass.setup(self)
+        self.server = _server
+        self.server.reset()
+
+    def test_it_checks_each_resource_once(self):
+        resources = [
+            custom_factories.Resource(url=self.server.url("/ok/{0}".format(i)))
+            for i in range(8)]
+
+        stats = checker.run_processes(3, batch_size=2)
+
+        assert stats == dict(checked=8, alive=8, dead=0, failed_processes=0)
+        assert sorted(self.server.requests) == sorted(
+            "/ok/{0}".format(i) for i in range(8))
+        for resource in resources:
+            assert results.get(resource["id"])["alive"] is True
+
+    def test_it_aggregates_the_stats(self):
+        for _ in range(3):
+            custom_factories.Resource(url=self.server.url("/ok"))
+        for _ in range(2):
+            custom_factories.Resource(url=self.server.url("/missing"))
+
+        stats = checker.run_processes(2, batch_size=1)
+
+        assert stats == dict(checked=5, alive=3, dead=2, failed_processes=0)
+
+    def test_failed_processes(self):
+        custom_factories.Resource(url=self.server.url("/ok"))
+
+        # An invalid argument makes run() crash in every worker process.
+        stats = checker.run_processes(2, concurrency=0)
+
+        assert stats["failed_processes"] == 2
+        assert stats["checked"] == 0
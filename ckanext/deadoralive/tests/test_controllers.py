@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 """Frontend tests for controllers.py."""
+import csv
+import json
+
 import ckan.new_tests.factories as factories
 import ckanext.deadoralive.tests.helpers as custom_helpers
 import ckanext.deadoralive.tests.factories as custom_factories
 import ckanext.deadoralive.config as config
+import ckanext.deadoralive.controllers as controllers
 
 
 class TestBrokenLinksController(custom_helpers.FunctionalTestBaseClass):
@@ -47,6 +51,34 @@ class TestBrokenLinksController(custom_helpers.FunctionalTestBaseClass):
         assert dataset_4["name"] in response
         assert dataset_5["name"] in response
 
+    def test_broken_links_by_organization_paging(self):
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        org_1 = factories.Organization()
+        dataset_1 = custom_factories.Dataset(owner_org=org_1["id"])
+        resource_1 = custom_factories.Resource(package_id=dataset_1["id"])
+        resource_2 = custom_factories.Resource(package_id=dataset_1["id"])
+        org_2 = factories.Organization()
+        dataset_2 = custom_factories.Dataset(owner_org=org_2["id"])
+        resource_3 = custom_factories.Resource(package_id=dataset_2["id"])
+        custom_helpers.make_broken((resource_1, resource_2, resource_3),
+                                   user=user)
+
+        original_per_page = controllers.ORGANIZATIONS_PER_PAGE
+        controllers.ORGANIZATIONS_PER_PAGE = 1
+        try:
+            page_1 = self.app.get("/organization/broken_links")
+            page_2 = self.app.get("/organization/broken_links?page=2")
+        finally:
+            controllers.ORGANIZATIONS_PER_PAGE = original_per_page
+
+        assert dataset_1["name"] in page_1
+        assert dataset_2["name"] not in page_1
+        assert "page=2" in page_1
+        assert dataset_1["name"] not in page_2
+        assert dataset_2["name"] in page_2
+        assert "page=1" in page_2
+
     def test_broken_links_by_organization_when_no_broken_links(self):
         response = self.app.get("/organization/broken_links")
         assert "This site has no broken links" in response
@@ -66,6 +98,19 @@ class TestBrokenLinksController(custom_helpers.FunctionalTestBaseClass):
 
         self.app.get("/organization/broken_links")
 
+    def test_dataset_page_marks_broken_resources(self):
+        user = factories.User()
+        config.authorized_users = [user["name"]]
+        dataset = custom_factories.Dataset()
+        resource_1 = custom_factories.Resource(package_id=dataset["id"])
+        resource_2 = custom_factories.Resource(package_id=dataset["id"])
+        custom_helpers.make_broken((resource_1,), user=user)
+        custom_helpers.make_working((resource_2,), user=user)
+
+        response = self.app.get("/dataset/" + dataset["name"])
+
+        assert response.body.count("</i> Broken</span>") == 1
+
     def test_broken_links_by_email(self):
         sysadmin = custom_factories.Sysadmin()
         extra_environ = {'REMOTE_USER': str(sysadmin["name"])}
@@ -148,3 +193,93 @@ class TestBrokenLinksController(custom_helpers.FunctionalTestBaseClass):
         custom_helpers.make_broken((resource_1, resource_2), user=sysadmin)
 
         self.app.get("/ckan-admin/broken_links", extra_environ=extra_environ)
+
+    def test_metrics(self):
+        sysadmin = custom_factories.Sysadmin()
+        extra_environ = {'REMOTE_USER': str(sysadmin["name"])}
+        custom_helpers.make_working((custom_factories.Resource(),),
+                                    user=sysadmin)
+
+        response = self.app.get("/deadoralive/metrics",
+                                extra_environ=extra_environ)
+
+        assert response.content_type == "text/plain"
+        assert ('deadoralive_call_duration_seconds_count'
+                '{function="logic.action.update.upsert"}') in response
+
+    def test_metrics_not_authorized(self):
+        user = factories.User()
+        config.authorized_users = []
+        for extra_environ in (None, {'REMOTE_USER': str(user["name"])}):
+            self.app.get("/deadoralive/metrics", status=403,
+                         extra_environ=extra_environ)
+
+    def _make_broken_links_for_export(self, sysadmin):
+        organization = factories.Organization(name="test_org")
+        dataset = custom_factories.Dataset(
+            name="test_dataset", owner_org=organization["id"],
+            maintainer_email=u"mäintainer@maintainers.com")
+        broken = custom_factories.Resource(package_id=dataset["id"],
+                                           url="http://example.com/broken")
+        working = custom_factories.Resource(package_id=dataset["id"])
+        custom_helpers.make_broken((broken,), user=sysadmin)
+        custom_helpers.make_working((working,), user=sysadmin)
+        return broken, working
+
+    def test_broken_links_csv(self):
+        sysadmin = custom_factories.Sysadmin()
+        extra_environ = {'REMOTE_USER': str(sysadmin["name"])}
+        broken, working = self._make_broken_links_for_export(sysadmin)
+
+        response = self.app.get("/deadoralive/broken_links.csv",
+                                extra_environ=extra_environ)
+
+        assert response.content_type == "text/csv"
+        assert "broken_links.csv" in response.headers["Content-Disposition"]
+        rows = list(csv.reader(response.body.splitlines()))
+        assert rows[0] == ["resource_id", "url", "dataset", "organization",
+                           "email", "status", "reason", "num_fails",
+                           "last_successful"]
+        assert len(rows) == 2
+        row = dict(zip(rows[0], rows[1]))
+        assert row["resource_id"] == broken["id"]
+        assert row["url"] == "http://example.com/broken"
+        assert row["dataset"] == "test_dataset"
+        assert row["organization"] == "test_org"
+        assert row["email"] == u"mäintainer@maintainers.com".encode("utf-8")
+        assert row["num_fails"] == "3"
+        assert row["last_successful"] == ""
+
+    def test_broken_links_jsonl(self):
+        sysadmin = custom_factories.Sysadmin()
+        extra_environ = {'REMOTE_USER': str(sysadmin["name"])}
+        broken, working = self._make_broken_links_for_export(sysadmin)
+
+        response = self.app.get("/deadoralive/broken_links.jsonl",
+                                extra_environ=extra_environ)
+
+        assert response.content_type == "application/x-ndjson"
+        links = [json.loads(line) for line in response.body.splitlines()]
+        assert len(links) == 1
+        assert links[0]["resource_id"] == broken["id"]
+        assert links[0]["email"] == u"mäintainer@maintainers.com"
+        assert links[0]["num_fails"] == 3
+        assert links[0]["last_successful"] is None
+
+    def test_broken_links_export_when_no_broken_links(self):
+        sysadmin = custom_factories.Sysadmin()
+        extra_environ = {'REMOTE_USER': str(sysadmin["name"])}
+
+        response = self.app.get("/deadoralive/broken_links.csv",
+                                extra_environ=extra_environ)
+        assert len(response.body.splitlines()) == 1
+
+        response = self.app.get("/deadoralive/broken_links.jsonl",
+                                extra_environ=extra_environ)
+        assert response.body == ""
+
+    def test_broken_links_export_not_authorized(self):
+        """Non-sysadmins should get redirected if they try to export."""
+        for url in ("/deadoralive/broken_links.csv",
+                    "/deadoralive/broken_links.jsonl"):
+            self.app.get(url, status=302)
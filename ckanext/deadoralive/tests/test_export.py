@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Tests for export.py."""
+import csv
+
+import ckanext.deadoralive.export as export
+
+
+def _link(**kwargs):
+    link = dict.fromkeys(export.FIELDS)
+    link.update(kwargs)
+    return link
+
+
+class TestIterCSV(object):
+    """Tests for the iter_csv() function."""
+
+    def _rows(self, links):
+        lines = "".join(export.iter_csv(links)).splitlines()
+        return [dict(zip(export.FIELDS, row))
+                for row in csv.reader(lines[1:])]
+
+    def test_values(self):
+        row, = self._rows([_link(resource_id=u"abc", email=u"mä@example.com",
+                                 status=404, num_fails=3)])
+
+        assert row["resource_id"] == "abc"
+        assert row["email"] == u"mä@example.com".encode("utf-8")
+        assert row["status"] == "404"
+        assert row["num_fails"] == "3"
+        assert row["reason"] == ""
+
+    def test_formulas_are_escaped(self):
+        """Values that a spreadsheet would run as a formula should be
+        prefixed with a '."""
+        row, = self._rows([_link(url=u"=HYPERLINK(\"http://evil\")",
+                                 reason=u"+1", email=u"@SUM(A1)",
+                                 dataset=u"-1", organization=u"\tx")])
+
+        assert row["url"] == "'=HYPERLINK(\"http://evil\")"
+        assert row["reason"] == "'+1"
+        assert row["email"] == "'@SUM(A1)"
+        assert row["dataset"] == "'-1"
+        assert row["organization"] == "'\tx"
+
+    def test_other_values_are_not_escaped(self):
+        row, = self._rows([_link(url=u"http://example.com/a=b",
+                                 reason=u"Not Found")])
+
+        assert row["url"] == "http://example.com/a=b"
+        assert row["reason"] == "Not Found"
@@ -0,0 +1,180 @@
+"""Tests for metrics.py."""
+import nose.tools
+
+import ckanext.deadoralive.metrics as metrics
+import ckanext.deadoralive.model.results as results
+import ckanext.deadoralive.tests.helpers as custom_helpers
+import ckanext.deadoralive.tests.factories as custom_factories
+
+
+@metrics.instrument
+def _return_rows(n):
+    return range(n)
+
+
+@metrics.instrument
+def _raise():
+    raise ValueError("Oops")
+
+
+@metrics.instrument
+def _yield_rows(n):
+    for i in range(n):
+        yield i
+
+
+def _get_metric(text, line_start):
+    """Return the value of the metric line that starts with line_start."""
+    for line in text.splitlines():
+        if line.startswith(line_start + " "):
+            return float(line.split()[-1])
+    raise AssertionError("No metric {0} in:\n{1}".format(line_start, text))
+
+
+class TestInstrument(object):
+    """Unit tests for the instrument() decorator."""
+
+    def setup(self):
+        metrics.clear()
+
+    def test_it_returns_the_result(self):
+        assert _return_rows(3) == [0, 1, 2]
+
+    def test_it_keeps_the_function_name(self):
+        assert _return_rows.__name__ == "_return_rows"
+
+    def test_it_counts_calls_and_rows(self):
+        _return_rows(3)
+        _return_rows(4)
+
+        text = metrics.render()
+
+        assert _get_metric(
+            text, 'deadoralive_call_duration_seconds_count'
+                  '{function="tests.test_metrics._return_rows"}') == 2
+        assert _get_metric(
+            text, 'deadoralive_call_duration_seconds_bucket'
+                  '{function="tests.test_metrics._return_rows",le="+Inf"}'
+        ) == 2
+        assert _get_metric(
+            text, 'deadoralive_rows_returned_total'
+                  '{function="tests.test_metrics._return_rows"}') == 7
+        assert _get_metric(
+            text, 'deadoralive_errors_total'
+                  '{function="tests.test_metrics._return_rows"}') == 0
+
+    def test_it_counts_errors(self):
+        nose.tools.assert_raises(ValueError, _raise)
+
+        assert _get_metric(
+            metrics.render(),
+            'deadoralive_errors_total{function="tests.test_metrics._raise"}'
+        ) == 1
+
+    def test_histogram_buckets_are_cumulative(self):
+        _return_rows(1)
+
+        text = metrics.render()
+
+        values = [
+            _get_metric(text, 'deadoralive_call_duration_seconds_bucket'
+                              '{{function="tests.test_metrics._return_rows",'
+                              'le="{0}"}}'.format(bound))
+            for bound in metrics.BUCKETS]
+        assert values == sorted(values)
+        assert values[-1] == 1
+
+    def test_generator_is_recorded_when_exhausted(self):
+        rows = _yield_rows(3)
+        assert "_yield_rows" not in metrics.render()
+
+        assert list(rows) == [0, 1, 2]
+
+        text = metrics.render()
+        assert _get_metric(
+            text, 'deadoralive_call_duration_seconds_count'
+                  '{function="tests.test_metrics._yield_rows"}') == 1
+        assert _get_metric(
+            text, 'deadoralive_rows_returned_total'
+                  '{function="tests.test_metrics._yield_rows"}') == 3
+        assert _get_metric(
+            text, 'deadoralive_errors_total'
+                  '{function="tests.test_metrics._yield_rows"}') == 0
+
+    def test_generator_is_recorded_when_closed(self):
+        rows = _yield_rows(3)
+        next(rows)
+        rows.close()
+
+        text = metrics.render()
+        assert _get_metric(
+            text, 'deadoralive_call_duration_seconds_count'
+                  '{function="tests.test_metrics._yield_rows"}') == 1
+        assert _get_metric(
+            text, 'deadoralive_rows_returned_total'
+                  '{function="tests.test_metrics._yield_rows"}') == 1
+        assert _get_metric(
+            text, 'deadoralive_errors_total'
+                  '{function="tests.test_metrics._yield_rows"}') == 0
+
+    def test_generator_keeps_the_function_name(self):
+        assert _yield_rows.__name__ == "_yield_rows"
+
+    def test_clear(self):
+        _return_rows(1)
+        metrics.clear()
+
+        assert "_return_rows" not in metrics.render()
+
+
+class TestSQLStatementCounts(custom_helpers.FunctionalTestBaseClass):
+
+    def setup(self):
+        custom_helpers.FunctionalTestBaseClass.setup(self)
+        metrics.clear()
+
+    def test_it_counts_sql_statements(self):
+        resource = custom_factories.Resource()
+        results.upsert(resource["id"], True)
+        results.get(resource["id"])
+
+        assert _get_metric(
+            metrics.render(),
+            'deadoralive_sql_statements_total{function="model.results.get"}'
+        ) >= 1
+        assert _get_metric(
+            metrics.render(),
+            'deadoralive_call_duration_seconds_count'
+            '{function="model.results.upsert_many"}') == 1
+
+    def test_it_counts_a_generators_sql_statements(self):
+        resource = custom_factories.Resource()
+        # A link that has never worked is broken after 3 failed checks.
+        for i in range(3):
+            results.upsert(resource["id"], False)
+        metrics.clear()
+
+        assert len(list(results.get_broken_links())) == 1
+
+        text = metrics.render()
+        assert _get_metric(
+            text, 'deadoralive_sql_statements_total'
+                  '{function="model.results.get_broken_links"}') >= 1
+        assert _get_metric(
+            text, 'deadoralive_rows_returned_total'
+                  '{function="model.results.get_broken_links"}') == 1
+
+    def test_it_records_iter_results(self):
+        for i in range(2):
+            results.upsert(custom_factories.Resource()["id"], True)
+        metrics.clear()
+
+        assert len(list(results.iter_results())) == 2
+
+        text = metrics.render()
+        assert _get_metric(
+            text, 'deadoralive_call_duration_seconds_count'
+                  '{function="model.results.iter_results"}') == 1
+        assert _get_metric(
+            text, 'deadoralive_rows_returned_total'
+                  '{function="model.results.iter_results"}') == 2
@@ -81,5 +81,8 @@ setup(
     entry_points='''
         [ckan.plugins]
         deadoralive=ckanext.deadoralive.plugin:DeadOrAlivePlugin
+
+        [paste.paster_command]
+        deadoralive=ckanext.deadoralive.commands:DeadOrAliveCommand
     ''',
 )